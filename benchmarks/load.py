@@ -0,0 +1,298 @@
+# Load benchmark of the collector hot paths against the simulated management interface:
+# poll latency over the socket, parse cost, queue throughput between processes and
+# writer rows/s. SQLite stands in for MySQL by default, pass a MySQL connection string
+# to measure the real database.
+#
+#   PYTHONPATH=. python benchmarks/load.py --clients 10000 --save before.json
+#   PYTHONPATH=. python benchmarks/load.py --clients 10000 --baseline before.json
+#
+# With --baseline the run fails when a result is worse than the baseline by more than
+# --tolerance, so regressions are caught before deploy.
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from openvpn_monitor.columns import (
+    HOST,
+    USER,
+    IP,
+    INTERNAL_IP,
+    RECEIVED,
+    SENT,
+    CONNECTED_AT_STR,
+    CONNECTED_AT,
+    CLOSED_AT,
+    TIMESTAMP_START,
+    TIMESTAMP_END,
+    RECEIVED_PEAK,
+    SENT_PEAK,
+)
+from openvpn_monitor.const import ROLLUPS
+from openvpn_monitor.monitoring.openvpn import OVPNMonitor, collect
+from openvpn_monitor.monitoring.schema import migrate
+from openvpn_monitor.monitoring.series import FIELDS, SessionSeriesTracker
+from openvpn_monitor.monitoring.sql import (
+    OVPNDataWriter,
+    OVPNSessionsWriter,
+    OVPNSessionSeriesWriter,
+)
+from openvpn_monitor.tables import DATA_TABLE, SESSIONS_TABLE, rollup_table, series_table
+from simulator import spawn
+
+HOST_ALIAS = "gw0"
+
+# Result name -> True when lower is better
+RESULTS = {
+    "poll_p50_ms": True,
+    "poll_p95_ms": True,
+    "parse_p50_ms": True,
+    "parse_p95_ms": True,
+    "queue_data_items_per_s": False,
+    "queue_sessions_items_per_s": False,
+    "writer_data_rows_per_s": False,
+    "writer_sessions_rows_per_s": False,
+    "writer_series_rows_per_s": False,
+}
+
+
+class SQLiteDataWriter(OVPNDataWriter):
+    # ON DUPLICATE KEY is MySQL only
+    def rollup_query(self, rollup: str):
+        return text(
+            f"""
+            INSERT INTO {rollup}
+                ({", ".join(self.rollup_columns)})
+                VALUES
+                ({", ".join(":" + column for column in self.rollup_columns)})
+                ON CONFLICT ({HOST}, {TIMESTAMP_START}, {USER}) DO UPDATE SET
+                    {SENT} = {SENT} + excluded.{SENT},
+                    {RECEIVED} = {RECEIVED} + excluded.{RECEIVED},
+                    {SENT_PEAK} = MAX({SENT_PEAK}, excluded.{SENT_PEAK}),
+                    {RECEIVED_PEAK} = MAX({RECEIVED_PEAK}, excluded.{RECEIVED_PEAK})
+            """
+        )
+
+
+def create_sqlite_tables(connection_string: str):
+    # Same tables and keys as the migrations, which rely on MySQL DDL
+    series = series_table(SESSIONS_TABLE)
+    statements = [
+        f"""CREATE TABLE {SESSIONS_TABLE} (
+            {HOST} Text NOT NULL, {USER} Text NOT NULL, {IP} Text, {INTERNAL_IP} Text,
+            {SENT} BigInt, {RECEIVED} BigInt, {CONNECTED_AT_STR} Text,
+            {CONNECTED_AT} BigInt NOT NULL, {CLOSED_AT} BigInt)""",
+        f"""CREATE INDEX ix_{SESSIONS_TABLE}_host_connected
+            ON {SESSIONS_TABLE} ({HOST}, {CONNECTED_AT})""",
+        f"""CREATE TABLE {DATA_TABLE} (
+            {HOST} Text NOT NULL, {TIMESTAMP_START} BigInt NOT NULL,
+            {TIMESTAMP_END} BigInt NOT NULL, {USER} Text NOT NULL,
+            {SENT} BigInt NOT NULL, {RECEIVED} BigInt NOT NULL)""",
+        f"""CREATE INDEX ix_{DATA_TABLE}_host_ts_user
+            ON {DATA_TABLE} ({HOST}, {TIMESTAMP_START}, {USER})""",
+        f"""CREATE TABLE {series} (
+            {HOST} Text NOT NULL, {USER} Text NOT NULL, {IP} Text NOT NULL,
+            {CONNECTED_AT} BigInt NOT NULL, {TIMESTAMP_START} BigInt NOT NULL,
+            {TIMESTAMP_END} BigInt NOT NULL, {SENT} BigInt NOT NULL,
+            {RECEIVED} BigInt NOT NULL)""",
+        f"""CREATE INDEX ix_{series}_session
+            ON {series} ({HOST}, {USER}, {CONNECTED_AT}, {TIMESTAMP_START})""",
+    ]
+    for name in ROLLUPS:
+        statements.append(
+            f"""CREATE TABLE {rollup_table(DATA_TABLE, name)} (
+                {HOST} Text NOT NULL, {TIMESTAMP_START} BigInt NOT NULL,
+                {TIMESTAMP_END} BigInt NOT NULL, {USER} Text NOT NULL,
+                {SENT} BigInt NOT NULL, {RECEIVED} BigInt NOT NULL,
+                {SENT_PEAK} Double NOT NULL DEFAULT 0, {RECEIVED_PEAK} Double NOT NULL DEFAULT 0,
+                PRIMARY KEY ({HOST}, {TIMESTAMP_START}, {USER}))"""
+        )
+    with Session(create_engine(connection_string)) as session:
+        for statement in statements:
+            session.execute(text(statement))
+        session.commit()
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def poll(port: int, polls: int, interval: float):
+    # Polls the simulator like OVPNMonitor.run does, returns the poll and parse times
+    # and the items the collector would have put on the queues
+    monitor = OVPNMonitor(
+        host_alias=HOST_ALIAS,
+        host="127.0.0.1",
+        port=port,
+        sessions_queue=None,
+        data_queue=None,
+        timeout=30,
+    )
+    tracker = SessionSeriesTracker(HOST_ALIAS, flush_interval=0.)
+    poll_times, parse_times = [], []
+    items = {"data": [], "sessions": [], "series": []}
+    timestamp, status = int(time.time()), {}
+    for idx in range(polls + 1):
+        started = time.perf_counter()
+        parser = monitor.status()
+        if parser is None:
+            raise RuntimeError("Poll of the simulator failed")
+        poll_time = time.perf_counter() - started
+        # Fake timestamps, so every poll lands in its own interval
+        timestamp_prev, status_prev = timestamp, status
+        timestamp, status = timestamp_prev + 10, parser.sessions
+        collect_start = time.perf_counter()
+        expired, sessionbytes = collect(
+            HOST_ALIAS, timestamp_prev, status_prev, timestamp, status
+        )
+        parse_time = parser.elapsed + time.perf_counter() - collect_start
+        tracker.update(timestamp_prev, timestamp, status.values())
+        batch = tracker.flush(force=True)
+        # The first poll only sets the baseline
+        if idx:
+            poll_times.append(poll_time)
+            parse_times.append(parse_time)
+            items["sessions"] += expired
+            if sessionbytes is not None:
+                items["data"].append(sessionbytes)
+            if batch is not None:
+                items["series"].append(batch)
+        time.sleep(interval)
+    monitor.connection.close()
+    return poll_times, parse_times, items
+
+
+def consume(queue: multiprocessing.Queue, count: int):
+    for _ in range(count):
+        queue.get()
+
+
+def queue_throughput(items: List[Any], repeat: int) -> float:
+    # Items per second through a multiprocessing.Queue to another process
+    items = items * repeat
+    if not items:
+        return 0.
+    queue = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=consume, args=(queue, len(items)))
+    consumer.start()
+    started = time.perf_counter()
+    for item in items:
+        queue.put(item)
+    consumer.join()
+    return len(items) / (time.perf_counter() - started)
+
+
+def writer_throughput(writer, items: List[Any], batch_size: int) -> float:
+    # Rows per second written the way OVPNBatchWriter.run writes them
+    rows = [row for item in items for row in writer.rows(item)]
+    if not rows:
+        return 0.
+    engine = create_engine(writer.connection_string)
+    query = writer.insert_query()
+    started = time.perf_counter()
+    for idx in range(0, len(rows), batch_size):
+        with Session(engine) as session:
+            writer.write(session, query, rows[idx:idx + batch_size])
+            session.commit()
+    return len(rows) / (time.perf_counter() - started)
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> bool:
+    ok = True
+    for name, lower_is_better in RESULTS.items():
+        if not baseline.get(name) or not results.get(name):
+            continue
+        ratio = results[name] / baseline[name]
+        worse = ratio > 1 + tolerance if lower_is_better else ratio < 1 - tolerance
+        print(
+            f"  {name:<28} {baseline[name]:>12.2f} -> {results[name]:>12.2f} "
+            f"({(ratio - 1) * 100:+.0f}%){'  REGRESSION' if worse else ''}"
+        )
+        ok = ok and not worse
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="fraction of sessions replaced every second")
+    parser.add_argument("--rate", type=float, default=10000.)
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="seconds between polls, lets the sessions churn")
+    parser.add_argument("--queue-repeat", type=int, default=5,
+                        help="times the collected items are sent through the queues")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--connection-string", default=None,
+                        help="MySQL database to write to, a temporary SQLite file if empty")
+    parser.add_argument("--save", default=None, help="write the results to a JSON file")
+    parser.add_argument("--baseline", default=None, help="compare with saved results")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    args = parser.parse_args()
+
+    simulator, port = spawn(args.clients, None, args.churn, args.rate)
+    print(f"Polling {args.clients} clients, churn {args.churn}/s", flush=True)
+    poll_times, parse_times, items = poll(port, args.polls, args.interval)
+    simulator.terminate()
+    results = {
+        "poll_p50_ms": percentile(poll_times, 0.5) * 1000,
+        "poll_p95_ms": percentile(poll_times, 0.95) * 1000,
+        "parse_p50_ms": percentile(parse_times, 0.5) * 1000,
+        "parse_p95_ms": percentile(parse_times, 0.95) * 1000,
+    }
+
+    print("Queues", flush=True)
+    for name in ("data", "sessions"):
+        results[f"queue_{name}_items_per_s"] = queue_throughput(items[name], args.queue_repeat)
+
+    print("Writers", flush=True)
+    with tempfile.TemporaryDirectory() as directory:
+        connection_string = args.connection_string
+        data_writer = OVPNDataWriter
+        if not connection_string:
+            connection_string = f"sqlite:///{os.path.join(directory, 'load.db')}"
+            create_sqlite_tables(connection_string)
+            data_writer = SQLiteDataWriter
+        else:
+            migrate(connection_string, DATA_TABLE, SESSIONS_TABLE)
+        writers = {
+            "data": data_writer(None, connection_string, DATA_TABLE),
+            "sessions": OVPNSessionsWriter(None, connection_string, SESSIONS_TABLE),
+            "series": OVPNSessionSeriesWriter(
+                None, connection_string, series_table(SESSIONS_TABLE)
+            ),
+        }
+        for name, writer in writers.items():
+            results[f"writer_{name}_rows_per_s"] = writer_throughput(
+                writer, items[name], args.batch_size
+            )
+
+    print(
+        f"  {len(items['data'])} data items, {len(items['sessions'])} closed sessions, "
+        f"{sum(len(batch.values) for batch in items['series']) // (FIELDS + 1)} series rows"
+    )
+    for name, value in results.items():
+        print(f"  {name:<28} {value:>12.2f}")
+
+    if args.save:
+        with open(args.save, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        print(f"Compared with {args.baseline}, tolerance {args.tolerance:.0%}")
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Size and CPU cost of the records sent through multiprocessing.Queue every interval.
+# Compares the previous dataclass / dict of dicts format with the slotted columnar one.
+#
+#   PYTHONPATH=. python benchmarks/queue_transport.py [users]
+import dataclasses
+import pickle
+import sys
+import timeit
+import tracemalloc
+from typing import Dict, Optional
+
+from openvpn_monitor.columns import RECEIVED, SENT
+from openvpn_monitor.const import ALL
+from openvpn_monitor.monitoring.data import SessionBytes, SessionData
+
+
+@dataclasses.dataclass
+class LegacySessionData:
+    host: str
+    user: str
+    ip: str
+    internal_ip: str
+    sent: int
+    received: int
+    connected_at_str: str
+    connected_at: int
+    closed_at: Optional[int] = None
+
+
+@dataclasses.dataclass
+class LegacySessionBytes:
+    host: str
+    timestamp_start: int
+    timestamp_end: int
+    data: Dict[str, Dict[str, int]]
+
+
+def totals(users: int) -> Dict[str, list]:
+    result = {f"user{idx:05d}": [idx * 1000, idx * 10000] for idx in range(users)}
+    result[ALL] = [sum(v[0] for v in result.values()), sum(v[1] for v in result.values())]
+    return result
+
+
+def sessions(cls, users: int):
+    return [
+        cls(
+            host="gw0",
+            user=f"user{idx:05d}",
+            ip=f"198.51.100.{idx % 256}:{10000 + idx}",
+            internal_ip=f"10.8.{idx // 256 % 256}.{idx % 256}",
+            sent=idx * 1000,
+            received=idx * 10000,
+            connected_at_str="2024-01-01 00:00:00",
+            connected_at=1704067200 + idx,
+            closed_at=1704070800 + idx,
+        )
+        for idx in range(users)
+    ]
+
+
+def measure(name: str, obj, number: int = 20):
+    protocol = pickle.HIGHEST_PROTOCOL
+    payload = pickle.dumps(obj, protocol)
+    dumps = timeit.timeit(lambda: pickle.dumps(obj, protocol), number=number) / number
+    loads = timeit.timeit(lambda: pickle.loads(payload), number=number) / number
+    print(
+        f"{name:<34} {len(payload) / 1024:>10.1f} KiB "
+        f"{dumps * 1000:>9.3f} ms {loads * 1000:>9.3f} ms"
+    )
+
+
+def allocated(factory) -> int:
+    tracemalloc.start()
+    obj = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = totals(users)
+    print(f"{users} users, pickle protocol {pickle.HIGHEST_PROTOCOL}")
+    print(f"{'record':<34} {'size':>14} {'dumps':>12} {'loads':>12}")
+
+    measure(
+        "SessionBytes, dict of dicts",
+        LegacySessionBytes(
+            host="gw0",
+            timestamp_start=0,
+            timestamp_end=60,
+            data={user: {SENT: v[0], RECEIVED: v[1]} for user, v in data.items()},
+        ),
+    )
+    measure("SessionBytes, columnar", SessionBytes.from_totals("gw0", 0, 60, data))
+
+    # Closed sessions are put one by one
+    measure("SessionData x1, dataclass", sessions(LegacySessionData, 1)[0], number=10000)
+    measure("SessionData x1, slotted", sessions(SessionData, 1)[0], number=10000)
+    measure(f"SessionData x{users}, dataclass", sessions(LegacySessionData, users))
+    measure(f"SessionData x{users}, slotted", sessions(SessionData, users))
+
+    print()
+    print("Memory of one status snapshot (collectors keep two per host)")
+    for name, cls in (("dataclass", LegacySessionData), ("slotted", SessionData)):
+        size = allocated(lambda: sessions(cls, users))
+        print(f"SessionData x{users}, {name:<20} {size / 1024 / 1024:>8.2f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# Fake OpenVPN management interface for benchmarks and manual testing.
+# Simulates `clients` sessions with random traffic rates, a `churn` fraction of them is
+# replaced by new sessions every second. Supports `status [1|2|3]`, `bytecount N` with
+# >BYTECOUNT_CLI notifications, >CLIENT:ESTABLISHED/DISCONNECT notifications and `quit`.
+#
+#   PYTHONPATH=. python benchmarks/simulator.py --clients 1000 --port 7505
+import argparse
+import datetime
+import multiprocessing
+import random
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class Client:
+    __slots__ = (
+        "cid", "user", "ip", "internal_ip", "connected_at", "rate_received", "rate_sent"
+    )
+
+    def __init__(self, cid: int, user: str, connected_at: float, rng: random.Random,
+                 rate: float):
+        self.cid = cid
+        self.user = user
+        self.ip = f"198.51.{cid // 256 % 256}.{cid % 256}:{1024 + cid % 60000}"
+        self.internal_ip = f"10.{cid // 65536 % 256}.{cid // 256 % 256}.{cid % 256}"
+        self.connected_at = connected_at
+        # Bytes per second received and sent by the server
+        self.rate_received = rng.expovariate(1 / rate)
+        self.rate_sent = rng.expovariate(1 / rate) * 10
+
+    def counters(self, now: float):
+        elapsed = max(now - self.connected_at, 0)
+        return int(self.rate_received * elapsed), int(self.rate_sent * elapsed)
+
+
+def render_status(clients: List[Client], version: int = 2, now: Optional[float] = None) -> bytes:
+    now = time.time() if now is None else now
+    stamp = datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+    if version == 1:
+        lines = [
+            "OpenVPN CLIENT LIST",
+            f"Updated,{stamp}",
+            "Common Name,Real Address,Bytes Received,Bytes Sent,Connected Since",
+        ]
+        for client in clients:
+            received, sent = client.counters(now)
+            since = datetime.datetime.fromtimestamp(client.connected_at)
+            lines.append(
+                f"{client.user},{client.ip},{received},{sent},{since:%Y-%m-%d %H:%M:%S}"
+            )
+        lines += ["ROUTING TABLE", "GLOBAL STATS", "END"]
+        return ("\r\n".join(lines) + "\r\n").encode()
+
+    sep = "\t" if version == 3 else ","
+    lines = [
+        sep.join(["TITLE", "OpenVPN 2.6.8 x86_64-pc-linux-gnu (simulator)"]),
+        sep.join(["TIME", stamp, str(int(now))]),
+        sep.join([
+            "HEADER", "CLIENT_LIST", "Common Name", "Real Address", "Virtual Address",
+            "Virtual IPv6 Address", "Bytes Received", "Bytes Sent", "Connected Since",
+            "Connected Since (time_t)", "Username", "Client ID", "Peer ID",
+            "Data Channel Cipher",
+        ]),
+    ]
+    for client in clients:
+        received, sent = client.counters(now)
+        since = datetime.datetime.fromtimestamp(int(client.connected_at))
+        lines.append(sep.join([
+            "CLIENT_LIST", client.user, client.ip, client.internal_ip, "", str(received),
+            str(sent), f"{since:%Y-%m-%d %H:%M:%S}", str(int(client.connected_at)),
+            "UNDEF", str(client.cid), str(client.cid), "AES-256-GCM",
+        ]))
+    lines.append(sep.join([
+        "HEADER", "ROUTING_TABLE", "Virtual Address", "Common Name", "Real Address",
+        "Last Ref", "Last Ref (time_t)",
+    ]))
+    for client in clients:
+        lines.append(sep.join([
+            "ROUTING_TABLE", client.internal_ip, client.user, client.ip, stamp, str(int(now)),
+        ]))
+    lines += [sep.join(["GLOBAL_STATS", "Max bcast/mcast queue length", "0"]), "END"]
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+class Simulation:
+    def __init__(
+        self,
+        clients: int = 100,
+        users: Optional[int] = None,
+        churn: float = 0.,
+        rate: float = 10000.,
+        seed: int = 0,
+    ):
+        self.rng = random.Random(seed)
+        self.users = users or clients
+        self.churn = churn
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_cid = 0
+        self.clients: Dict[int, Client] = {}
+        # Connection handlers subscribed to >CLIENT notifications
+        self.listeners: List["ManagementHandler"] = []
+        now = time.time()
+        for _ in range(clients):
+            # Sessions connected during the last hour
+            self.connect(now - self.rng.uniform(0, 3600))
+
+    def connect(self, connected_at: float) -> Client:
+        user = f"user{self.rng.randrange(self.users):06d}"
+        client = Client(self.next_cid, user, connected_at, self.rng, self.rate)
+        self.clients[client.cid] = client
+        self.next_cid += 1
+        return client
+
+    def tick(self, now: float):
+        # Replaces churn * clients sessions, fractions accumulate over ticks
+        with self.lock:
+            replace = int(len(self.clients) * self.churn + self.rng.random())
+            for cid in self.rng.sample(list(self.clients), min(replace, len(self.clients))):
+                client = self.clients.pop(cid)
+                new = self.connect(now)
+                for listener in list(self.listeners):
+                    listener.notify_client("DISCONNECT", client, now)
+                    listener.notify_client("ESTABLISHED", new, now)
+
+    def snapshot(self) -> List[Client]:
+        with self.lock:
+            return list(self.clients.values())
+
+    def run(self):
+        while True:
+            time.sleep(1)
+            self.tick(time.time())
+
+
+class ManagementHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.bytecount = 0
+        self.connected = True
+
+    def send(self, data: bytes):
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+
+    def notify_client(self, kind: str, client: Client, now: float):
+        received, sent = client.counters(now)
+        ip, port = client.ip.rsplit(":", 1)
+        env = {
+            "common_name": client.user,
+            "trusted_ip": ip,
+            "trusted_port": port,
+            "ifconfig_pool_remote_ip": client.internal_ip,
+            "time_unix": str(int(client.connected_at)),
+            "bytes_received": str(received),
+            "bytes_sent": str(sent),
+        }
+        lines = [f">CLIENT:{kind},{client.cid}"]
+        lines += [f">CLIENT:ENV,{key}={value}" for key, value in env.items()]
+        lines.append(">CLIENT:ENV,END")
+        self.send(("\r\n".join(lines) + "\r\n").encode())
+
+    def bytecount_loop(self):
+        simulation = self.server.simulation
+        while self.connected and self.bytecount:
+            time.sleep(self.bytecount)
+            now = time.time()
+            lines = []
+            for client in simulation.snapshot():
+                received, sent = client.counters(now)
+                lines.append(f">BYTECOUNT_CLI:{client.cid},{received},{sent}")
+            if lines:
+                self.send(("\r\n".join(lines) + "\r\n").encode())
+
+    def handle(self):
+        simulation = self.server.simulation
+        self.send(b">INFO:OpenVPN Management Interface Version 5 -- type 'help' for more info\r\n")
+        with simulation.lock:
+            simulation.listeners.append(self)
+        try:
+            self.serve()
+        except OSError:
+            pass
+        finally:
+            self.connected = False
+            with simulation.lock:
+                simulation.listeners.remove(self)
+
+    def serve(self):
+        simulation = self.server.simulation
+        for line in self.rfile:
+            command = line.decode().strip().split()
+            if not command:
+                continue
+            if command[0] == "status":
+                version = int(command[1]) if len(command) > 1 else 1
+                self.send(render_status(simulation.snapshot(), version))
+            elif command[0] == "bytecount" and len(command) > 1:
+                running = self.bytecount > 0
+                self.bytecount = int(command[1])
+                self.send(b"SUCCESS: bytecount interval changed\r\n")
+                if self.bytecount and not running:
+                    threading.Thread(target=self.bytecount_loop, daemon=True).start()
+            elif command[0] == "quit":
+                break
+            else:
+                self.send(b"ERROR: unknown command, enter 'help' for more options\r\n")
+
+
+class ManagementServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, simulation: Simulation, host: str = "127.0.0.1", port: int = 0):
+        self.simulation = simulation
+        super().__init__((host, port), ManagementHandler)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "ManagementServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        if self.simulation.churn:
+            threading.Thread(target=self.simulation.run, daemon=True).start()
+        return self
+
+
+def serve(pipe, *args):
+    server = ManagementServer(Simulation(*args)).start()
+    pipe.send(server.port)
+    while True:
+        time.sleep(3600)
+
+
+def spawn(*args) -> Tuple[multiprocessing.Process, int]:
+    # Runs the simulation in a separate process, so it does not compete for the GIL
+    # with the code being measured. Takes the arguments of Simulation, returns the
+    # process and the port.
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child, *args), daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7505)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--users", type=int, default=None)
+    parser.add_argument("--churn", type=float, default=0.001,
+                        help="fraction of sessions replaced every second")
+    parser.add_argument("--rate", type=float, default=10000.,
+                        help="mean bytes per second received by the server per session")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    simulation = Simulation(args.clients, args.users, args.churn, args.rate, args.seed)
+    server = ManagementServer(simulation, args.host, args.port).start()
+    print(f"Simulating {args.clients} clients on {args.host}:{server.port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Cold start of the entry points: import time and resident memory of a fresh
+# interpreter after importing every role, and the heavy packages it pulled in.
+# Forked collectors and writers inherit the memory and the modules of the process
+# they are forked from.
+#
+#   PYTHONPATH=. python benchmarks/startup.py [--repeat 5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROLES = {
+    # run.py itself, before any worker is started
+    "entry": "openvpn_monitor.run",
+    # monitor process, parent of the collectors and writers
+    "collector": "openvpn_monitor.monitoring.monitor",
+    # single collector process with the spawn start method
+    "collector-only": "openvpn_monitor.monitoring.openvpn",
+    "dashboard": "openvpn_monitor.dashboard.wsgi",
+}
+HEAVY = ["sqlalchemy", "pandas", "numpy", "plotly", "dash", "flask", "gunicorn"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+with open("/proc/self/status") as fd:
+    rss = next(int(line.split()[1]) for line in fd if line.startswith("VmRSS:"))
+print(json.dumps({{
+    "seconds": elapsed,
+    "rss": rss * 1024,
+    "modules": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def probe(module: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("CONNECTION_STRING", "sqlite://")
+    env.setdefault("METRICS_DIR", "")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+        env=env, check=True, stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'role':<16}{'import, ms':>12}{'RSS, MiB':>10}  heavy modules")
+    for role, module in ROLES.items():
+        # The first run warms up the bytecode and the page cache
+        probe(module)
+        results = [probe(module) for _ in range(args.repeat)]
+        seconds = statistics.median(result["seconds"] for result in results)
+        rss = statistics.median(result["rss"] for result in results)
+        print(f"{role:<16}{seconds * 1000:>12.0f}{rss / 1024 / 1024:>10.1f}  "
+              f"{', '.join(results[0]['modules']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
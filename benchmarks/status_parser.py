@@ -0,0 +1,75 @@
+# Parsing cost of the management interface status for large gateways.
+# The response is fed in 64 KiB chunks, as it arrives from the socket.
+#
+#   PYTHONPATH=. python benchmarks/status_parser.py [clients]
+import sys
+import timeit
+
+from openvpn_monitor.monitoring.data import SessionData
+from openvpn_monitor.monitoring.status import StatusParser
+from simulator import Simulation, render_status
+
+CHUNK = 65536
+
+
+def payload(clients: int, version: int = 2) -> bytes:
+    return render_status(Simulation(clients).snapshot(), version)
+
+
+def chunks(data: bytes):
+    return [data[idx:idx + CHUNK] for idx in range(0, len(data), CHUNK)]
+
+
+def legacy(host_alias: str, parts) -> dict:
+    # Previous implementation: bytes concatenation, full decode, splitlines, positional
+    # fields and string session ids
+    result = b""
+    for chunk in parts:
+        result += chunk
+    status = [s for s in result.decode("utf-8").splitlines() if s.startswith("CLIENT_LIST")]
+    stats = {}
+    for line in status:
+        _, user, ip, internal_ip, _, sent, received, connected_at_str, connected_at = (
+            line.split(",")[:9]
+        )
+        stats[user + ip + internal_ip + connected_at_str] = SessionData(
+            host=host_alias,
+            user=user,
+            ip=ip,
+            internal_ip=internal_ip,
+            sent=int(sent),
+            received=int(received),
+            connected_at_str=connected_at_str,
+            connected_at=int(connected_at),
+            closed_at=None,
+        )
+    return stats
+
+
+def streaming(host_alias: str, parts) -> dict:
+    parser = StatusParser(host_alias)
+    for chunk in parts:
+        parser.feed(chunk)
+    return parser.sessions
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for version in (2, 3):
+        data = payload(clients, version)
+        parts = chunks(data)
+        print(f"status {version}: {clients} clients, {len(data) / 1024:.0f} KiB")
+        runs = [("streaming parser", streaming)]
+        if version == 2:
+            runs.insert(0, ("legacy", legacy))
+        for name, func in runs:
+            assert len(func("gw0", parts)) == clients
+            number = 5
+            elapsed = min(
+                timeit.repeat(lambda: func("gw0", parts), number=number, repeat=5)
+            ) / number
+            print(f"  {name:<20} {elapsed * 1000:>8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
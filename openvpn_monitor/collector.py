@@ -0,0 +1,6 @@
+from openvpn_monitor.run import COLLECTOR, main
+
+# Collector node: polls the management interfaces and writes to the database, runs
+# without the dashboard dependencies (requirements-collector.txt)
+if __name__ == "__main__":
+    main(COLLECTOR)
@@ -9,3 +9,5 @@ CONNECTED_AT = "connected_at"
 CLOSED_AT = "closed_at"
 TIMESTAMP_START = "timestamp_start"
 TIMESTAMP_END = "timestamp_end"
+RECEIVED_PEAK = "received_peak"
+SENT_PEAK = "sent_peak"
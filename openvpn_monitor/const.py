@@ -20,5 +20,31 @@ TIMEDELTAS = {
     INF: None,
 }
 
+# Bucket sizes in seconds for the speed graphs, all are multiples of the 1m rollup
+GRAPH_BUCKETS = [
+    60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 30 * 60,
+    60 * 60, 2 * 60 * 60, 3 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+    24 * 60 * 60, 2 * 24 * 60 * 60, 7 * 24 * 60 * 60,
+]
+
 DATA_SIZES = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
 DATA_SPEEDS = ["B/s", "KiB/s", "MiB/s", "GiB/s", "TiB/s", "PiB/s"]
+
+RAW = "raw"
+SESSIONS = "sessions"
+SESSION_SERIES = "session_series"
+# Rollup name -> bucket size in seconds
+ROLLUPS = {
+    "1m": 60,
+    "1h": 60 * 60,
+    "1d": 24 * 60 * 60,
+}
+
+# Collectors publish the current sessions there for the dashboard, empty disables it
+LIVE_DIR = "/dev/shm/openvpn-monitor"
+# Every process dumps its metrics there, the dashboard serves them at /metrics
+METRICS_DIR = "/dev/shm/openvpn-monitor/metrics"
+# Writers keep rows there until they are in the database, empty keeps them in memory
+SPOOL_DIR = "/var/spool/openvpn-monitor"
+# Collectors save the last state of every host there for restarts, empty disables it
+CHECKPOINT_DIR = "/var/spool/openvpn-monitor/checkpoints"
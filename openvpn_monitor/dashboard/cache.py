@@ -0,0 +1,104 @@
+import collections
+import datetime
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Tuple
+
+import pandas as pd
+
+
+class QueryCache:
+    # LRU cache with TTL. Concurrent requests for the same key wait for the one
+    # that is already running the query instead of issuing their own.
+    def __init__(self, ttl: float = 30., maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: "collections.OrderedDict[Hashable, Tuple[float, Any]]" = (
+            collections.OrderedDict()
+        )
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[key] = future
+                self.misses += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = func()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            del self.inflight[key]
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CachedReader:
+    # Wraps a reader, rounding datetime arguments down to `bucket` seconds, so
+    # callbacks that ask for "now - period" on the same tick share one query.
+    def __init__(self, reader, cache: QueryCache, bucket: int = 60):
+        self.reader = reader
+        self.cache = cache
+        self.bucket = bucket
+
+    def normalize(self, value):
+        if isinstance(value, datetime.datetime):
+            timestamp = value.timestamp()
+            return datetime.datetime.fromtimestamp(timestamp - timestamp % self.bucket)
+        return value
+
+    def call(self, name: str, func: Callable, args, kwargs):
+        args = tuple(self.normalize(arg) for arg in args)
+        kwargs = {key: self.normalize(value) for key, value in kwargs.items()}
+        key = (
+            type(self.reader).__name__,
+            self.reader.table,
+            name,
+            args,
+            tuple(sorted(kwargs.items())),
+        )
+        result = self.cache.get(key, lambda: func(*args, **kwargs))
+        if isinstance(result, (pd.DataFrame, list)):
+            return result.copy()
+        return result
+
+    def __call__(self, *args, **kwargs):
+        return self.call("__call__", self.reader, args, kwargs)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.reader, name)
+        if not callable(attr):
+            return attr
+
+        def cached(*args, **kwargs):
+            return self.call(name, attr, args, kwargs)
+
+        return cached
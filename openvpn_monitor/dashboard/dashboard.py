@@ -1,9 +1,15 @@
 import datetime
+import json
+import math
 import os
+import threading
+import time
 
+import pandas as pd
 import plotly.express as px
-from dash import Dash, html, dcc, dash_table
-from dash.dependencies import Output, Input
+from dash import Dash, html, dcc, dash_table, ctx, no_update
+from dash.dependencies import Output, Input, State
+from flask import Response
 
 from openvpn_monitor.columns import (
     HOST,
@@ -12,25 +18,78 @@ from openvpn_monitor.columns import (
     RECEIVED,
     TIMESTAMP_START,
     TIMESTAMP_END,
+    IP,
+    CONNECTED_AT,
+    RECEIVED_PEAK,
+    SENT_PEAK,
 )
-from openvpn_monitor.const import TIMEDELTAS, ALL, INF
+from openvpn_monitor.const import TIMEDELTAS, ALL, INF, LIVE_DIR, METRICS_DIR
+from openvpn_monitor.dashboard.cache import QueryCache, CachedReader
 from openvpn_monitor.dashboard.functions import (
-    bytes_to_str,
-    speed_to_str,
+    bytes_to_str_series,
+    speed_to_str_series,
     get_sess_data,
+    graph_bucket,
+    timestamps_to_datetime,
+    timestamps_to_str,
 )
 from openvpn_monitor.dashboard.sql import (
     OVPNDataReader,
     OVPNSessionsReader,
     OVPNHostsReader,
+    OVPNSessionSeriesReader,
 )
-from openvpn_monitor.tables import DATA_TABLE, SESSIONS_TABLE
+from openvpn_monitor.live import LiveStateReader, SESSIONS, RATES
+from openvpn_monitor.metrics import Metrics, CALLBACK_SECONDS, render
+from openvpn_monitor.tables import DATA_TABLE, SESSIONS_TABLE, series_table
 
 connection_string = os.environ['CONNECTION_STRING']
 
-datareader = OVPNDataReader(conn_string=connection_string, table=DATA_TABLE)
-sessionreader = OVPNSessionsReader(conn_string=connection_string, table=SESSIONS_TABLE)
-hostsreader = OVPNHostsReader(conn_string=connection_string, table=SESSIONS_TABLE)
+cache = QueryCache(
+    ttl=float(os.environ.get("CACHE_TTL", "30")),
+    maxsize=int(os.environ.get("CACHE_SIZE", "256")),
+)
+
+datareader = CachedReader(
+    OVPNDataReader(conn_string=connection_string, table=DATA_TABLE), cache)
+sessionreader = CachedReader(
+    OVPNSessionsReader(conn_string=connection_string, table=SESSIONS_TABLE), cache)
+hostsreader = CachedReader(
+    OVPNHostsReader(conn_string=connection_string, table=SESSIONS_TABLE), cache)
+seriesreader = CachedReader(
+    OVPNSessionSeriesReader(conn_string=connection_string, table=series_table(SESSIONS_TABLE)),
+    cache,
+)
+
+# Live panels are served from the state published by the collectors while it is fresh,
+# the database is queried only when no collector publishes on this machine
+live_dir = os.environ.get("LIVE_DIR", LIVE_DIR)
+livereader = LiveStateReader(
+    live_dir, max_age=float(os.environ.get("LIVE_MAX_AGE", "180"))
+) if live_dir else None
+
+metrics_dir = os.environ.get("METRICS_DIR", METRICS_DIR)
+# Web server workers share the module, every one dumps to its own file
+metrics = Metrics(metrics_dir, "dashboard", per_process=True)
+
+# Upper bound of bars per user in the speed graphs, GRAPH_PEAKS shows the highest
+# speed over a single poll interval inside every bar instead of the average
+GRAPH_POINTS = int(os.environ.get("GRAPH_POINTS", "300"))
+GRAPH_PEAKS = os.environ.get("GRAPH_PEAKS", "0") == "1"
+# Incremental refresh: graphs are extended with the buckets completed since the last
+# tick instead of being redrawn, the whole figure is rebuilt every INCREMENTAL_RESYNC
+# ticks. Rows are expected in the database INCREMENTAL_LAG seconds after they start.
+# Complete buckets only are appended, so the in-progress one is not drawn: graphs with
+# buckets above INCREMENTAL_MAX_BUCKET seconds are always redrawn up to now instead.
+INCREMENTAL = os.environ.get("DASHBOARD_INCREMENTAL", "1") == "1"
+INCREMENTAL_LAG = int(os.environ.get("DASHBOARD_INCREMENTAL_LAG", "120"))
+INCREMENTAL_RESYNC = int(os.environ.get("DASHBOARD_INCREMENTAL_RESYNC", "60"))
+INCREMENTAL_MAX_BUCKET = int(os.environ.get("DASHBOARD_INCREMENTAL_MAX_BUCKET", "300"))
+# Seconds between refreshes of the page
+TIMER_INTERVAL = 60
+
+month_traffic_state = {}
+month_traffic_lock = threading.Lock()
 
 app = Dash(__name__, title="OpenVPN Monitor")
 
@@ -45,16 +104,34 @@ SPEED_FOR_TIME_PERIOD_TABLE = "speed_for_time_period_table"
 CLOSED_SESSIONS_TABLE = "closed_sessions_table"
 RECEIVED_GRAPH = "received_graph"
 SENT_GRAPH = "sent_graph"
+GRAPH_STATE = "graph_state"
+SESSION_SELECTOR = "session_selector"
+SESSION_GRAPH = "session_graph"
 
-TIME_DIFF = "time_diff"
 COLOR_ID = USER + ' ' + HOST
 
+
+@app.server.route("/metrics")
+def metrics_endpoint():
+    # Metrics of the collectors and writers are dumped by their processes
+    metrics.dump()
+    return Response(
+        render(metrics_dir) if metrics_dir else "",
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def timed(func):
+    return metrics.timed(CALLBACK_SECONDS, callback=func.__name__)(func)
+
+
 app.layout = html.Div(
     children=[
         dcc.Interval(
             id=TIMER,
-            interval=60 * 1000  # ms
+            interval=TIMER_INTERVAL * 1000  # ms
         ),
+        dcc.Store(id=GRAPH_STATE),
 
         html.H3(children='OpenVPN monitoring'),
         html.Br(),
@@ -141,6 +218,13 @@ app.layout = html.Div(
         dash_table.DataTable(id=CLOSED_SESSIONS_TABLE),
         html.Br(),
 
+        html.H4(children="Session speed"),
+        dcc.Dropdown(
+            id=SESSION_SELECTOR,
+            placeholder="Select session",
+        ),
+        dcc.Graph(id=SESSION_GRAPH),
+
         html.H4(children="Received speed"),
         dcc.Graph(id=RECEIVED_GRAPH),
 
@@ -155,6 +239,7 @@ app.layout = html.Div(
     Input(TIME_PERIOD_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def all_hosts_update(timedelta_str, _):
     timedelta = TIMEDELTAS[timedelta_str]
     return [ALL] + hostsreader(timedelta=timedelta)
@@ -164,6 +249,7 @@ def all_hosts_update(timedelta_str, _):
     Output(TIME_UPDATED, "children"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def time_update(_):
     return f"""Last update: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}"""
 
@@ -173,50 +259,104 @@ def time_update(_):
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def active_users_table(host, _):
     if host == ALL:
         host = None
-    data = datareader(
+    if livereader is not None:
+        users = live_users(host)
+        if users is not None:
+            return users.to_dict("records")
+    users = datareader.active_users(
         host=host,
         connected_at_min=datetime.datetime.now() - datetime.timedelta(minutes=5)
     )
-    users = data[[USER, HOST]].drop_duplicates()
     users = users[users[USER] != ALL].reset_index(drop=True)
 
     return users.to_dict("records")
 
 
+def live_users(host):
+    states = livereader.read()
+    if host is not None:
+        states = {host: states[host]} if host in states else {}
+    if not states:
+        return None
+    rows = []
+    for state in states.values():
+        users = sorted({sess[USER] for sess in state[SESSIONS]})
+        for user in users:
+            rate = state[RATES].get(user, {SENT: 0, RECEIVED: 0})
+            rows.append((user, state[HOST], rate[RECEIVED], rate[SENT]))
+    users = pd.DataFrame(rows, columns=[USER, HOST, RECEIVED, SENT])
+    users[RECEIVED] = speed_to_str_series(users[RECEIVED])
+    users[SENT] = speed_to_str_series(users[SENT])
+    return users
+
+
+def add_traffic(*frames):
+    return (
+        pd.concat(frames)
+        .groupby([HOST, USER], as_index=False)[[RECEIVED, SENT]]
+        .sum()
+    )
+
+
+def month_traffic(host, start_date):
+    # Traffic before the hour-aligned watermark is kept per (host, month) and only
+    # extended with the hours completed since the last call. Rows after the
+    # watermark are read on every call. Rows written late for the kept range, e.g.
+    # replayed from the spool after a database outage, are counted when the whole
+    # range is read again every INCREMENTAL_RESYNC ticks.
+    now = time.time()
+    watermark = datetime.datetime.fromtimestamp((now - INCREMENTAL_LAG) // 3600 * 3600)
+    watermark = max(watermark, start_date)
+    key = (host, start_date)
+    with month_traffic_lock:
+        state = month_traffic_state.get(key)
+
+    if state is None or now >= state[2]:
+        base = datareader.traffic(
+            host=host, connected_at_min=start_date, connected_at_max=watermark, exact=True)
+        resync_at = now + INCREMENTAL_RESYNC * TIMER_INTERVAL
+    elif state[0] < watermark:
+        base = add_traffic(
+            state[1],
+            datareader.traffic(
+                host=host, connected_at_min=state[0], connected_at_max=watermark, exact=True),
+        )
+        resync_at = state[2]
+    else:
+        watermark, base, resync_at = state
+
+    with month_traffic_lock:
+        for other in [other for other in month_traffic_state if other[1] != start_date]:
+            del month_traffic_state[other]
+        month_traffic_state[key] = (watermark, base, resync_at)
+
+    return add_traffic(base, datareader.traffic(host=host, connected_at_min=watermark))
+
+
 @app.callback(
     Output(TRAFFIC_SINCE_MONTH_START_TABLE, "data"),
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def traffic_since_month_start_table(host, _):
     if host == ALL:
         host = None
     curr_date = datetime.datetime.now()
     start_date = datetime.datetime(
         year=curr_date.year, month=curr_date.month, day=1, hour=0, minute=0, second=0)
-    data = datareader(host=host, connected_at_min=start_date)
-
-    users = (
-        data[[HOST, USER]]
-        .drop_duplicates()
-        .reset_index(drop=True)
-        .sort_values('user')
-    )
-
-    received = data.groupby([HOST, USER])[RECEIVED].sum().reset_index()
-    sent = data.groupby([HOST, USER])[SENT].sum().reset_index()
-
-    users = (
-        users
-        .merge(received, how="left", on=[HOST, USER])
-        .merge(sent, how="left", on=[HOST, USER])
-    )
+    if INCREMENTAL:
+        users = month_traffic(host, start_date)
+    else:
+        users = datareader.traffic(host=host, connected_at_min=start_date)
+    users = users.sort_values(USER).reset_index(drop=True)
 
-    users[RECEIVED] = users[RECEIVED].map(bytes_to_str)
-    users[SENT] = users[SENT].map(bytes_to_str)
+    users[RECEIVED] = bytes_to_str_series(users[RECEIVED])
+    users[SENT] = bytes_to_str_series(users[SENT])
 
     return users.to_dict("records")
 
@@ -227,6 +367,7 @@ def traffic_since_month_start_table(host, _):
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def traffic_for_time_period_table(timedelta_str, host, _):
     if host == ALL:
         host = None
@@ -237,26 +378,14 @@ def traffic_for_time_period_table(timedelta_str, host, _):
         start_date = curr_date - TIMEDELTAS[timedelta_str]
     else:
         start_date = None
-    data = datareader(connected_at_min=start_date, host=host)
-
     users = (
-        data[[HOST, USER]]
-        .drop_duplicates()
-        .reset_index(drop=True)
+        datareader.traffic(host=host, connected_at_min=start_date)
         .sort_values(USER)
+        .reset_index(drop=True)
     )
 
-    received = data.groupby([HOST, USER])[RECEIVED].sum().reset_index()
-    sent = data.groupby([HOST, USER])[SENT].sum().reset_index()
-
-    received[RECEIVED] = received[RECEIVED].map(bytes_to_str)
-    sent[SENT] = sent[SENT].map(bytes_to_str)
-
-    users = (
-        users
-        .merge(received, how="left", on=[HOST, USER])
-        .merge(sent, how="left", on=[HOST, USER])
-    )
+    users[RECEIVED] = bytes_to_str_series(users[RECEIVED])
+    users[SENT] = bytes_to_str_series(users[SENT])
 
     return users.to_dict("records")
 
@@ -267,6 +396,7 @@ def traffic_for_time_period_table(timedelta_str, host, _):
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def speed_for_time_period_table(timedelta_str, host, _):
     if host == ALL:
         host = None
@@ -278,34 +408,22 @@ def speed_for_time_period_table(timedelta_str, host, _):
     else:
         start_date = None
 
-    data = datareader(connected_at_min=start_date, host=host)
-
     users = (
-        data[[HOST, USER]]
-        .drop_duplicates()
-        .reset_index(drop=True)
+        datareader.traffic(host=host, connected_at_min=start_date)
         .sort_values([HOST, USER])
+        .reset_index(drop=True)
     )
 
-    received = data.groupby([HOST, USER])[RECEIVED].sum().reset_index()
-    sent = data.groupby([HOST, USER])[SENT].sum().reset_index()
-
     if timedelta is not None:
         seconds = timedelta.total_seconds()
     else:
-        seconds = datetime.datetime.now().timestamp() - data[TIMESTAMP_START].min()
-
-    received[RECEIVED] = received[RECEIVED] / seconds
-    sent[SENT] = sent[SENT] / seconds
+        first_timestamp = datareader.first_timestamp(host=host)
+        if first_timestamp is None:
+            first_timestamp = datetime.datetime.now().timestamp()
+        seconds = datetime.datetime.now().timestamp() - first_timestamp
 
-    received[RECEIVED] = received[RECEIVED].map(speed_to_str)
-    sent[SENT] = sent[SENT].map(speed_to_str)
-
-    users = (
-        users
-        .merge(received, how="left", on=[HOST, USER])
-        .merge(sent, how="left", on=[HOST, USER])
-    )
+    users[RECEIVED] = speed_to_str_series(users[RECEIVED] / seconds)
+    users[SENT] = speed_to_str_series(users[SENT] / seconds)
 
     return users.to_dict("records")
 
@@ -315,6 +433,7 @@ def speed_for_time_period_table(timedelta_str, host, _):
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
+@timed
 def closed_sessions_table(host, _):
     if host == ALL:
         host = None
@@ -325,62 +444,167 @@ def closed_sessions_table(host, _):
 
 
 @app.callback(
-    Output(RECEIVED_GRAPH, "figure"),
+    Output(SESSION_SELECTOR, "options"),
     Input(TIME_PERIOD_SELECTOR, "value"),
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
 )
-def received_graph(timedelta_str, host, _):
+@timed
+def session_options(timedelta_str, host, _):
     if host == ALL:
         host = None
+    timedelta = TIMEDELTAS[timedelta_str]
+    sessions = seriesreader.sessions(
+        host=host,
+        connected_at_min=datetime.datetime.now() - timedelta if timedelta is not None else None,
+    )
+    connected_at = timestamps_to_str(sessions[CONNECTED_AT])
+    return [
+        {
+            "label": f"{row[USER]} @ {row[HOST]}, {row[IP]}, connected at {connected_at[idx]}",
+            "value": json.dumps([row[HOST], row[USER], row[IP], int(row[CONNECTED_AT])]),
+        }
+        for idx, row in sessions.iterrows()
+    ]
+
 
+@app.callback(
+    Output(SESSION_GRAPH, "figure"),
+    Input(SESSION_SELECTOR, "value"),
+    Input(TIMER, "n_intervals"),
+)
+@timed
+def session_graph(session, _):
+    if not session:
+        return {}
+    host, user, ip, connected_at = json.loads(session)
+    data = seriesreader(host=host, user=user, ip=ip, connected_at=connected_at)
+    duration = data[TIMESTAMP_END] - data[TIMESTAMP_START]
+    data[RECEIVED] = data[RECEIVED] / duration
+    data[SENT] = data[SENT] / duration
+    data[TIMESTAMP_START] = timestamps_to_datetime(data[TIMESTAMP_START])
+    return px.line(data, x=TIMESTAMP_START, y=[RECEIVED, SENT], markers=True)
+
+
+def graph_window(timedelta_str, host):
     curr_date = datetime.datetime.now()
     timedelta = TIMEDELTAS[timedelta_str]
     if timedelta is not None:
         start_date = curr_date - TIMEDELTAS[timedelta_str]
+        period = timedelta.total_seconds()
     else:
         start_date = None
+        first_timestamp = datareader.first_timestamp(host=host)
+        if first_timestamp is None:
+            first_timestamp = curr_date.timestamp()
+        period = curr_date.timestamp() - first_timestamp
 
-    data = datareader(connected_at_min=start_date, host=host)
-    data = data[data[USER] != ALL]
-    data[TIME_DIFF] = data[TIMESTAMP_END] - data[TIMESTAMP_START]
-    data[RECEIVED] = data[RECEIVED] / data[TIME_DIFF]
-    data[SENT] = data[SENT] / data[TIME_DIFF]
-    data[COLOR_ID] = data[USER] + ' ' + data[HOST]
-    data[TIMESTAMP_START] = data[TIMESTAMP_START].apply(
-        lambda d: datetime.datetime.fromtimestamp(d)
-    )
+    return start_date, period, graph_bucket(period, GRAPH_POINTS)
 
-    graph = px.bar(data, x=TIMESTAMP_START, y=RECEIVED, color=COLOR_ID)
-    return graph
+
+def speed_data(bucket, host, start_date, end_date=None):
+    data = datareader.buckets(
+        bucket,
+        connected_at_min=start_date,
+        connected_at_max=end_date,
+        host=host,
+        peaks=GRAPH_PEAKS,
+    )
+    data = data[data[USER] != ALL].copy()
+    if GRAPH_PEAKS:
+        data[RECEIVED] = data[RECEIVED_PEAK]
+        data[SENT] = data[SENT_PEAK]
+    else:
+        data[RECEIVED] = data[RECEIVED] / bucket
+        data[SENT] = data[SENT] / bucket
+    data[COLOR_ID] = data[USER] + ' ' + data[HOST]
+    data[TIMESTAMP_START] = timestamps_to_datetime(data[TIMESTAMP_START])
+    return data
+
+
+def extend_data(data, column, traces, max_points):
+    # extendData payload appending the new buckets to the existing traces
+    x, y, indices = [], [], []
+    for index, trace in enumerate(traces):
+        part = data[data[COLOR_ID] == trace]
+        if part.empty:
+            continue
+        x.append(part[TIMESTAMP_START].dt.strftime("%Y-%m-%d %H:%M:%S").tolist())
+        y.append(part[column].tolist())
+        indices.append(index)
+    if not indices:
+        return no_update
+    if max_points is None:
+        return [{"x": x, "y": y}, indices]
+    return [{"x": x, "y": y}, indices, max_points]
 
 
 @app.callback(
+    Output(RECEIVED_GRAPH, "figure"),
+    Output(RECEIVED_GRAPH, "extendData"),
     Output(SENT_GRAPH, "figure"),
+    Output(SENT_GRAPH, "extendData"),
+    Output(GRAPH_STATE, "data"),
     Input(TIME_PERIOD_SELECTOR, "value"),
     Input(HOST_SELECTOR, "value"),
     Input(TIMER, "n_intervals"),
+    State(GRAPH_STATE, "data"),
 )
-def sent_graph(timedelta_str, host, _):
+@timed
+def speed_graphs(timedelta_str, host, _, state):
     if host == ALL:
         host = None
 
-    curr_date = datetime.datetime.now()
-    timedelta = TIMEDELTAS[timedelta_str]
-    if timedelta is not None:
-        start_date = curr_date - TIMEDELTAS[timedelta_str]
-    else:
-        start_date = None
-
-    data = datareader(connected_at_min=start_date, host=host)
-    data = data[data[USER] != ALL]
-    data[TIME_DIFF] = data[TIMESTAMP_END] - data[TIMESTAMP_START]
-    data[RECEIVED] = data[RECEIVED] / data[TIME_DIFF]
-    data[SENT] = data[SENT] / data[TIME_DIFF]
-    data[COLOR_ID] = data[USER] + ' ' + data[HOST]
-    data[TIMESTAMP_START] = data[TIMESTAMP_START].apply(
-        lambda d: datetime.datetime.fromtimestamp(d)
-    )
-
-    graph = px.bar(data, x=TIMESTAMP_START, y=SENT, color=COLOR_ID)
-    return graph
+    start_date, period, bucket = graph_window(timedelta_str, host)
+    if not INCREMENTAL or bucket > INCREMENTAL_MAX_BUCKET:
+        data = speed_data(bucket, host, start_date)
+        received_graph = px.bar(data, x=TIMESTAMP_START, y=RECEIVED, color=COLOR_ID)
+        sent_graph = px.bar(data, x=TIMESTAMP_START, y=SENT, color=COLOR_ID)
+        return received_graph, no_update, sent_graph, no_update, no_update
+
+    # Only complete buckets are drawn, so every bucket is sent to the browser once.
+    # The state of the tab keeps the end of the last drawn bucket as a watermark.
+    key = [timedelta_str, host]
+    if (
+            state is not None
+            and state["key"] == key
+            and ctx.triggered_id == TIMER
+            and state["ticks"] < INCREMENTAL_RESYNC
+    ):
+        bucket = state["bucket"]
+        complete = (time.time() - INCREMENTAL_LAG) // bucket * bucket
+        data = speed_data(
+            bucket,
+            host,
+            datetime.datetime.fromtimestamp(state["watermark"]),
+            datetime.datetime.fromtimestamp(complete),
+        )
+        if set(data[COLOR_ID]) <= set(state["traces"]):
+            max_points = None
+            if TIMEDELTAS[timedelta_str] is not None:
+                max_points = math.ceil(period / bucket)
+            state = dict(
+                state,
+                watermark=max(complete, state["watermark"]),
+                ticks=state["ticks"] + 1,
+            )
+            return (
+                no_update,
+                extend_data(data, RECEIVED, state["traces"], max_points),
+                no_update,
+                extend_data(data, SENT, state["traces"], max_points),
+                state,
+            )
+
+    complete = (time.time() - INCREMENTAL_LAG) // bucket * bucket
+    data = speed_data(bucket, host, start_date, datetime.datetime.fromtimestamp(complete))
+    received_graph = px.bar(data, x=TIMESTAMP_START, y=RECEIVED, color=COLOR_ID)
+    sent_graph = px.bar(data, x=TIMESTAMP_START, y=SENT, color=COLOR_ID)
+    state = {
+        "key": key,
+        "bucket": bucket,
+        "watermark": complete,
+        "traces": [trace.name for trace in received_graph.data],
+        "ticks": 0,
+    }
+    return received_graph, no_update, sent_graph, no_update, state
@@ -1,5 +1,8 @@
-import datetime
+import math
+import time
+from typing import List
 
+import numpy as np
 import pandas as pd
 
 from openvpn_monitor.columns import (
@@ -11,20 +14,94 @@ from openvpn_monitor.columns import (
     RECEIVED,
     SENT,
 )
-from openvpn_monitor.const import DATA_SPEEDS, DATA_SIZES
+from openvpn_monitor.const import DATA_SPEEDS, DATA_SIZES, GRAPH_BUCKETS
+
+TWO_DIGITS = np.array([f"{i:02d}" for i in range(100)])
 
 
 def get_sess_data(data: pd.DataFrame) -> pd.DataFrame:
     data = data.copy()
-    data[CONNECTED_AT] = data[CONNECTED_AT].map(datetime.datetime.fromtimestamp)
-    data[CONNECTED_AT] = data[CONNECTED_AT].map(lambda x: x.strftime("%Y-%m-%d %H:%M"))
-    data[CLOSED_AT] = data[CLOSED_AT].map(datetime.datetime.fromtimestamp)
-    data[CLOSED_AT] = data[CLOSED_AT].map(lambda x: x.strftime("%Y-%m-%d %H:%M"))
-    data[RECEIVED] = data[RECEIVED].map(bytes_to_str)
-    data[SENT] = data[SENT].map(bytes_to_str)
+    data[CONNECTED_AT] = timestamps_to_str(data[CONNECTED_AT])
+    data[CLOSED_AT] = timestamps_to_str(data[CLOSED_AT])
+    data[RECEIVED] = bytes_to_str_series(data[RECEIVED])
+    data[SENT] = bytes_to_str_series(data[SENT])
     return data[[HOST, USER, IP, CONNECTED_AT, CLOSED_AT, RECEIVED, SENT, ]]
 
 
+def timestamps_to_datetime(data: pd.Series) -> pd.Series:
+    # Same as datetime.fromtimestamp(x). UTC offset changes happen on 15 minute
+    # boundaries, so the offset is looked up once per 15 minute bucket.
+    values = pd.to_numeric(data, errors="coerce").to_numpy(dtype="float64")
+    buckets, inverse = np.unique(np.floor(values / 900) * 900, return_inverse=True)
+    offsets = np.array(
+        [
+            time.localtime(bucket).tm_gmtoff if np.isfinite(bucket) else 0
+            for bucket in buckets
+        ],
+        dtype="float64",
+    )
+    local = pd.Series(values + offsets[inverse.reshape(-1)], index=data.index)
+    return pd.to_datetime(local, unit="s")
+
+
+def timestamps_to_str(data: pd.Series, fmt: str = "%Y-%m-%d %H:%M") -> pd.Series:
+    return timestamps_to_datetime(data).dt.strftime(fmt)
+
+
+def graph_bucket(period: float, points: int) -> int:
+    # The smallest bucket that keeps the period within `points` buckets
+    for bucket in GRAPH_BUCKETS:
+        if period / bucket <= points:
+            return bucket
+    return GRAPH_BUCKETS[-1] * math.ceil(period / points / GRAPH_BUCKETS[-1])
+
+
+def units_to_str(data: pd.Series, sizes: List[str]) -> pd.Series:
+    # Vectorized bytes_to_str/speed_to_str, the unit index is the integer part of
+    # log1024(x). Dividing by a power of two is exact, so the strings are identical.
+    denominator = 1024
+    values = pd.to_numeric(data, errors="coerce").to_numpy(dtype="float64")
+    missing = data.isna().to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        i = np.floor(np.log(values) / np.log(denominator))
+    i = np.clip(np.nan_to_num(i, nan=0., neginf=0.), 0, len(sizes) - 1).astype("int64")
+    # Fix rounding errors of the logarithm around exact powers of 1024
+    i[(i < len(sizes) - 1) & (values / np.power(float(denominator), i + 1) >= 1)] += 1
+    i[(i > 0) & (values / np.power(float(denominator), i) < 1)] -= 1
+
+    values = values / np.power(float(denominator), i)
+    units = np.array(sizes)[i]
+    hundredths = values * 100
+    with np.errstate(invalid="ignore"):
+        # Rounding hundredths is only ambiguous close to .5, these are formatted one by one
+        fast = (
+            ~missing
+            & (values >= 0)
+            & (np.abs(hundredths - np.floor(hundredths) - 0.5) > 1e-6)
+        )
+    result = np.empty(len(values), dtype=object)
+
+    hundredths = np.rint(hundredths[fast]).astype("int64")
+    result[fast] = np.char.add(
+        np.char.add((hundredths // 100).astype("U"), "."),
+        np.char.add(TWO_DIGITS[hundredths % 100], np.char.add(" ", units[fast])),
+    ).astype(object)
+
+    slow = ~fast & ~missing
+    result[slow] = [f"{x:.2f} {unit}" for x, unit in zip(values[slow], units[slow])]
+    result[missing] = None
+    return pd.Series(result, index=data.index, dtype=object)
+
+
+def bytes_to_str_series(data: pd.Series) -> pd.Series:
+    return units_to_str(data, DATA_SIZES)
+
+
+def speed_to_str_series(data: pd.Series) -> pd.Series:
+    return units_to_str(data, DATA_SPEEDS)
+
+
 def bytes_to_str(x):
     if x is None:
         return x
@@ -1,8 +1,11 @@
 import datetime
-from typing import List, Optional
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
 from openvpn_monitor.columns import (
@@ -16,10 +19,42 @@ from openvpn_monitor.columns import (
     CLOSED_AT,
     TIMESTAMP_START,
     TIMESTAMP_END,
+    RECEIVED_PEAK,
+    SENT_PEAK,
 )
+from openvpn_monitor.const import ROLLUPS
+from openvpn_monitor.tables import rollup_table
 
+# (process ID, connection string) -> engine. Engines are created on first use in every
+# process, so forked web server workers never share pooled connections, and the
+# readers of a process share one pool.
+engines: Dict[Tuple[int, str], Engine] = {}
+engines_lock = threading.Lock()
 
-class OVPNHostsReader:
+
+def get_engine(conn_string: str) -> Engine:
+    key = (os.getpid(), conn_string)
+    with engines_lock:
+        engine = engines.get(key)
+        if engine is None:
+            engine = engines[key] = create_engine(conn_string, pool_recycle=1800)
+        return engine
+
+
+class Reader:
+    conn_string: str
+
+    @property
+    def engine(self) -> Engine:
+        return get_engine(self.conn_string)
+
+    def fetch(self, query: str, params: Dict[str, Any]) -> List[tuple]:
+        # Values are always bound, never formatted into the query
+        with Session(self.engine) as session:
+            return session.execute(text(query), params).fetchall()
+
+
+class OVPNHostsReader(Reader):
     def __init__(
         self,
         conn_string: str,
@@ -28,36 +63,88 @@ class OVPNHostsReader:
         self.conn_string = conn_string
         self.table = table
 
-        self.engine = create_engine(self.conn_string, pool_recycle=1800)
-
     def __call__(
         self,
         timedelta: Optional[datetime.timedelta] = None
     ) -> List[str]:
         query = f"""SELECT DISTINCT {HOST} FROM {self.table} """
+        params = {}
 
         if timedelta is not None:
-            min_timestamp = (datetime.datetime.now() - timedelta).timestamp()
-            query += f""" WHERE {CONNECTED_AT} >= {min_timestamp} """
+            query += f""" WHERE {CONNECTED_AT} >= :{CONNECTED_AT} """
+            params[CONNECTED_AT] = (datetime.datetime.now() - timedelta).timestamp()
 
-        with Session(self.engine) as session:
-            result = session.execute(query).fetchall()
-
-        result = sorted(row[0] for row in result)
+        result = sorted(row[0] for row in self.fetch(query, params))
 
         return result
 
 
-class OVPNDataReader:
+class OVPNDataReader(Reader):
     def __init__(
         self,
         conn_string: str,
         table: str,
+        min_points: int = 100,
     ):
         self.conn_string = conn_string
         self.table = table
+        self.min_points = min_points
+        # (bucket size in seconds, table), coarsest first
+        self.rollups = sorted(
+            ((seconds, rollup_table(table, name)) for name, seconds in ROLLUPS.items()),
+            reverse=True,
+        )
+
+    def source(
+        self,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+        connected_at_max: Optional[datetime.datetime] = None,
+        exact: bool = False,
+    ) -> str:
+        # The coarsest table that still has min_points buckets in the period. With
+        # exact, only rollups whose buckets are aligned with both bounds are used.
+        end = datetime.datetime.now().timestamp()
+        if connected_at_max is not None:
+            end = connected_at_max.timestamp()
+        if connected_at_min is None:
+            first_timestamp = self.first_timestamp(host=host)
+            if first_timestamp is None:
+                return self.table
+            period = end - first_timestamp
+        else:
+            period = end - connected_at_min.timestamp()
+        bounds = [
+            bound.timestamp() for bound in (connected_at_min, connected_at_max)
+            if bound is not None
+        ]
+        for seconds, rollup in self.rollups:
+            if exact and any(bound % seconds for bound in bounds):
+                continue
+            if period / seconds >= self.min_points:
+                return rollup
+        return self.table
 
-        self.engine = create_engine(self.conn_string, pool_recycle=1800)
+    def where(
+        self,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+        connected_at_max: Optional[datetime.datetime] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        conditions = []
+        params = {}
+        if host is not None:
+            conditions.append(f"{HOST} = :{HOST}")
+            params[HOST] = host
+        if connected_at_min is not None:
+            conditions.append(f"{TIMESTAMP_START} >= :{TIMESTAMP_START}")
+            params[TIMESTAMP_START] = connected_at_min.timestamp()
+        if connected_at_max is not None:
+            conditions.append(f"{TIMESTAMP_START} < :{TIMESTAMP_START}_max")
+            params[f"{TIMESTAMP_START}_max"] = connected_at_max.timestamp()
+        if not conditions:
+            return "", params
+        return " WHERE " + " AND ".join(conditions), params
 
     def __call__(
         self,
@@ -65,6 +152,8 @@ class OVPNDataReader:
         connected_at_min: Optional[datetime.datetime] = None,
         limit: Optional[int] = None,
     ) -> pd.DataFrame:
+        table = self.source(host=host, connected_at_min=connected_at_min)
+        where, params = self.where(host=host, connected_at_min=connected_at_min)
         query = (
             f"""SELECT 
                     {HOST},
@@ -73,30 +162,126 @@ class OVPNDataReader:
                     {USER}, 
                     {RECEIVED},
                     {SENT} 
-                FROM {self.table} """
+                FROM {table} {where}
+                ORDER BY {TIMESTAMP_START} DESC """
         )
-        if host is not None or connected_at_min is not None:
-            query += f""" WHERE """
-            if host is not None:
-                query += f""" {HOST} = '{host}' """
-            if host is not None and connected_at_min is not None:
-                query += """ AND """
-            if connected_at_min is not None:
-                query += f""" {TIMESTAMP_START} >= {connected_at_min.timestamp()} """
-        query += f""" ORDER BY {TIMESTAMP_START} DESC """
         if limit is not None:
-            query += f""" LIMIT {limit} """
-
-        with Session(self.engine) as session:
-            result = session.execute(query).fetchall()
+            query += f""" LIMIT {int(limit)} """
 
         return pd.DataFrame(
-            result,
+            self.fetch(query, params),
             columns=[HOST, TIMESTAMP_START, TIMESTAMP_END, USER, RECEIVED, SENT, ]
         )
 
+    def traffic(
+        self,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+        connected_at_max: Optional[datetime.datetime] = None,
+        exact: bool = False,
+    ) -> pd.DataFrame:
+        table = self.source(
+            host=host,
+            connected_at_min=connected_at_min,
+            connected_at_max=connected_at_max,
+            exact=exact,
+        )
+        where, params = self.where(
+            host=host, connected_at_min=connected_at_min, connected_at_max=connected_at_max)
+        query = (
+            f"""SELECT
+                    {HOST},
+                    {USER},
+                    SUM({RECEIVED}),
+                    SUM({SENT})
+                FROM {table} {where}
+                GROUP BY {HOST}, {USER} """
+        )
+        data = pd.DataFrame(self.fetch(query, params), columns=[HOST, USER, RECEIVED, SENT, ])
+        data[[RECEIVED, SENT]] = data[[RECEIVED, SENT]].astype("int64")
+        return data
 
-class OVPNSessionsReader:
+    def active_users(
+        self,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+    ) -> pd.DataFrame:
+        table = self.source(host=host, connected_at_min=connected_at_min)
+        where, params = self.where(host=host, connected_at_min=connected_at_min)
+        query = f"""SELECT DISTINCT {USER}, {HOST} FROM {table} {where} """
+        return pd.DataFrame(self.fetch(query, params), columns=[USER, HOST, ])
+
+    def buckets(
+        self,
+        bucket: int,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+        connected_at_max: Optional[datetime.datetime] = None,
+        peaks: bool = False,
+    ) -> pd.DataFrame:
+        # With peaks, the highest speed of a single raw row (one poll interval) inside
+        # every bucket is returned too, so short bursts are not averaged away. The
+        # rollups keep this maximum per bucket in their peak columns.
+        bucket = int(bucket)
+        table = self.table
+        for seconds, rollup in self.rollups:
+            if bucket % seconds == 0:
+                table = rollup
+                break
+        where, params = self.where(
+            host=host, connected_at_min=connected_at_min, connected_at_max=connected_at_max)
+        peaks_query = ""
+        if peaks and table != self.table:
+            peaks_query = f""",
+                    MAX({RECEIVED_PEAK}),
+                    MAX({SENT_PEAK})"""
+        elif peaks:
+            peaks_query = f""",
+                    MAX({RECEIVED} / NULLIF({TIMESTAMP_END} - {TIMESTAMP_START}, 0)),
+                    MAX({SENT} / NULLIF({TIMESTAMP_END} - {TIMESTAMP_START}, 0))"""
+        query = (
+            f"""SELECT
+                    {HOST},
+                    {USER},
+                    FLOOR({TIMESTAMP_START} / {bucket}) * {bucket} AS bucket,
+                    SUM({RECEIVED}),
+                    SUM({SENT})
+                    {peaks_query}
+                FROM {table} {where}
+                GROUP BY {HOST}, {USER}, bucket
+                ORDER BY bucket """
+        )
+        columns = [HOST, USER, TIMESTAMP_START, RECEIVED, SENT, ]
+        if peaks:
+            columns += [RECEIVED_PEAK, SENT_PEAK]
+        data = pd.DataFrame(self.fetch(query, params), columns=columns)
+        data[[TIMESTAMP_START, RECEIVED, SENT]] = (
+            data[[TIMESTAMP_START, RECEIVED, SENT]].astype("int64")
+        )
+        if peaks:
+            data[[RECEIVED_PEAK, SENT_PEAK]] = (
+                data[[RECEIVED_PEAK, SENT_PEAK]].astype("float64").fillna(0.)
+            )
+        data[TIMESTAMP_END] = data[TIMESTAMP_START] + bucket
+        return data
+
+    def first_timestamp(
+        self,
+        host: Optional[str] = None,
+    ) -> Optional[int]:
+        # Raw data may be kept for a shorter time than the coarsest rollup
+        where, params = self.where(host=host)
+        timestamps = [
+            self.fetch(f"""SELECT MIN({TIMESTAMP_START}) FROM {table} {where} """, params)[0][0]
+            for table in (self.table, self.rollups[0][1])
+        ]
+        timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+        if not timestamps:
+            return None
+        return min(timestamps)
+
+
+class OVPNSessionsReader(Reader):
     def __init__(
         self,
         conn_string: str,
@@ -105,15 +290,12 @@ class OVPNSessionsReader:
         self.conn_string = conn_string
         self.table = table
 
-        self.engine = create_engine(self.conn_string, pool_recycle=1800)
-
     def __call__(
         self,
         host: Optional[str] = None,
         connected_at_min: Optional[datetime.datetime] = None,
         limit: Optional[int] = None,
     ):
-        # engine = create_engine(self.conn_string, pool_recycle=1800)
         query = (
             f"""SELECT 
                     {HOST},
@@ -126,22 +308,71 @@ class OVPNSessionsReader:
                     {CLOSED_AT}
                 FROM {self.table} """
         )
-        if host is not None or connected_at_min is not None:
-            query += f""" WHERE """
-            if host is not None:
-                query += f""" {HOST} = '{host}' """
-            if host is not None and connected_at_min is not None:
-                query += """ AND """
-            if connected_at_min is not None:
-                query += f""" {TIMESTAMP_START} >= {connected_at_min.timestamp()} """
+        conditions = []
+        params = {}
+        if host is not None:
+            conditions.append(f"{HOST} = :{HOST}")
+            params[HOST] = host
+        if connected_at_min is not None:
+            conditions.append(f"{CONNECTED_AT} >= :{CONNECTED_AT}")
+            params[CONNECTED_AT] = connected_at_min.timestamp()
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
         query += f""" ORDER BY {CONNECTED_AT} DESC """
         if limit is not None:
-            query += f""" LIMIT {limit} """
-
-        with Session(self.engine) as session:
-            result = session.execute(query).fetchall()
+            query += f""" LIMIT {int(limit)} """
 
         return pd.DataFrame(
-            result,
+            self.fetch(query, params),
             columns=[HOST, USER, IP, INTERNAL_IP, RECEIVED, SENT, CONNECTED_AT, CLOSED_AT, ]
         )
+
+
+class OVPNSessionSeriesReader(Reader):
+    def __init__(
+        self,
+        conn_string: str,
+        table: str,
+    ):
+        self.conn_string = conn_string
+        self.table = table
+
+    def sessions(
+        self,
+        host: Optional[str] = None,
+        connected_at_min: Optional[datetime.datetime] = None,
+        limit: int = 100,
+    ) -> pd.DataFrame:
+        # Latest sessions with traffic after connected_at_min
+        conditions, params = [], {"limit": limit}
+        if host is not None:
+            conditions.append(f"{HOST} = :host")
+            params["host"] = host
+        if connected_at_min is not None:
+            conditions.append(f"{TIMESTAMP_START} >= :timestamp_start_min")
+            params["timestamp_start_min"] = int(connected_at_min.timestamp())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+            SELECT {HOST}, {USER}, {IP}, {CONNECTED_AT}
+            FROM {self.table} {where}
+            GROUP BY {HOST}, {USER}, {IP}, {CONNECTED_AT}
+            ORDER BY {CONNECTED_AT} DESC
+            LIMIT :limit
+        """
+        return pd.DataFrame(self.fetch(query, params), columns=[HOST, USER, IP, CONNECTED_AT])
+
+    def __call__(self, host: str, user: str, ip: str, connected_at: int) -> pd.DataFrame:
+        query = f"""
+            SELECT {TIMESTAMP_START}, {TIMESTAMP_END}, {SENT}, {RECEIVED}
+            FROM {self.table}
+            WHERE {HOST} = :host AND {USER} = :user AND {CONNECTED_AT} = :connected_at
+                AND {IP} = :ip
+            ORDER BY {TIMESTAMP_START}
+        """
+        data = pd.DataFrame(
+            self.fetch(
+                query, {"host": host, "user": user, "ip": ip, "connected_at": connected_at}
+            ),
+            columns=[TIMESTAMP_START, TIMESTAMP_END, SENT, RECEIVED],
+        )
+        return data.astype("int64")
@@ -0,0 +1,58 @@
+from typing import Any, Dict
+
+from gunicorn.app.base import BaseApplication
+
+from openvpn_monitor.dashboard.dashboard import app, metrics
+
+# WSGI entry point for any server. With gunicorn load this module as the config too,
+# so the workers dump their metrics:
+#   gunicorn -c python:openvpn_monitor.dashboard.wsgi --workers 4 --threads 8 \
+#       openvpn_monitor.dashboard.wsgi:application
+application = app.server
+
+DEV = "dev"
+GUNICORN = "gunicorn"
+
+
+def post_fork(server, worker):
+    # Threads do not survive fork, every worker dumps its own metrics
+    metrics.start()
+
+
+class DashboardServer(BaseApplication):
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return application
+
+
+def serve(
+    host: str = "0.0.0.0",
+    port: int = 8888,
+    server: str = GUNICORN,
+    workers: int = 2,
+    threads: int = 4,
+    timeout: int = 120,
+):
+    if server == DEV:
+        # Single process Flask development server
+        metrics.start()
+        app.run_server(host=host, port=port)
+        return
+    print(f"Serving the dashboard on {host}:{port} with {workers} workers "
+          f"and {threads} threads each", flush=True)
+    DashboardServer({
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "threads": threads,
+        # Slow callbacks block one thread, not the worker
+        "worker_class": "gthread",
+        "timeout": timeout,
+        "post_fork": post_fork,
+    }).run()
@@ -0,0 +1,105 @@
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from openvpn_monitor.columns import (
+    HOST,
+    USER,
+    IP,
+    INTERNAL_IP,
+    SENT,
+    RECEIVED,
+    CONNECTED_AT,
+    TIMESTAMP_START,
+    TIMESTAMP_END,
+)
+from openvpn_monitor.const import ALL
+
+# Live state of every host is kept in {directory}/{host}.json. Collectors replace the
+# file after every poll, the dashboard reads it without touching the database.
+SESSIONS = "sessions"
+RATES = "rates"
+SUFFIX = ".json"
+
+
+class LiveStatePublisher:
+    def __init__(self, directory: str, host_alias: str):
+        self.directory = directory
+        self.host_alias = host_alias
+        self.path = os.path.join(directory, host_alias + SUFFIX)
+
+    def publish(
+        self,
+        timestamp_start: int,
+        timestamp_end: int,
+        sessions: Iterable[Any],
+        sessionbytes: Optional[Any],
+    ):
+        duration = max(timestamp_end - timestamp_start, 1)
+        state = {
+            HOST: self.host_alias,
+            TIMESTAMP_START: timestamp_start,
+            TIMESTAMP_END: timestamp_end,
+            SESSIONS: [
+                {
+                    USER: sess.user,
+                    IP: sess.ip,
+                    INTERNAL_IP: sess.internal_ip,
+                    CONNECTED_AT: sess.connected_at,
+                    SENT: sess.sent,
+                    RECEIVED: sess.received,
+                }
+                for sess in sessions
+            ],
+            # Bytes per second during the last poll interval
+            RATES: {
+                user: {SENT: sent / duration, RECEIVED: received / duration}
+                for user, sent, received in (
+                    zip(sessionbytes.users, sessionbytes.sent, sessionbytes.received)
+                    if sessionbytes is not None else ()
+                )
+                if user != ALL
+            },
+        }
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "w") as fd:
+                json.dump(state, fd)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"{self.host_alias}: Got {e.__repr__()} when tried to publish live state",
+                  flush=True)
+
+
+class LiveStateReader:
+    def __init__(self, directory: str, max_age: float = 180.):
+        self.directory = directory
+        self.max_age = max_age
+        # Path -> (mtime, state), files are parsed again only when replaced
+        self.files: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def read(self) -> Dict[str, Dict[str, Any]]:
+        # Host -> state for every host that published recently
+        result = {}
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(SUFFIX)]
+        except OSError:
+            return result
+        now = time.time()
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if now - mtime / 1e9 > self.max_age:
+                    continue
+                cached = self.files.get(path)
+                if cached is None or cached[0] != mtime:
+                    with open(path) as fd:
+                        cached = (mtime, json.load(fd))
+                    self.files[path] = cached
+            except (OSError, ValueError):
+                continue
+            result[cached[1][HOST]] = cached[1]
+        return result
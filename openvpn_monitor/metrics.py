@@ -0,0 +1,319 @@
+import contextlib
+import fcntl
+import functools
+import http.server
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Every process keeps its metrics in memory and dumps them to {directory}/{process}.json,
+# the dashboard merges the files of all processes and serves them at /metrics in the
+# Prometheus text format, collector nodes without the dashboard serve them with serve().
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.
+)
+ROWS_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+POLL_SECONDS = "openvpn_monitor_poll_seconds"
+PARSE_SECONDS = "openvpn_monitor_parse_seconds"
+POLL_OVERRUNS = "openvpn_monitor_poll_overruns_total"
+QUEUE_DEPTH = "openvpn_monitor_queue_depth"
+WRITER_BUFFERED_ROWS = "openvpn_monitor_writer_buffered_rows"
+WRITER_DROPPED_ROWS = "openvpn_monitor_writer_dropped_rows_total"
+WRITER_BATCH_ROWS = "openvpn_monitor_writer_batch_rows"
+WRITER_INSERT_SECONDS = "openvpn_monitor_writer_insert_seconds"
+WRITER_ERRORS = "openvpn_monitor_writer_errors_total"
+WRITER_REJECTED_ROWS = "openvpn_monitor_writer_rejected_rows_total"
+SPOOL_BYTES = "openvpn_monitor_spool_bytes"
+CALLBACK_SECONDS = "openvpn_monitor_callback_seconds"
+WORKER_RESTARTS = "openvpn_monitor_worker_restarts_total"
+
+# Totals of the processes that are gone, see retire()
+RETIRED = "_retired.json"
+
+# Name -> (type, help, histogram buckets)
+METRICS: Dict[str, Tuple[str, str, Optional[Tuple[float, ...]]]] = {
+    POLL_SECONDS: (
+        HISTOGRAM, "Time to fetch the status from the management interface", LATENCY_BUCKETS),
+    PARSE_SECONDS: (
+        HISTOGRAM, "Time to parse the status and compute the deltas", LATENCY_BUCKETS),
+    POLL_OVERRUNS: (COUNTER, "Polls that did not fit into the interval", None),
+    QUEUE_DEPTH: (GAUGE, "Items waiting in the queue of a writer", None),
+    WRITER_BUFFERED_ROWS: (GAUGE, "Rows waiting in the buffer of a writer", None),
+    WRITER_DROPPED_ROWS: (COUNTER, "Rows dropped because the buffer was full", None),
+    WRITER_BATCH_ROWS: (HISTOGRAM, "Rows written in one batch", ROWS_BUCKETS),
+    WRITER_INSERT_SECONDS: (
+        HISTOGRAM, "Time to write and commit one batch", LATENCY_BUCKETS),
+    WRITER_ERRORS: (COUNTER, "Batches that failed to be written and were retried", None),
+    WRITER_REJECTED_ROWS: (
+        COUNTER, "Rows the database refused for good, quarantined and skipped", None),
+    SPOOL_BYTES: (GAUGE, "Size of the spool of a writer on disk", None),
+    CALLBACK_SECONDS: (HISTOGRAM, "Time spent in dashboard callbacks", LATENCY_BUCKETS),
+    WORKER_RESTARTS: (COUNTER, "Workers restarted by a supervisor", None),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    def __init__(
+        self,
+        directory: Optional[str],
+        process_name: str,
+        interval: float = 10.,
+        per_process: bool = False,
+    ):
+        self.directory = directory
+        self.process_name = process_name
+        self.interval = interval
+        # Every process forked with this object dumps to its own file
+        self.per_process = per_process
+        # (name, labels) -> number, or [bucket counts, sum, count] for histograms
+        self.values: Dict[Tuple[str, Labels], Any] = {}
+        # Gauges evaluated right before every dump
+        self.watches: List[Tuple[str, Labels, Callable[[], float]]] = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Processes may be started with spawn, the lock is not picklable
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1., **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * (len(buckets) + 1), 0., 0]
+            idx = 0
+            while idx < len(buckets) and value > buckets[idx]:
+                idx += 1
+            histogram[0][idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels: str):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def watch(self, name: str, func: Callable[[], float], **labels: str):
+        self.watches.append((name, tuple(sorted(labels.items())), func))
+
+    def dump(self):
+        for name, labels, func in self.watches:
+            try:
+                self.set(name, func(), **dict(labels))
+            except (NotImplementedError, OSError):
+                # Queue.qsize is not implemented on macOS
+                pass
+        if not self.directory:
+            return
+        with self.lock:
+            values = [[name, dict(labels), value] for (name, labels), value in self.values.items()]
+        name = self.process_name
+        if self.per_process:
+            name = f"{name}:{os.getpid()}"
+        path = os.path.join(self.directory, name.replace(":", "_") + ".json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "w") as fd:
+                json.dump(values, fd)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"{self.process_name}: Got {e.__repr__()} when tried to dump metrics",
+                  flush=True)
+
+    def loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.dump()
+
+    def start(self) -> "Metrics":
+        threading.Thread(
+            target=self.loop, name=f"{self.process_name}:metrics", daemon=True
+        ).start()
+        return self
+
+
+def merge(result: Dict[Tuple[str, Labels], Any], values: List[list]):
+    for metric, labels, value in values:
+        if metric not in METRICS:
+            continue
+        key = (metric, tuple(sorted(labels.items())))
+        if key not in result:
+            result[key] = value
+        elif METRICS[metric][0] == HISTOGRAM:
+            total = result[key]
+            result[key] = [
+                [a + b for a, b in zip(total[0], value[0])],
+                total[1] + value[1],
+                total[2] + value[2],
+            ]
+        else:
+            result[key] = result[key] + value
+
+
+def load(path: str, max_age: Optional[float] = None) -> Optional[List[list]]:
+    try:
+        if max_age is not None and time.time() - os.stat(path).st_mtime > max_age:
+            return None
+        with open(path) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def retire(directory: str, paths: List[str], max_age: float):
+    # Files of processes that stopped dumping are dropped. Their counters and histograms
+    # are folded into RETIRED first, otherwise the sums would go backwards, which
+    # Prometheus takes for a reset. Gauges are dropped with the process.
+    with open(os.path.join(directory, RETIRED + ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired = os.path.join(directory, RETIRED)
+        totals: Dict[Tuple[str, Labels], Any] = {}
+        merge(totals, load(retired) or [])
+        stale = []
+        for path in paths:
+            # Another process may have retired it already or the process is back
+            try:
+                if time.time() - os.stat(path).st_mtime <= max_age:
+                    continue
+            except OSError:
+                continue
+            merge(totals, [
+                item for item in load(path) or []
+                if item[0] in METRICS and METRICS[item[0]][0] != GAUGE
+            ])
+            stale.append(path)
+        if not stale:
+            return
+        tmp = f"{retired}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fd:
+            json.dump([[name, dict(labels), value] for (name, labels), value in totals.items()], fd)
+        os.replace(tmp, retired)
+        for path in stale:
+            os.unlink(path)
+
+
+def collect(directory: str, max_age: float = 300.) -> Dict[Tuple[str, Labels], Any]:
+    # Sums the values of all processes that dumped their metrics recently and the
+    # retired totals of the processes that are gone
+    result = {}
+    try:
+        names = [
+            name for name in os.listdir(directory)
+            if name.endswith(".json") and name != RETIRED
+        ]
+    except OSError:
+        return result
+    stale = []
+    for name in names:
+        path = os.path.join(directory, name)
+        values = load(path, max_age)
+        if values is None:
+            stale.append(path)
+            continue
+        merge(result, values)
+    if stale:
+        try:
+            retire(directory, stale, max_age)
+        except OSError as e:
+            print(f"metrics: Got {e.__repr__()} when tried to retire metrics", flush=True)
+    merge(result, load(os.path.join(directory, RETIRED)) or [])
+    return result
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def render(directory: str, max_age: float = 300.) -> str:
+    values = collect(directory, max_age)
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        series = sorted(
+            [(labels, value) for (metric, labels), value in values.items() if metric == name],
+            key=lambda item: item[0],
+        )
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind != HISTOGRAM:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{name}_bucket{format_labels(labels, (('le', str(bound)),))} {cumulative}"
+                )
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(directory: str, host: str = "0.0.0.0", port: int = 9100):
+    # Minimal /metrics endpoint for the collector role, the dashboard is not there
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render(directory).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the log
+            pass
+
+    print(f"Serving metrics at http://{host}:{port}/metrics", flush=True)
+    http.server.ThreadingHTTPServer((host, port), Handler).serve_forever()
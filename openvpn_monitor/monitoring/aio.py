@@ -0,0 +1,170 @@
+import asyncio
+import multiprocessing
+import random
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from openvpn_monitor.live import LiveStatePublisher
+from openvpn_monitor.metrics import Metrics, POLL_SECONDS, PARSE_SECONDS, POLL_OVERRUNS
+
+from openvpn_monitor.monitoring.checkpoint import Checkpoint, POLLING
+from openvpn_monitor.monitoring.management import Backoff
+from openvpn_monitor.monitoring.openvpn import collect
+from openvpn_monitor.monitoring.series import SessionSeriesTracker
+from openvpn_monitor.monitoring.status import STATUS_COMMAND, StatusParser
+
+
+class OVPNAsyncMonitor(multiprocessing.Process):
+    def __init__(
+        self,
+        *,
+        hosts: Dict[str, Dict[str, Any]],
+        sessions_queue: multiprocessing.Queue,
+        data_queue: multiprocessing.Queue,
+        interval: int = 10,
+        timeout: int = 5,
+        jitter: float = 0.1,
+        live_dir: Optional[str] = None,
+        metrics_dir: Optional[str] = None,
+        series_queue: Optional[multiprocessing.Queue] = None,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_max_age: float = 3600.,
+    ):
+        super().__init__(name="monitor:async")
+        self.hosts = hosts
+        self.sessions_queue = sessions_queue
+        self.data_queue = data_queue
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.live_dir = live_dir
+        self.metrics = Metrics(metrics_dir, self.name)
+        self.series_queue = series_queue
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_max_age = checkpoint_max_age
+        self.connections: Dict[str, Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = {}
+        self.backoffs: Dict[str, Backoff] = {}
+
+    async def status(self, host_alias: str, host: str, port: int) -> Optional[StatusParser]:
+        # None when the poll failed or was postponed: it tells nothing about the sessions
+        backoff = self.backoffs.setdefault(host_alias, Backoff())
+        parser = StatusParser(host_alias)
+        try:
+            if host_alias not in self.connections:
+                if not backoff.ready():
+                    return None
+                self.connections[host_alias] = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self.timeout
+                )
+            reader, writer = self.connections[host_alias]
+            with self.metrics.time(POLL_SECONDS, host=host_alias):
+                writer.write(STATUS_COMMAND + b"\n")
+                await writer.drain()
+                # The response is parsed while the rest of it is still on the way
+                while not parser.done:
+                    chunk = await asyncio.wait_for(reader.read(65536), self.timeout)
+                    if not chunk:
+                        raise EOFError("Management interface closed the connection")
+                    parser.feed(chunk)
+            backoff.succeeded()
+            return parser
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+            print(
+                f"{host_alias}: Got {e.__repr__()} when tried to fetch data "
+                f"from the monitoring port for {host}:{port}",
+                flush=True
+            )
+            if host_alias in self.connections:
+                self.connections.pop(host_alias)[1].close()
+            backoff.failed()
+            return None
+
+    async def put(self, queue: multiprocessing.Queue, item):
+        await asyncio.get_running_loop().run_in_executor(None, queue.put, item)
+
+    async def poll(self, host_alias: str, conf: Dict[str, Any]):
+        # Spread the hosts over the interval, so they are not polled all at once
+        await asyncio.sleep(random.uniform(0, self.interval))
+        print(f'Started monitoring for host {host_alias}', flush=True)
+        timestamp = int(time.time())
+        status = {}
+        live = LiveStatePublisher(self.live_dir, host_alias) if self.live_dir else None
+        series = SessionSeriesTracker(host_alias) if self.series_queue is not None else None
+        checkpoint = (
+            Checkpoint(self.checkpoint_dir, host_alias, POLLING, self.checkpoint_max_age)
+            if self.checkpoint_dir else None
+        )
+        restored = checkpoint.load() if checkpoint is not None else None
+        if restored is not None:
+            timestamp, status = restored
+
+        while True:
+            start = time.time()
+            parser = await self.status(host_alias, conf['host'], conf['monitoring_port'])
+            if parser is None:
+                # Keep the last known state, the next successful poll closes only the
+                # sessions that really ended
+                await self.wait(host_alias, start)
+                continue
+            timestamp_prev, status_prev = timestamp, status
+            timestamp, status = int(time.time()), parser.sessions
+            collect_start = time.perf_counter()
+            expired, sessionbytes = collect(
+                host_alias, timestamp_prev, status_prev, timestamp, status
+            )
+            self.metrics.observe(
+                PARSE_SECONDS,
+                parser.elapsed + time.perf_counter() - collect_start,
+                host=host_alias,
+            )
+            for sess in expired:
+                await self.put(self.sessions_queue, sess)
+            if sessionbytes is not None:
+                await self.put(self.data_queue, sessionbytes)
+            if live is not None:
+                live.publish(
+                    timestamp_prev, timestamp, status.values(),
+                    sessionbytes,
+                )
+            if series is not None:
+                series.update(timestamp_prev, timestamp, status.values())
+                batch = series.flush()
+                if batch is not None:
+                    await self.put(self.series_queue, batch)
+            if checkpoint is not None:
+                # fsync does not block the other hosts
+                await asyncio.get_running_loop().run_in_executor(
+                    None, checkpoint.save, timestamp, status
+                )
+
+            await self.wait(host_alias, start)
+
+    async def wait(self, host_alias: str, start: float):
+        time_wait = self.interval - (time.time() - start)
+        if time_wait > 0:
+            time_wait += random.uniform(-self.jitter, self.jitter) * self.interval
+            await asyncio.sleep(max(time_wait, 0))
+        else:
+            self.metrics.inc(POLL_OVERRUNS, host=host_alias)
+            print(f'{host_alias}: Not enough time to collect stats', flush=True)
+
+    async def watch(self, host_alias: str, conf: Dict[str, Any]):
+        # An error of one host must not stop polling the others, the host starts over
+        # from its checkpoint
+        while True:
+            try:
+                await self.poll(host_alias, conf)
+            except Exception as e:
+                print(f"{host_alias}: Got {e.__repr__()}, polling starts over", flush=True)
+                if host_alias in self.connections:
+                    self.connections.pop(host_alias)[1].close()
+                await asyncio.sleep(self.interval)
+
+    async def main(self):
+        await asyncio.gather(
+            *(self.watch(host_alias, conf) for host_alias, conf in self.hosts.items())
+        )
+
+    def run(self):
+        self.metrics.start()
+        asyncio.run(self.main())
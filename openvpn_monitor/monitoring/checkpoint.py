@@ -0,0 +1,66 @@
+import os
+import pickle
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from openvpn_monitor.monitoring.data import SessionData
+
+# Collectors save the sessions of every host with their last cumulative counters to
+# {directory}/{host}.state after every poll. After a restart the first poll computes
+# the deltas against the saved counters and closes the sessions that ended meanwhile.
+SUFFIX = ".state"
+FORMAT = 2
+# Sessions are keyed by SessionKey in the polling collectors and by client ID in the
+# stream collector, a state saved by the other kind is discarded
+POLLING = "polling"
+STREAM = "stream"
+
+
+class Checkpoint:
+    def __init__(self, directory: str, host_alias: str, kind: str, max_age: float = 3600.):
+        self.directory = directory
+        self.host_alias = host_alias
+        self.kind = kind
+        # Older state is ignored: the traffic of the whole downtime would be attributed
+        # to one interval
+        self.max_age = max_age
+        self.path = os.path.join(directory, host_alias + SUFFIX)
+
+    def save(self, timestamp: int, sessions: Dict[Any, SessionData]):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "wb") as fd:
+                pickle.dump(
+                    (FORMAT, self.kind, timestamp, sessions), fd, pickle.HIGHEST_PROTOCOL
+                )
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"{self.host_alias}: Got {e.__repr__()} when tried to save the state",
+                  flush=True)
+
+    def load(self) -> Optional[Tuple[int, Dict[Any, SessionData]]]:
+        try:
+            with open(self.path, "rb") as fd:
+                state = pickle.load(fd)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            print(f"{self.host_alias}: Got {e.__repr__()} when tried to load the state",
+                  flush=True)
+            return None
+        if not isinstance(state, tuple) or state[0] != FORMAT or state[1] != self.kind:
+            print(f"{self.host_alias}: Ignored the state saved in another format or by "
+                  "another collector", flush=True)
+            return None
+        _, _, timestamp, sessions = state
+        age = time.time() - timestamp
+        if age > self.max_age:
+            print(f"{self.host_alias}: Ignored the state saved {age:.0f} seconds ago",
+                  flush=True)
+            return None
+        print(f"{self.host_alias}: Restored {len(sessions)} sessions saved "
+              f"{age:.0f} seconds ago", flush=True)
+        return timestamp, sessions
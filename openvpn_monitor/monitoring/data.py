@@ -1,8 +1,28 @@
-from dataclasses import dataclass
-from typing import Optional, Dict
+from array import array
+from dataclasses import dataclass, fields
+from typing import Optional, Dict, List, Tuple
 
 
-@dataclass
+def slotted(cls):
+    # dataclass(slots=True) for Python < 3.10: records are created for every client on
+    # every poll and cross the process boundary, __slots__ make them smaller to keep
+    # and to pickle
+    cls = dataclass(cls)
+    names = tuple(field.name for field in fields(cls))
+    namespace = {
+        key: value for key, value in cls.__dict__.items()
+        if key not in names and key not in ("__dict__", "__weakref__")
+    }
+    namespace["__slots__"] = names
+    # Pickle the values only, without the field names. Not attrgetter: with a single
+    # name it returns the value itself instead of a tuple
+    namespace["__reduce__"] = lambda self: (
+        type(self), tuple(getattr(self, name) for name in names)
+    )
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@slotted
 class SessionData:
     host: str
     user: str
@@ -15,9 +35,39 @@ class SessionData:
     closed_at: Optional[int] = None
 
 
-@dataclass
+@slotted
 class SessionBytes:
     host: str
     timestamp_start: int
     timestamp_end: int
-    data: Dict[str, Dict[str, int]]
+    # Parallel columns, one entry per user plus ALL with the totals of the host
+    users: List[str]
+    sent: array
+    received: array
+
+    @classmethod
+    def from_totals(
+        cls,
+        host: str,
+        timestamp_start: int,
+        timestamp_end: int,
+        totals: Dict[str, List[int]],
+    ) -> "SessionBytes":
+        # totals: user -> [sent, received]
+        return cls(
+            host=host,
+            timestamp_start=timestamp_start,
+            timestamp_end=timestamp_end,
+            users=list(totals),
+            sent=array("q", [value[0] for value in totals.values()]),
+            received=array("q", [value[1] for value in totals.values()]),
+        )
+
+
+@slotted
+class SessionSeriesBatch:
+    host: str
+    # (user, ip, connected_at) of every session in the batch
+    sessions: List[Tuple[str, str, int]]
+    # Flat rows of (session index, timestamp_start, timestamp_end, sent, received)
+    values: array
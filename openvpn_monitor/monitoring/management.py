@@ -0,0 +1,157 @@
+import socket
+import time
+from typing import Optional
+
+STATUS_END = b"\nEND"
+
+
+class Backoff:
+    def __init__(self, delay_min: float = 1., delay_max: float = 60.):
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.delay = 0.
+        self.retry_at = 0.
+
+    def ready(self) -> bool:
+        return time.time() >= self.retry_at
+
+    def failed(self):
+        self.delay = min(max(self.delay * 2, self.delay_min), self.delay_max)
+        self.retry_at = time.time() + self.delay
+
+    def succeeded(self):
+        self.delay = 0.
+        self.retry_at = 0.
+
+
+class ManagementConnection:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        timeout: float = 5.,
+        backoff: Optional[Backoff] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self.sock: Optional[socket.socket] = None
+        self.buffer = bytearray()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.settimeout(self.timeout)
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.buffer = bytearray()
+
+    def read_until(self, terminator: bytes) -> bytes:
+        start = 0
+        while True:
+            idx = self.buffer.find(terminator, start)
+            if idx >= 0:
+                end = self.buffer.find(b"\n", idx + len(terminator))
+                if end >= 0:
+                    result = bytes(self.buffer[:end + 1])
+                    del self.buffer[:end + 1]
+                    return result
+            else:
+                start = max(len(self.buffer) - len(terminator), 0)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Management interface closed the connection")
+            self.buffer += chunk
+
+    def ensure_connected(self):
+        if self.sock is not None:
+            return
+        if not self.backoff.ready():
+            raise ConnectionError(
+                f"Reconnect postponed for {self.retry_in():.1f} seconds"
+            )
+        try:
+            self.connect()
+        except OSError:
+            self.close()
+            self.backoff.failed()
+            raise
+
+    def send(self, command: bytes):
+        self.ensure_connected()
+        try:
+            self.sock.sendall(command + b"\n")
+        except OSError:
+            self.close()
+            self.backoff.failed()
+            raise
+
+    def readline(self, timeout: float) -> Optional[bytes]:
+        while True:
+            idx = self.buffer.find(b"\n")
+            if idx >= 0:
+                line = bytes(self.buffer[:idx + 1])
+                del self.buffer[:idx + 1]
+                return line
+            try:
+                self.sock.settimeout(timeout)
+                chunk = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            except OSError:
+                self.close()
+                self.backoff.failed()
+                raise
+            finally:
+                if self.sock is not None:
+                    self.sock.settimeout(self.timeout)
+            if not chunk:
+                self.close()
+                self.backoff.failed()
+                raise ConnectionError("Management interface closed the connection")
+            self.buffer += chunk
+
+    def command(self, command: bytes, terminator: bytes = STATUS_END) -> bytes:
+        self.send(command)
+        try:
+            result = self.read_until(terminator)
+        except OSError:
+            self.close()
+            self.backoff.failed()
+            raise
+
+        self.backoff.succeeded()
+        return result
+
+    def stream(self, command: bytes, parser):
+        # Feeds the response to the parser as it arrives, whatever follows the response
+        # stays in the buffer. Notifications that were buffered or arrived with the
+        # response go to the parser too, it keeps them for the caller.
+        self.send(command)
+        try:
+            if self.buffer:
+                buffered, self.buffer = bytes(self.buffer), bytearray()
+                parser.feed(buffered)
+            while not parser.done:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError("Management interface closed the connection")
+                parser.feed(chunk)
+        except OSError:
+            self.close()
+            self.backoff.failed()
+            raise
+
+        self.buffer += parser.remainder
+        self.backoff.succeeded()
+        return parser
+
+    def retry_in(self) -> float:
+        return max(self.backoff.retry_at - time.time(), 0.)
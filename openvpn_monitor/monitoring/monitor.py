@@ -1,10 +1,19 @@
+import functools
 import multiprocessing
-import sys
-import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
+from openvpn_monitor.monitoring.aio import OVPNAsyncMonitor
 from openvpn_monitor.monitoring.openvpn import OVPNMonitor
-from openvpn_monitor.monitoring.sql import OVPNSessionsWriter, OVPNDataWriter
+from openvpn_monitor.monitoring.partitions import OVPNPartitionMaintainer
+from openvpn_monitor.monitoring.schema import migrate
+from openvpn_monitor.monitoring.stream import OVPNStreamMonitor
+from openvpn_monitor.monitoring.sql import (
+    OVPNSessionsWriter,
+    OVPNDataWriter,
+    OVPNSessionSeriesWriter,
+)
+from openvpn_monitor.supervisor import Supervisor, Worker
+from openvpn_monitor.tables import series_table
 
 
 def monitor(
@@ -15,49 +24,176 @@ def monitor(
     sessions_table: str,
     interval: int = 10,
     timeout: int = 5,
+    batch_size: int = 1000,
+    flush_interval: float = 5.,
+    spill_size: int = 100000,
+    collector: str = "process",
+    bytecount: int = 5,
+    retention: Optional[Dict[str, int]] = None,
+    partitioning: Optional[Dict[str, Any]] = None,
+    live_dir: Optional[str] = None,
+    metrics_dir: Optional[str] = None,
+    session_series: bool = True,
+    spool_dir: Optional[str] = None,
+    spool_size: int = 1024 * 1024 * 1024,
+    fsync_interval: float = 1.,
+    checkpoint_dir: Optional[str] = None,
+    checkpoint_max_age: float = 3600.,
 ):
-    processes = []
+    # Every writer migrates the schema before its first write, retrying while the
+    # database is down, so the collectors start without waiting for it. Migrations
+    # are serialized by a database lock and skip the versions already applied.
+    schema = functools.partial(migrate, connection_string, data_table, sessions_table)
+
+    workers = []
     sessions_queue = multiprocessing.Queue(maxsize=len(hosts) * 2)
     data_queue = multiprocessing.Queue(maxsize=len(hosts) * 2)
-    for host, conf in hosts.items():
-        processes.append(
-            OVPNMonitor(
-                host_alias=host,
-                host=conf['host'],
-                port=conf['monitoring_port'],
-                sessions_queue=sessions_queue,
-                data_queue=data_queue,
-                interval=interval,
-                timeout=timeout,
+    series_queue = multiprocessing.Queue(maxsize=len(hosts) * 2) if session_series else None
+    if collector == "async":
+        workers.append(
+            Worker(
+                functools.partial(
+                    OVPNAsyncMonitor,
+                    hosts=hosts,
+                    sessions_queue=sessions_queue,
+                    data_queue=data_queue,
+                    interval=interval,
+                    timeout=timeout,
+                    live_dir=live_dir,
+                    metrics_dir=metrics_dir,
+                    series_queue=series_queue,
+                    checkpoint_dir=checkpoint_dir,
+                    checkpoint_max_age=checkpoint_max_age,
+                ),
+                shared=True,
             )
         )
+    elif collector == "stream":
+        for host, conf in hosts.items():
+            workers.append(
+                Worker(
+                    functools.partial(
+                        OVPNStreamMonitor,
+                        host_alias=host,
+                        host=conf['host'],
+                        port=conf['monitoring_port'],
+                        sessions_queue=sessions_queue,
+                        data_queue=data_queue,
+                        interval=interval,
+                        timeout=timeout,
+                        bytecount=bytecount,
+                        live_dir=live_dir,
+                        metrics_dir=metrics_dir,
+                        series_queue=series_queue,
+                        checkpoint_dir=checkpoint_dir,
+                        checkpoint_max_age=checkpoint_max_age,
+                    ),
+                    shared=True,
+                )
+            )
+    else:
+        for host, conf in hosts.items():
+            workers.append(
+                Worker(
+                    functools.partial(
+                        OVPNMonitor,
+                        host_alias=host,
+                        host=conf['host'],
+                        port=conf['monitoring_port'],
+                        sessions_queue=sessions_queue,
+                        data_queue=data_queue,
+                        interval=interval,
+                        timeout=timeout,
+                        live_dir=live_dir,
+                        metrics_dir=metrics_dir,
+                        series_queue=series_queue,
+                        checkpoint_dir=checkpoint_dir,
+                        checkpoint_max_age=checkpoint_max_age,
+                    ),
+                    shared=True,
+                )
+            )
 
-    processes.append(
-        OVPNDataWriter(
-            queue=data_queue,
-            connection_string=connection_string,
-            table=data_table,
+    workers.append(
+        Worker(
+            functools.partial(
+                OVPNDataWriter,
+                queue=data_queue,
+                connection_string=connection_string,
+                table=data_table,
+                retention=retention,
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+                spill_size=spill_size,
+                metrics_dir=metrics_dir,
+                spool_dir=spool_dir,
+                spool_size=spool_size,
+                fsync_interval=fsync_interval,
+                partitioned=bool(partitioning),
+                migrate=schema,
+            ),
+            shared=True,
         )
     )
 
-    processes.append(
-        OVPNSessionsWriter(
-            queue=sessions_queue,
-            connection_string=connection_string,
-            table=sessions_table,
+    workers.append(
+        Worker(
+            functools.partial(
+                OVPNSessionsWriter,
+                queue=sessions_queue,
+                connection_string=connection_string,
+                table=sessions_table,
+                retention=retention,
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+                spill_size=spill_size,
+                metrics_dir=metrics_dir,
+                spool_dir=spool_dir,
+                spool_size=spool_size,
+                fsync_interval=fsync_interval,
+                partitioned=bool(partitioning),
+                migrate=schema,
+            ),
+            shared=True,
         )
     )
 
-    print("Starting processes", flush=True)
-    for process in processes:
-        process.start()
-
-    while True:
-        if not all([process.is_alive() for process in processes]):
-            print("Monitor: some processes died", flush=True)
-            for process in processes:
-                if process.is_alive():
-                    process.terminate()
-                process.join()
-            sys.exit(1)
-        time.sleep(10)
+    if session_series:
+        workers.append(
+            Worker(
+                functools.partial(
+                    OVPNSessionSeriesWriter,
+                    queue=series_queue,
+                    connection_string=connection_string,
+                    table=series_table(sessions_table),
+                    retention=retention,
+                    batch_size=batch_size,
+                    flush_interval=flush_interval,
+                    spill_size=spill_size,
+                    metrics_dir=metrics_dir,
+                    spool_dir=spool_dir,
+                    spool_size=spool_size,
+                    fsync_interval=fsync_interval,
+                    partitioned=bool(partitioning),
+                    migrate=schema,
+                ),
+                shared=True,
+            )
+        )
+
+    if partitioning:
+        workers.append(
+            Worker(
+                functools.partial(
+                    OVPNPartitionMaintainer,
+                    connection_string=connection_string,
+                    data_table=data_table,
+                    sessions_table=sessions_table,
+                    retention=retention,
+                    migrate=schema,
+                    **partitioning
+                ),
+            )
+        )
+
+    Supervisor("monitor", workers, metrics_dir=metrics_dir).run()
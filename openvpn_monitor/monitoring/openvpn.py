@@ -1,11 +1,55 @@
 import multiprocessing
-import telnetlib
 import time
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 
-from openvpn_monitor.columns import RECEIVED, SENT
 from openvpn_monitor.const import ALL
+from openvpn_monitor.live import LiveStatePublisher
+from openvpn_monitor.metrics import Metrics, POLL_SECONDS, PARSE_SECONDS, POLL_OVERRUNS
+from openvpn_monitor.monitoring.checkpoint import Checkpoint, POLLING
 from openvpn_monitor.monitoring.data import SessionData, SessionBytes
+from openvpn_monitor.monitoring.management import ManagementConnection
+from openvpn_monitor.monitoring.series import SessionSeriesTracker
+from openvpn_monitor.monitoring.status import STATUS_COMMAND, SessionKey, StatusParser
+
+
+def collect(
+    host_alias: str,
+    timestamp_prev: int,
+    status_prev: Dict[SessionKey, SessionData],
+    timestamp: int,
+    status: Dict[SessionKey, SessionData],
+) -> Tuple[List[SessionData], Optional[SessionBytes]]:
+    expired_sessions = [
+        sess_id for sess_id in status_prev if sess_id not in status
+    ]
+    active_sessions = [
+        sess_id for sess_id in status_prev if sess_id in status
+    ]
+
+    expired = []
+    for sess in expired_sessions:
+        status_prev[sess].closed_at = timestamp_prev
+        expired.append(status_prev[sess])
+
+    # User -> [sent, received]
+    user_dw_data = {ALL: [0, 0]}
+    total = user_dw_data[ALL]
+    for sess in active_sessions:
+        curr, prev = status[sess], status_prev[sess]
+        user_sent = curr.sent - prev.sent
+        user_received = curr.received - prev.received
+        user = user_dw_data.get(curr.user)
+        if user is None:
+            user = user_dw_data[curr.user] = [0, 0]
+        user[0] += user_sent
+        user[1] += user_received
+        total[0] += user_sent
+        total[1] += user_received
+
+    if total[0] == 0 and total[1] == 0:
+        return expired, None
+
+    return expired, SessionBytes.from_totals(host_alias, timestamp_prev, timestamp, user_dw_data)
 
 
 class OVPNMonitor(multiprocessing.Process):
@@ -19,6 +63,11 @@ class OVPNMonitor(multiprocessing.Process):
         data_queue: multiprocessing.Queue,
         interval: int = 10,
         timeout: int = 5,
+        live_dir: Optional[str] = None,
+        metrics_dir: Optional[str] = None,
+        series_queue: Optional[multiprocessing.Queue] = None,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_max_age: float = 3600.,
     ):
         super().__init__(name=f"monitor:{host_alias}")
         self.host_alias = host_alias
@@ -28,120 +77,90 @@ class OVPNMonitor(multiprocessing.Process):
         self.data_queue = data_queue
         self.interval = interval
         self.timeout = timeout
+        self.connection = ManagementConnection(host, port, timeout)
+        self.live = LiveStatePublisher(live_dir, host_alias) if live_dir else None
+        self.metrics = Metrics(metrics_dir, self.name)
+        self.series_queue = series_queue
+        self.series = SessionSeriesTracker(host_alias) if series_queue is not None else None
+        self.checkpoint = (
+            Checkpoint(checkpoint_dir, host_alias, POLLING, checkpoint_max_age)
+            if checkpoint_dir else None
+        )
 
     def status(
         self,
-    ) -> List[str]:
+    ) -> Optional[StatusParser]:
+        # None when the poll failed: it tells nothing about the sessions
+        parser = StatusParser(self.host_alias)
         try:
-            telnet = telnetlib.Telnet(self.host, self.port)
-            telnet.write(b"status\n")
-            result = b""
-            while True:
-                chunk = telnet.read_until(b"END", self.timeout)
-                if chunk == b"":
-                    break
-                result += chunk
-
-            telnet.close()
-
-            result = result.decode('utf-8')
-            result = result.splitlines()
-            status = [s for s in result if s.startswith("CLIENT_LIST")]
-
-            return status
-        except EOFError as e:
+            with self.metrics.time(POLL_SECONDS, host=self.host_alias):
+                self.connection.stream(STATUS_COMMAND, parser)
+        except OSError as e:
             print(
                 f"{self.host_alias}: Got {e.__repr__()} when tried to fetch data "
                 f"from the monitoring port for {self.host}:{self.port}",
                 flush=True
             )
-            return []
+            return None
+        return parser
 
-    def status_parsed(
-        self
-    ) -> Tuple[int, Dict[str, SessionData]]:
-        status = self.status()
-        stats = {}
-        timestamp = int(time.time())
-        for line in status:
-            # CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,
-            # Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,
-            # Client ID,Peer ID,Data Channel Cipher
-            _, user, ip, internal_ip, _, sent, received, connected_at_str, connected_at = (
-                line.split(",")[:9]
-            )
-            sess_id = user + ip + internal_ip + connected_at_str
-            sess_stats = SessionData(
-                host=self.host_alias,
-                user=user,
-                ip=ip,
-                internal_ip=internal_ip,
-                sent=int(sent),
-                received=int(received),
-                connected_at_str=connected_at_str,
-                connected_at=int(connected_at),
-                closed_at=None,
-            )
-            stats[sess_id] = sess_stats
-
-        return timestamp, stats
+    def wait(self, start: float):
+        time_wait = self.interval - (time.time() - start)
+        if time_wait > 0:
+            time.sleep(time_wait)
+        else:
+            self.metrics.inc(POLL_OVERRUNS, host=self.host_alias)
+            print('Not enough time to collect stats', flush=True)
 
     def run(
         self,
     ):
         print(f'Started monitoring for host {self.host_alias}', flush=True)
+        self.metrics.start()
         timestamp = int(time.time())
         status = {}
+        restored = self.checkpoint.load() if self.checkpoint is not None else None
+        if restored is not None:
+            timestamp, status = restored
 
         while True:
             start = time.time()
+            parser = self.status()
+            if parser is None:
+                # Keep the last known state: closing every session here would write
+                # fake sessions and lose the traffic of the next interval. The next
+                # successful poll closes only the sessions that really ended.
+                self.wait(start)
+                continue
             timestamp_prev, status_prev = timestamp, status
-            timestamp, status = self.status_parsed()
-            expired_sessions = [
-                sess_id for sess_id in status_prev if sess_id not in status
-            ]
-            active_sessions = [
-                sess_id for sess_id in status_prev if sess_id in status
-            ]
-
-            for sess in expired_sessions:
-                status_prev[sess].closed_at = timestamp_prev
-                self.sessions_queue.put(status_prev[sess])
-
-            user_dw_data = {'__ALL__': {SENT: 0, RECEIVED: 0}}
-            for sess in active_sessions:
-                if status[sess].user not in user_dw_data:
-                    user_dw_data[status[sess].user] = {SENT: 0, RECEIVED: 0}
-                if sess in status_prev:
-                    user_sent = status[sess].sent - status_prev[sess].sent
-                    user_received = status[sess].received - status_prev[sess].received
-                else:
-                    user_sent = status[sess].sent
-                    user_received = status[sess].received
-                user_dw_data[status[sess].user][SENT] += user_sent
-                user_dw_data[status[sess].user][RECEIVED] += user_received
-
-                user_dw_data[ALL][SENT] += user_sent
-                user_dw_data[ALL][RECEIVED] += user_received
-
-            if (
-                    (user_dw_data[ALL]['sent'] != 0)
-                    or (user_dw_data[ALL]['received'] != 0)
-            ):
-                self.data_queue.put(
-                    SessionBytes(
-                        host=self.host_alias,
-                        timestamp_start=timestamp_prev,
-                        timestamp_end=timestamp,
-                        data=user_dw_data,
-                    )
+            timestamp, status = int(time.time()), parser.sessions
+            collect_start = time.perf_counter()
+            expired, sessionbytes = collect(
+                self.host_alias, timestamp_prev, status_prev, timestamp, status
+            )
+            self.metrics.observe(
+                PARSE_SECONDS,
+                parser.elapsed + time.perf_counter() - collect_start,
+                host=self.host_alias,
+            )
+            for sess in expired:
+                self.sessions_queue.put(sess)
+            if sessionbytes is not None:
+                self.data_queue.put(sessionbytes)
+            if self.live is not None:
+                self.live.publish(
+                    timestamp_prev, timestamp, status.values(),
+                    sessionbytes,
                 )
-
-            time_wait = self.interval - (time.time() - start)
-            if time_wait > 0:
-                time.sleep(time_wait)
-            else:
-                print('Not enough time to collect stats', flush=True)
+            if self.series is not None:
+                self.series.update(timestamp_prev, timestamp, status.values())
+                batch = self.series.flush()
+                if batch is not None:
+                    self.series_queue.put(batch)
+            if self.checkpoint is not None:
+                self.checkpoint.save(timestamp, status)
+
+            self.wait(start)
 
 
 class SimpleReader:
@@ -0,0 +1,174 @@
+import datetime
+import multiprocessing
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from openvpn_monitor.columns import TIMESTAMP_START, CLOSED_AT
+from openvpn_monitor.const import ROLLUPS, RAW, SESSIONS, SESSION_SERIES
+from openvpn_monitor.monitoring.management import Backoff
+from openvpn_monitor.tables import rollup_table, series_table
+
+DAILY = "daily"
+MONTHLY = "monthly"
+FUTURE_PARTITION = "p_future"
+
+
+def period_start(scheme: str, timestamp: float) -> datetime.datetime:
+    date = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if scheme == MONTHLY:
+        date = date.replace(day=1)
+    return date
+
+
+def next_period(scheme: str, date: datetime.datetime) -> datetime.datetime:
+    if scheme == MONTHLY:
+        if date.month == 12:
+            return date.replace(year=date.year + 1, month=1)
+        return date.replace(month=date.month + 1)
+    return date + datetime.timedelta(days=1)
+
+
+def partitions(scheme: str, start: float, end: float) -> List[Tuple[str, int]]:
+    # (name, upper bound) for every period from the one containing start up to end
+    result = []
+    date = period_start(scheme, start)
+    while date.timestamp() < end:
+        upper = next_period(scheme, date)
+        result.append((f"p{date.strftime('%Y%m%d')}", int(upper.timestamp())))
+        date = upper
+    return result
+
+
+def partitions_sql(bounds: List[Tuple[str, int]]) -> str:
+    return ", ".join(
+        [f"PARTITION {name} VALUES LESS THAN ({upper})" for name, upper in bounds]
+        + [f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE"]
+    )
+
+
+class OVPNPartitionMaintainer(multiprocessing.Process):
+    # Keeps the tables RANGE partitioned by time: converts them on the first run,
+    # creates `precreate` periods ahead and drops partitions older than the retention.
+    def __init__(
+        self,
+        *,
+        connection_string: str,
+        data_table: str,
+        sessions_table: str,
+        scheme: str = DAILY,
+        precreate: int = 7,
+        retention: Optional[Dict[str, int]] = None,
+        interval: float = 3600.,
+        migrate: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__(name="partition_maintainer")
+        if scheme not in (DAILY, MONTHLY):
+            raise ValueError(f"Unknown partitioning scheme {scheme}")
+        self.connection_string = connection_string
+        self.scheme = scheme
+        self.precreate = precreate
+        self.interval = interval
+        # The tables must exist before they are partitioned
+        self.migrate = migrate
+
+        retention = retention or {}
+        # Table -> (partitioning column, retention in days)
+        self.tables = {
+            data_table: (TIMESTAMP_START, retention.get(RAW)),
+            sessions_table: (CLOSED_AT, retention.get(SESSIONS)),
+            series_table(sessions_table): (TIMESTAMP_START, retention.get(SESSION_SERIES)),
+        }
+        for name in ROLLUPS:
+            self.tables[rollup_table(data_table, name)] = (TIMESTAMP_START, retention.get(name))
+
+    def current_partitions(self, session: Session, table: str) -> List[Dict[str, Any]]:
+        result = session.execute(
+            text(
+                """SELECT PARTITION_NAME, PARTITION_METHOD, PARTITION_DESCRIPTION
+                    FROM information_schema.partitions
+                    WHERE table_schema = DATABASE() AND table_name = :table
+                    ORDER BY PARTITION_ORDINAL_POSITION"""
+            ),
+            {"table": table}
+        ).fetchall()
+        return [
+            {"name": name, "method": method, "upper": description}
+            for name, method, description in result
+        ]
+
+    def horizon(self) -> float:
+        date = period_start(self.scheme, time.time())
+        for _ in range(self.precreate + 1):
+            date = next_period(self.scheme, date)
+        return date.timestamp()
+
+    def convert(self, session: Session, table: str, column: str):
+        first = session.execute(f"SELECT MIN({column}) FROM {table}").scalar()
+        if first is None:
+            first = time.time()
+        bounds = partitions(self.scheme, first, self.horizon())
+        print(f"{self.name}: partitioning {table} into {len(bounds)} partitions", flush=True)
+        session.execute(
+            f"ALTER TABLE {table} PARTITION BY RANGE ({column}) ({partitions_sql(bounds)})"
+        )
+
+    def extend(self, session: Session, table: str, current: List[Dict[str, Any]]):
+        uppers = [int(p["upper"]) for p in current if p["name"] != FUTURE_PARTITION]
+        last = max(uppers) if uppers else time.time()
+        bounds = [
+            (name, upper)
+            for name, upper in partitions(self.scheme, last, self.horizon())
+            if upper > last
+        ]
+        if bounds:
+            session.execute(
+                f"""ALTER TABLE {table} REORGANIZE PARTITION {FUTURE_PARTITION}
+                    INTO ({partitions_sql(bounds)})"""
+            )
+
+    def expire(self, session: Session, table: str, current: List[Dict[str, Any]], days: int):
+        cutoff = time.time() - days * 24 * 60 * 60
+        expired = [
+            p["name"] for p in current
+            if p["name"] != FUTURE_PARTITION and int(p["upper"]) <= cutoff
+        ]
+        if expired:
+            print(f"{self.name}: dropping {len(expired)} partitions of {table}", flush=True)
+            session.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+
+    def maintain(self, engine):
+        with Session(engine) as session:
+            for table, (column, days) in self.tables.items():
+                current = self.current_partitions(session, table)
+                if not current or current[0]["method"] != "RANGE":
+                    self.convert(session, table, column)
+                    current = self.current_partitions(session, table)
+                else:
+                    self.extend(session, table, current)
+                if days:
+                    self.expire(session, table, current, days)
+            session.commit()
+
+    def run(self):
+        engine = create_engine(self.connection_string, pool_recycle=1800)
+        backoff = Backoff()
+        migrated = self.migrate is None
+        while True:
+            try:
+                if not migrated:
+                    self.migrate()
+                    migrated = True
+                self.maintain(engine)
+            except SQLAlchemyError as e:
+                backoff.failed()
+                print(f"{self.name}: Got {e.__class__.__name__}, retrying in "
+                      f"{backoff.delay:.0f} seconds", flush=True)
+                time.sleep(backoff.delay)
+                continue
+            backoff.succeeded()
+            time.sleep(self.interval)
@@ -0,0 +1,282 @@
+from typing import Callable, List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from openvpn_monitor.columns import (
+    HOST,
+    USER,
+    IP,
+    INTERNAL_IP,
+    RECEIVED,
+    SENT,
+    CONNECTED_AT_STR,
+    CONNECTED_AT,
+    CLOSED_AT,
+    TIMESTAMP_START,
+    TIMESTAMP_END,
+    RECEIVED_PEAK,
+    SENT_PEAK,
+)
+from openvpn_monitor.const import ROLLUPS
+from openvpn_monitor.tables import SCHEMA_VERSION_TABLE, rollup_table, series_table
+
+SCHEMA_LOCK = "openvpn_monitor_schema"
+
+
+def table_exists(session: Session, table: str) -> bool:
+    return bool(
+        session.execute(
+            text(
+                """SELECT COUNT(*) FROM information_schema.tables
+                    WHERE table_schema = DATABASE() AND table_name = :table"""
+            ),
+            {"table": table}
+        ).scalar()
+    )
+
+
+def index_exists(session: Session, table: str, index: str) -> bool:
+    return bool(
+        session.execute(
+            text(
+                """SELECT COUNT(*) FROM information_schema.statistics
+                    WHERE table_schema = DATABASE()
+                        AND table_name = :table
+                        AND index_name = :index"""
+            ),
+            {"table": table, "index": index}
+        ).scalar()
+    )
+
+
+def column_exists(session: Session, table: str, column: str) -> bool:
+    return bool(
+        session.execute(
+            text(
+                """SELECT COUNT(*) FROM information_schema.columns
+                    WHERE table_schema = DATABASE()
+                        AND table_name = :table
+                        AND column_name = :column"""
+            ),
+            {"table": table, "column": column}
+        ).scalar()
+    )
+
+
+def add_index(session: Session, table: str, index: str, columns: List[str]):
+    if not index_exists(session, table, index):
+        session.execute(f"CREATE INDEX {index} ON {table} ({', '.join(columns)})")
+
+
+# Every migration takes (session, data table, sessions table) and must be safe to
+# run again, since MySQL commits DDL statements implicitly.
+
+def create_tables(session: Session, data_table: str, sessions_table: str):
+    session.execute(
+        f'''CREATE TABLE IF NOT EXISTS {sessions_table}
+            (
+                {HOST} VarChar(255) NOT NULL,
+                {USER} Text,
+                {IP} Text,
+                {INTERNAL_IP} Text,
+                {SENT} Integer,
+                {RECEIVED} Integer,
+                {CONNECTED_AT_STR} Text,
+                {CONNECTED_AT} Integer,
+                {CLOSED_AT} Integer
+            )
+            PARTITION BY KEY ({HOST})'''
+    )
+    session.execute(
+        f'''CREATE TABLE IF NOT EXISTS {data_table}
+            (
+                {HOST} VarChar(255) NOT NULL,
+                {TIMESTAMP_START} Integer,
+                {TIMESTAMP_END} Integer,
+                {USER} Text,
+                {SENT} Integer,
+                {RECEIVED} Integer
+            )
+            PARTITION BY KEY ({HOST})'''
+    )
+
+
+def create_rollups(session: Session, data_table: str, sessions_table: str):
+    for name, seconds in ROLLUPS.items():
+        rollup = rollup_table(data_table, name)
+        if table_exists(session, rollup):
+            continue
+        session.execute(
+            f'''CREATE TABLE {rollup}
+                (
+                    {HOST} VarChar(255) NOT NULL,
+                    {TIMESTAMP_START} BigInt NOT NULL,
+                    {TIMESTAMP_END} BigInt NOT NULL,
+                    {USER} VarChar(255) NOT NULL,
+                    {SENT} BigInt NOT NULL,
+                    {RECEIVED} BigInt NOT NULL,
+                    PRIMARY KEY ({HOST}, {TIMESTAMP_START}, {USER})
+                )
+                PARTITION BY KEY ({HOST})'''
+        )
+        # Backfill the new rollup from the raw data that is already there
+        session.execute(
+            f"""
+            INSERT INTO {rollup}
+                ({HOST}, {TIMESTAMP_START}, {TIMESTAMP_END}, {USER}, {SENT}, {RECEIVED})
+            SELECT
+                {HOST},
+                FLOOR({TIMESTAMP_START} / {seconds}) * {seconds} AS bucket,
+                FLOOR({TIMESTAMP_START} / {seconds}) * {seconds} + {seconds},
+                {USER},
+                SUM({SENT}),
+                SUM({RECEIVED})
+            FROM {data_table}
+            GROUP BY {HOST}, bucket, {USER}
+            """
+        )
+
+
+def add_indexes(session: Session, data_table: str, sessions_table: str):
+    session.execute(
+        f'''ALTER TABLE {data_table}
+            MODIFY {TIMESTAMP_START} BigInt NOT NULL,
+            MODIFY {TIMESTAMP_END} BigInt NOT NULL,
+            MODIFY {USER} VarChar(255) NOT NULL,
+            MODIFY {SENT} BigInt NOT NULL,
+            MODIFY {RECEIVED} BigInt NOT NULL'''
+    )
+    session.execute(
+        f'''ALTER TABLE {sessions_table}
+            MODIFY {USER} VarChar(255) NOT NULL,
+            MODIFY {IP} VarChar(64),
+            MODIFY {INTERNAL_IP} VarChar(64),
+            MODIFY {SENT} BigInt,
+            MODIFY {RECEIVED} BigInt,
+            MODIFY {CONNECTED_AT_STR} VarChar(64),
+            MODIFY {CONNECTED_AT} BigInt NOT NULL,
+            MODIFY {CLOSED_AT} BigInt'''
+    )
+    # WHERE host = ? AND timestamp_start >= ? ... GROUP BY host, user
+    add_index(
+        session, data_table, f"ix_{data_table}_host_ts_user",
+        [HOST, TIMESTAMP_START, USER]
+    )
+    # WHERE timestamp_start >= ? for all hosts, ORDER BY timestamp_start
+    add_index(session, data_table, f"ix_{data_table}_ts", [TIMESTAMP_START])
+    # Latest closed sessions, ORDER BY connected_at DESC
+    add_index(
+        session, sessions_table, f"ix_{sessions_table}_host_connected",
+        [HOST, CONNECTED_AT]
+    )
+    # SELECT DISTINCT host ... WHERE connected_at >= ?
+    add_index(
+        session, sessions_table, f"ix_{sessions_table}_connected_host",
+        [CONNECTED_AT, HOST]
+    )
+    for name in ROLLUPS:
+        rollup = rollup_table(data_table, name)
+        add_index(session, rollup, f"ix_{rollup}_ts", [TIMESTAMP_START])
+
+
+def create_session_series(session: Session, data_table: str, sessions_table: str):
+    series = series_table(sessions_table)
+    session.execute(
+        f'''CREATE TABLE IF NOT EXISTS {series}
+            (
+                {HOST} VarChar(255) NOT NULL,
+                {USER} VarChar(255) NOT NULL,
+                {IP} VarChar(64) NOT NULL,
+                {CONNECTED_AT} BigInt NOT NULL,
+                {TIMESTAMP_START} BigInt NOT NULL,
+                {TIMESTAMP_END} BigInt NOT NULL,
+                {SENT} BigInt NOT NULL,
+                {RECEIVED} BigInt NOT NULL
+            )
+            PARTITION BY KEY ({HOST})'''
+    )
+    # Drilldown into one session
+    add_index(
+        session, series, f"ix_{series}_session",
+        [HOST, USER, CONNECTED_AT, TIMESTAMP_START]
+    )
+    # Sessions seen in a time period, retention
+    add_index(session, series, f"ix_{series}_ts", [TIMESTAMP_START])
+
+
+def add_rollup_peaks(session: Session, data_table: str, sessions_table: str):
+    # Highest speed of a single raw row inside every bucket, so peaks survive the
+    # rollups instead of being averaged over a whole hour or day
+    for name, seconds in ROLLUPS.items():
+        rollup = rollup_table(data_table, name)
+        if column_exists(session, rollup, RECEIVED_PEAK):
+            continue
+        session.execute(
+            f'''ALTER TABLE {rollup}
+                ADD COLUMN {SENT_PEAK} Double NOT NULL DEFAULT 0,
+                ADD COLUMN {RECEIVED_PEAK} Double NOT NULL DEFAULT 0'''
+        )
+        # Buckets whose raw data is already expired only have their average
+        session.execute(
+            f'''UPDATE {rollup} SET
+                {SENT_PEAK} = {SENT} / ({TIMESTAMP_END} - {TIMESTAMP_START}),
+                {RECEIVED_PEAK} = {RECEIVED} / ({TIMESTAMP_END} - {TIMESTAMP_START})'''
+        )
+        session.execute(
+            f'''UPDATE {rollup} AS r
+                JOIN (
+                    SELECT
+                        {HOST},
+                        FLOOR({TIMESTAMP_START} / {seconds}) * {seconds} AS bucket,
+                        {USER},
+                        MAX({SENT} / NULLIF({TIMESTAMP_END} - {TIMESTAMP_START}, 0)) AS sp,
+                        MAX({RECEIVED} / NULLIF({TIMESTAMP_END} - {TIMESTAMP_START}, 0)) AS rp
+                    FROM {data_table}
+                    GROUP BY {HOST}, bucket, {USER}
+                ) AS p
+                    ON r.{HOST} = p.{HOST}
+                        AND r.{TIMESTAMP_START} = p.bucket
+                        AND r.{USER} = p.{USER}
+                SET
+                    r.{SENT_PEAK} = GREATEST(r.{SENT_PEAK}, COALESCE(p.sp, 0)),
+                    r.{RECEIVED_PEAK} = GREATEST(r.{RECEIVED_PEAK}, COALESCE(p.rp, 0))'''
+        )
+
+
+MIGRATIONS: List[Callable[[Session, str, str], None]] = [
+    create_tables,
+    create_rollups,
+    add_indexes,
+    create_session_series,
+    add_rollup_peaks,
+]
+
+
+def migrate(connection_string: str, data_table: str, sessions_table: str):
+    engine = create_engine(connection_string, pool_recycle=1800)
+    with Session(engine) as session:
+        # Several collector nodes may share the database
+        session.execute(text("SELECT GET_LOCK(:lock, 600)"), {"lock": SCHEMA_LOCK})
+        try:
+            session.execute(
+                f"""CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE}
+                    (version Integer NOT NULL)"""
+            )
+            version = session.execute(
+                f"SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}"
+            ).scalar() or 0
+
+            for number, migration in enumerate(MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                print(f"Migrating schema to version {number}: {migration.__name__}", flush=True)
+                migration(session, data_table, sessions_table)
+                session.execute(
+                    text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version) VALUES (:version)"),
+                    {"version": number}
+                )
+                session.commit()
+        finally:
+            session.execute(text("SELECT RELEASE_LOCK(:lock)"), {"lock": SCHEMA_LOCK})
+            session.commit()
@@ -0,0 +1,92 @@
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from openvpn_monitor.monitoring.data import SessionData, SessionSeriesBatch
+
+# timestamp_start, timestamp_end, sent, received
+FIELDS = 4
+
+
+class SessionSeries:
+    # Traffic deltas of one session in a ring buffer of int64, the oldest points are
+    # overwritten when the buffer is not drained in time
+    __slots__ = ("capacity", "values", "start", "size", "sent", "received", "dropped")
+
+    def __init__(self, capacity: int, sent: int, received: int):
+        self.capacity = capacity
+        self.values = array("q", bytes(8 * FIELDS * capacity))
+        self.start = 0
+        self.size = 0
+        # Last seen cumulative counters
+        self.sent = sent
+        self.received = received
+        self.dropped = 0
+
+    def add(self, timestamp_start: int, timestamp_end: int, sent: int, received: int):
+        sent_delta, received_delta = sent - self.sent, received - self.received
+        self.sent, self.received = sent, received
+        if sent_delta < 0 or received_delta < 0 or (sent_delta == 0 and received_delta == 0):
+            return
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+            self.dropped += 1
+        idx = (self.start + self.size) % self.capacity * FIELDS
+        self.values[idx:idx + FIELDS] = array(
+            "q", (timestamp_start, timestamp_end, sent_delta, received_delta)
+        )
+        self.size += 1
+
+    def drain(self, index: int, out: array):
+        for i in range(self.size):
+            idx = (self.start + i) % self.capacity * FIELDS
+            out.append(index)
+            out.extend(self.values[idx:idx + FIELDS])
+        self.start = 0
+        self.size = 0
+
+
+class SessionSeriesTracker:
+    # Keeps a series per active session of a host and hands them over in bulk
+    # every `flush_interval` seconds
+    def __init__(self, host_alias: str, capacity: int = 64, flush_interval: float = 60.):
+        self.host_alias = host_alias
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_at = time.time() + flush_interval
+        self.series: Dict[Tuple[str, str, int], SessionSeries] = {}
+        # Closed sessions wait here for the next flush
+        self.closed: Dict[Tuple[str, str, int], SessionSeries] = {}
+
+    def update(self, timestamp_prev: int, timestamp: int, sessions: Iterable[SessionData]):
+        seen = {}
+        for sess in sessions:
+            key = (sess.user, sess.ip, sess.connected_at)
+            series = self.series.get(key)
+            if series is None:
+                # Traffic before the first poll is not attributed to the interval
+                series = SessionSeries(self.capacity, sess.sent, sess.received)
+            else:
+                series.add(timestamp_prev, timestamp, sess.sent, sess.received)
+            seen[key] = series
+        for key, series in self.series.items():
+            if key not in seen and series.size:
+                self.closed[key] = series
+        self.series = seen
+
+    def flush(self, force: bool = False) -> Optional[SessionSeriesBatch]:
+        if not force and time.time() < self.flush_at:
+            return None
+        self.flush_at = time.time() + self.flush_interval
+        sessions: List[Tuple[str, str, int]] = []
+        values = array("q")
+        for series_map in (self.series, self.closed):
+            for key, series in series_map.items():
+                if series.size:
+                    series.drain(len(sessions), values)
+                    sessions.append(key)
+        self.closed = {}
+        if not sessions:
+            return None
+        return SessionSeriesBatch(host=self.host_alias, sessions=sessions, values=values)
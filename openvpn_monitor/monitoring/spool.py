@@ -0,0 +1,194 @@
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, Dict, List, Tuple
+
+# Append-only spool of rows between the queue and the database. Rows are appended to
+# numbered segment files as frames, the checkpoint file holds the position of the first
+# row that is not in the database yet. Segments before the checkpoint are deleted.
+# Rows written to the database right before a crash may be written again after the
+# restart, since the checkpoint is saved after the commit.
+#
+# Frame: payload length, number of rows, crc32 of the payload, then the pickled rows.
+HEADER = struct.Struct("<III")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT = "checkpoint"
+
+# Segment number, offset in the segment
+Position = Tuple[int, int]
+
+
+class Spool:
+    def __init__(
+        self,
+        directory: str,
+        max_size: int = 1024 * 1024 * 1024,
+        segment_size: int = 64 * 1024 * 1024,
+        fsync_interval: float = 1.,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = min(segment_size, max_size)
+        self.fsync_interval = fsync_interval
+        self.committed: Position = (0, 0)
+        # Segment number -> size in bytes
+        self.sizes: Dict[int, int] = {}
+        # Rows appended and not committed yet
+        self.pending = 0
+        self.fd = None
+        self.dirty = False
+        self.synced_at = 0.
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def scan(self, segment: int, offset: int, stop: int = -1) -> Tuple[int, int]:
+        # Rows in the segment from the offset until stop or the last complete frame,
+        # and the end of the last frame. Damaged frames count as pending rows too,
+        # read() skips them.
+        rows = 0
+        with open(self.path(segment), "rb") as fd:
+            fd.seek(offset)
+            while stop < 0 or offset < stop:
+                header = fd.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, count, crc = HEADER.unpack(header)
+                payload = fd.read(length)
+                if len(payload) < length:
+                    break
+                rows += count
+                offset += HEADER.size + length
+        return rows, offset
+
+    def open(self) -> "Spool":
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as fd:
+                segment, offset = fd.read().split()
+                self.committed = (int(segment), int(offset))
+        except (OSError, ValueError):
+            pass
+        segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for segment in segments:
+            if segment < self.committed[0]:
+                os.remove(self.path(segment))
+                continue
+            offset = self.committed[1] if segment == self.committed[0] else 0
+            rows, end = self.scan(segment, offset)
+            self.pending += rows
+            self.sizes[segment] = end
+            # A frame may be torn by a crash, only the last segment is appended to
+            if end < os.path.getsize(self.path(segment)):
+                os.truncate(self.path(segment), end)
+        if not self.sizes:
+            segment, offset = self.committed
+            self.committed = (segment + 1, 0) if offset else (segment, 0)
+            self.sizes[self.committed[0]] = 0
+        self.fd = open(self.path(max(self.sizes)), "ab")
+        return self
+
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def append(self, rows: List[Any]) -> int:
+        # Returns the number of rows dropped because the spool is full
+        payload = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        frame = HEADER.pack(len(payload), len(rows), zlib.crc32(payload)) + payload
+        current = max(self.sizes)
+        if self.sizes[current] and self.sizes[current] + len(frame) > self.segment_size:
+            self.sync(force=True)
+            self.fd.close()
+            current += 1
+            self.sizes[current] = 0
+            self.fd = open(self.path(current), "ab")
+        self.fd.write(frame)
+        # Readers use their own file objects
+        self.fd.flush()
+        self.dirty = True
+        self.sizes[current] += len(frame)
+        self.pending += len(rows)
+        self.sync()
+        dropped = 0
+        while self.size() > self.max_size and len(self.sizes) > 1:
+            dropped += self.drop_oldest()
+        return dropped
+
+    def drop_oldest(self) -> int:
+        segment = min(self.sizes)
+        offset = self.committed[1] if segment == self.committed[0] else 0
+        rows, _ = self.scan(segment, offset)
+        os.remove(self.path(segment))
+        del self.sizes[segment]
+        self.pending -= rows
+        self.save_checkpoint((min(self.sizes), 0))
+        return rows
+
+    def sync(self, force: bool = False):
+        # fsync is batched, at most once per fsync_interval unless forced
+        if not self.dirty:
+            return
+        if force or time.time() - self.synced_at >= self.fsync_interval:
+            os.fsync(self.fd.fileno())
+            self.dirty = False
+            self.synced_at = time.time()
+
+    def read(self, max_rows: int) -> Tuple[List[Any], Position, Position, int]:
+        # Whole frames from the checkpoint until max_rows is reached, the position of
+        # the first frame, the position right after the last one and the number of rows
+        # read including the rows of skipped damaged frames, to be passed to commit()
+        rows = []
+        consumed = 0
+        segment, offset = self.committed
+        while len(rows) < max_rows and segment in self.sizes:
+            end = self.sizes[segment]
+            if offset >= end:
+                if segment == max(self.sizes):
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            with open(self.path(segment), "rb") as fd:
+                fd.seek(offset)
+                while len(rows) < max_rows and offset < end:
+                    length, count, crc = HEADER.unpack(fd.read(HEADER.size))
+                    payload = fd.read(length)
+                    offset += HEADER.size + length
+                    consumed += count
+                    if zlib.crc32(payload) != crc:
+                        print(f"Spool: skipped a damaged frame of {count} rows in "
+                              f"{self.path(segment)}", flush=True)
+                        continue
+                    rows.extend(pickle.loads(payload))
+        return rows, self.committed, (segment, offset), consumed
+
+    def commit(self, start: Position, position: Position, rows: int):
+        if start != self.committed:
+            # Segments were dropped since the rows were read, the dropped rows are not
+            # pending anymore
+            if position <= self.committed:
+                return
+            rows = 0
+            for segment in range(self.committed[0], position[0] + 1):
+                offset = self.committed[1] if segment == self.committed[0] else 0
+                stop = position[1] if segment == position[0] else -1
+                rows += self.scan(segment, offset, stop)[0]
+        self.pending -= rows
+        for segment in [segment for segment in self.sizes if segment < position[0]]:
+            os.remove(self.path(segment))
+            del self.sizes[segment]
+        self.save_checkpoint(position)
+
+    def save_checkpoint(self, position: Position):
+        self.committed = position
+        path = os.path.join(self.directory, CHECKPOINT)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as fd:
+            fd.write(f"{position[0]} {position[1]}")
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, path)
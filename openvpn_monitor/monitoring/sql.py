@@ -1,6 +1,22 @@
+import abc
+import collections
+import json
 import multiprocessing
+import os
+import threading
+import time
+from queue import Empty
+from typing import Any, Callable, Dict, List, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import (
+    DBAPIError,
+    DisconnectionError,
+    InterfaceError,
+    OperationalError,
+    SQLAlchemyError,
+    TimeoutError as PoolTimeoutError,
+)
 from sqlalchemy.orm import Session
 
 from openvpn_monitor.columns import (
@@ -15,123 +31,552 @@ from openvpn_monitor.columns import (
     CLOSED_AT,
     TIMESTAMP_START,
     TIMESTAMP_END,
+    RECEIVED_PEAK,
+    SENT_PEAK,
+)
+from openvpn_monitor.const import ROLLUPS, RAW, SESSIONS, SESSION_SERIES
+from openvpn_monitor.metrics import (
+    Metrics,
+    QUEUE_DEPTH,
+    WRITER_BUFFERED_ROWS,
+    WRITER_DROPPED_ROWS,
+    WRITER_BATCH_ROWS,
+    WRITER_INSERT_SECONDS,
+    WRITER_ERRORS,
+    WRITER_REJECTED_ROWS,
+    SPOOL_BYTES,
 )
-from openvpn_monitor.monitoring.data import SessionData, SessionBytes
+from openvpn_monitor.monitoring.data import SessionData, SessionBytes, SessionSeriesBatch
+from openvpn_monitor.monitoring.management import Backoff
+from openvpn_monitor.monitoring.series import FIELDS
+from openvpn_monitor.monitoring.spool import Spool
+from openvpn_monitor.tables import rollup_table
+
+# Seconds the drain thread waits for an item before it checks whether to stop
+DRAIN_TIMEOUT = 1.
+# Rows refused by the database are appended there, in the spool directory of the writer
+REJECTED = "rejected.jsonl"
+
 
+def retriable(error: SQLAlchemyError) -> bool:
+    # Lost connections and timeouts pass with time, rows the database refuses
+    # (too long values, duplicate keys, ...) are refused again on every retry
+    if isinstance(error, (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
 
-class OVPNSessionsWriter(multiprocessing.Process):
-    def __init__(self, queue, connection_string, table):
-        super().__init__(name="session_writer")
+
+class OVPNBatchWriter(multiprocessing.Process, abc.ABC):
+    # Queue items are moved to a bounded buffer by a separate thread, so producers
+    # never wait for the database. When the buffer is full the oldest rows are dropped.
+    # With spool_dir the buffer is a spool on disk: rows survive database outages and
+    # restarts and are written in bulk when the database is back. Batches that failed
+    # on a connection error are retried with a backoff in both cases. Batches the
+    # database refuses are split until the bad rows are found, those are quarantined.
+    columns: List[str] = []
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        queue: multiprocessing.Queue,
+        connection_string: str,
+        table: str,
+        batch_size: int = 1000,
+        flush_interval: float = 5.,
+        spill_size: int = 100000,
+        stats_interval: float = 300.,
+        maintenance_interval: float = 3600.,
+        metrics_dir: Optional[str] = None,
+        spool_dir: Optional[str] = None,
+        spool_size: int = 1024 * 1024 * 1024,
+        fsync_interval: float = 1.,
+        partitioned: bool = False,
+        migrate: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__(name=name)
         self.queue = queue
         self.connection_string = connection_string
         self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_size = max(spill_size, batch_size)
+        self.stats_interval = stats_interval
+        self.maintenance_interval = maintenance_interval
+        # Partitioned tables expire by dropping whole partitions in OVPNPartitionMaintainer,
+        # row by row DELETEs would only lock the tables the dashboard reads
+        self.partitioned = partitioned
+        # Brings the schema up to date before the first write, retried until the
+        # database is reachable while the queue is drained into the buffer or spool
+        self.migrate = migrate
+        self.metrics = Metrics(metrics_dir, name)
+        self.spool_dir = os.path.join(spool_dir, name) if spool_dir else None
+        self.spool_size = spool_size
+        self.fsync_interval = fsync_interval
+        self.spool: Optional[Spool] = None
+        # Start and end of the batch read from the spool
+        self.spool_batch = None
+
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.rows_per_second = 0.
+        self.last_flush_duration = 0.
+
+    def write(self, session: Session, query, batch: List[Dict[str, Any]]):
+        session.execute(query, batch)
+
+    def maintain(self, engine):
+        pass
+
+    @abc.abstractmethod
+    def rows(self, item) -> List[Dict[str, Any]]:
+        # Rows of the table for one queue item
+        pass
+
+    def insert_query(self):
+        return text(
+            f"""
+            INSERT INTO {self.table}
+                ({", ".join(self.columns)})
+                VALUES
+                ({", ".join(":" + column for column in self.columns)})
+            """
+        )
+
+    def buffered(self) -> int:
+        return self.spool.pending if self.spool is not None else len(self.buffer)
+
+    def drain(self):
+        # Queue.get() holds the reader lock of the queue while it waits, so it waits
+        # for a short time only and the thread can be stopped before the process exits
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=DRAIN_TIMEOUT)
+            except Empty:
+                continue
+            rows = self.rows(item)
+            if not rows:
+                continue
+            with self.buffer_ready:
+                if self.spool is not None:
+                    if not self.spool.pending:
+                        self.first_buffered = time.time()
+                    dropped = self.spool.append(rows)
+                    if dropped:
+                        self.rows_dropped += dropped
+                        self.metrics.inc(WRITER_DROPPED_ROWS, dropped, writer=self.name)
+                    self.buffer_ready.notify()
+                    continue
+                overflow = len(self.buffer) + len(rows) - self.spill_size
+                if overflow > 0:
+                    self.rows_dropped += overflow
+                    self.metrics.inc(WRITER_DROPPED_ROWS, overflow, writer=self.name)
+                if not self.buffer:
+                    self.first_buffered = time.time()
+                self.buffer.extend(rows)
+                self.buffer_ready.notify()
+
+    def flush_due(self) -> bool:
+        buffered = self.buffered()
+        return bool(buffered) and (
+            buffered >= self.batch_size
+            or time.time() - self.first_buffered >= self.flush_interval
+        )
+
+    def next_batch(self) -> List[Dict[str, Any]]:
+        with self.buffer_ready:
+            while not self.flush_due():
+                if self.buffered():
+                    wait = self.flush_interval - (time.time() - self.first_buffered)
+                else:
+                    wait = None
+                if self.spool is not None:
+                    # Nothing to write yet, a good time for an fsync
+                    self.spool.sync(force=True)
+                    wait = min(wait, self.fsync_interval) if wait else self.fsync_interval
+                self.buffer_ready.wait(wait)
+            if self.spool is not None:
+                batch, start, end, consumed = self.spool.read(self.batch_size)
+                self.spool_batch = (start, end, consumed)
+                return batch
+            batch = [
+                self.buffer.popleft()
+                for _ in range(min(len(self.buffer), self.batch_size))
+            ]
+            if self.buffer:
+                self.first_buffered = time.time()
+            return batch
 
+    def written(self, batch: List[Dict[str, Any]]):
+        if self.spool is None:
+            return
+        with self.buffer_ready:
+            self.spool.commit(*self.spool_batch)
+            if self.spool.pending:
+                self.first_buffered = time.time()
+
+    def reject(self, row: Dict[str, Any], error: SQLAlchemyError):
+        self.metrics.inc(WRITER_REJECTED_ROWS, writer=self.name)
+        print(f"{self.name}: Rejected {row} with {error.__class__.__name__}: "
+              f"{getattr(error, 'orig', error)}", flush=True)
+        if not self.spool_dir:
+            return
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            with open(os.path.join(self.spool_dir, REJECTED), "a") as fd:
+                fd.write(json.dumps(row) + "\n")
+        except OSError as e:
+            print(f"{self.name}: Got {e.__repr__()} when tried to quarantine a row",
+                  flush=True)
+
+    def report(self, elapsed: float):
+        self.rows_per_second = self.rows_written / elapsed
+        print(
+            f"{self.name}: {self.rows_per_second:.2f} rows/s, "
+            f"{self.flushes} flushes, "
+            f"last flush took {self.last_flush_duration * 1000:.1f} ms, "
+            f"{self.buffered()} rows buffered, "
+            f"{self.rows_dropped} rows dropped",
+            flush=True
+        )
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+
+    def run(self):
         engine = create_engine(self.connection_string, pool_recycle=1800)
+        query = self.insert_query()
+
+        self.buffer = collections.deque(maxlen=self.spill_size)
+        self.buffer_ready = threading.Condition()
+        self.first_buffered = time.time()
+        if self.spool_dir:
+            self.spool = Spool(self.spool_dir, self.spool_size, fsync_interval=self.fsync_interval)
+            self.spool.open()
+            if self.spool.pending:
+                print(f"{self.name}: {self.spool.pending} rows in the spool", flush=True)
+            self.metrics.watch(SPOOL_BYTES, self.spool.size, writer=self.name)
+        self.stopped = threading.Event()
+        drain = threading.Thread(target=self.drain, name=f"{self.name}:drain", daemon=True)
+        drain.start()
+        self.metrics.watch(QUEUE_DEPTH, self.queue.qsize, writer=self.name)
+        self.metrics.watch(WRITER_BUFFERED_ROWS, self.buffered, writer=self.name)
+        self.metrics.start()
+        try:
+            self.loop(engine, query)
+        finally:
+            # A drain thread killed inside Queue.get() would keep the queue locked for
+            # the next writer
+            self.stopped.set()
+            drain.join()
+
+    def loop(self, engine, query):
+        backoff = Backoff()
+        while self.migrate is not None:
+            try:
+                self.migrate()
+                break
+            except SQLAlchemyError as e:
+                backoff.failed()
+                self.metrics.inc(WRITER_ERRORS, writer=self.name)
+                print(
+                    f"{self.name}: Got {e.__class__.__name__} when tried to migrate the "
+                    f"schema, retrying in {backoff.delay:.0f} seconds",
+                    flush=True
+                )
+                time.sleep(backoff.delay)
+        backoff.succeeded()
+        stats_start = time.time()
+        maintain_at = time.time()
+        batch = None
+        while True:
+            if batch is None:
+                batch = self.next_batch()
+                if not batch:
+                    # Only damaged frames were read from the spool
+                    self.written(batch)
+                    batch = None
+                    continue
+                # Parts of the batch not written yet, every part is one transaction
+                parts = [batch]
+
+            flush_start = time.time()
+            try:
+                with Session(engine) as session:
+                    self.write(session, query, parts[0])
+                    session.commit()
+                parts.pop(0)
+            except SQLAlchemyError as e:
+                if retriable(e):
+                    backoff.failed()
+                    self.metrics.inc(WRITER_ERRORS, writer=self.name)
+                    print(
+                        f"{self.name}: Got {e.__class__.__name__} when tried to write "
+                        f"{len(parts[0])} rows, retrying in {backoff.delay:.0f} seconds, "
+                        f"{self.buffered()} rows buffered",
+                        flush=True
+                    )
+                    time.sleep(backoff.delay)
+                    continue
+                # Halves are tried one by one until the refused rows are alone
+                part = parts.pop(0)
+                if len(part) < 2:
+                    for row in part:
+                        self.reject(row, e)
+                else:
+                    middle = len(part) // 2
+                    parts[:0] = [part[:middle], part[middle:]]
+            if parts:
+                continue
+            backoff.succeeded()
+            self.written(batch)
+            self.last_flush_duration = time.time() - flush_start
+            self.metrics.observe(WRITER_INSERT_SECONDS, self.last_flush_duration, writer=self.name)
+            self.metrics.observe(WRITER_BATCH_ROWS, len(batch), writer=self.name)
+            self.rows_written += len(batch)
+            self.flushes += 1
+            batch = None
+
+            elapsed = time.time() - stats_start
+            if elapsed >= self.stats_interval:
+                self.report(elapsed)
+                stats_start = time.time()
+
+            if not self.partitioned and time.time() >= maintain_at:
+                try:
+                    self.maintain(engine)
+                except SQLAlchemyError as e:
+                    print(f"{self.name}: Got {e.__class__.__name__} during maintenance",
+                          flush=True)
+                maintain_at = time.time() + self.maintenance_interval
+
+
+class OVPNSessionsWriter(OVPNBatchWriter):
+    columns = [
+        HOST,
+        USER,
+        IP,
+        INTERNAL_IP,
+        SENT,
+        RECEIVED,
+        CONNECTED_AT_STR,
+        CONNECTED_AT,
+        CLOSED_AT,
+    ]
+
+    def __init__(
+        self,
+        queue,
+        connection_string,
+        table,
+        retention: Optional[Dict[str, int]] = None,
+        **kwargs
+    ):
+        # Retention in days, 0 or None keeps sessions forever
+        self.retention = (retention or {}).get(SESSIONS)
+        super().__init__(
+            name="session_writer",
+            queue=queue,
+            connection_string=connection_string,
+            table=table,
+            **kwargs
+        )
+
+    def maintain(self, engine):
+        if not self.retention:
+            return
         with Session(engine) as session:
             session.execute(
-                f'''CREATE TABLE IF NOT EXISTS {self.table}
-                    (
-                        {HOST} VarChar(255) NOT NULL,
-                        {USER} Text, 
-                        {IP} Text, 
-                        {INTERNAL_IP} Text, 
-                        {SENT} Integer, 
-                        {RECEIVED} Integer, 
-                        {CONNECTED_AT_STR} Text, 
-                        {CONNECTED_AT} Integer,
-                        {CLOSED_AT} Integer
-                    )
-                    PARTITION BY KEY ({HOST})'''
+                text(f"DELETE FROM {self.table} WHERE {CLOSED_AT} < :timestamp"),
+                {"timestamp": int(time.time()) - self.retention * 24 * 60 * 60}
             )
             session.commit()
 
-    def run(self):
-        engine = create_engine(self.connection_string, pool_recycle=1800)
-        while True:
-            ovpn_session: SessionData = self.queue.get()
-            query = (
-                f"""
-                INSERT INTO {self.table} 
-                    (
-                        {HOST},
-                        {USER}, 
-                        {IP}, 
-                        {INTERNAL_IP}, 
-                        {SENT}, 
-                        {RECEIVED}, 
-                        {CONNECTED_AT_STR}, 
-                        {CONNECTED_AT}, 
-                        {CLOSED_AT}
-                    ) 
-                    VALUES
-                    (
-                        "{ovpn_session.host}",
-                        "{ovpn_session.user}", 
-                        "{ovpn_session.ip}", 
-                        "{ovpn_session.internal_ip}", 
-                        "{ovpn_session.sent}", 
-                        "{ovpn_session.received}", 
-                        "{ovpn_session.connected_at_str}", 
-                        "{ovpn_session.connected_at}", 
-                        "{ovpn_session.closed_at}"
+    def rows(self, ovpn_session: SessionData) -> List[Dict[str, Any]]:
+        return [
+            {
+                HOST: ovpn_session.host,
+                USER: ovpn_session.user,
+                IP: ovpn_session.ip,
+                INTERNAL_IP: ovpn_session.internal_ip,
+                SENT: ovpn_session.sent,
+                RECEIVED: ovpn_session.received,
+                CONNECTED_AT_STR: ovpn_session.connected_at_str,
+                CONNECTED_AT: ovpn_session.connected_at,
+                CLOSED_AT: ovpn_session.closed_at,
+            }
+        ]
+
+
+class OVPNDataWriter(OVPNBatchWriter):
+    columns = [
+        HOST,
+        TIMESTAMP_START,
+        TIMESTAMP_END,
+        USER,
+        SENT,
+        RECEIVED,
+    ]
+    # Rollups keep the highest speed of a single row inside every bucket
+    rollup_columns = columns + [SENT_PEAK, RECEIVED_PEAK]
+
+    def __init__(
+        self,
+        queue,
+        connection_string,
+        table,
+        retention: Optional[Dict[str, int]] = None,
+        **kwargs
+    ):
+        # Rollup name -> (bucket size in seconds, table)
+        self.rollups = {
+            name: (seconds, rollup_table(table, name)) for name, seconds in ROLLUPS.items()
+        }
+        # Table name -> retention in days, 0 or None keeps data forever
+        retention = retention or {}
+        self.retention = {table: retention.get(RAW)}
+        self.retention.update(
+            {rollup: retention.get(name) for name, (_, rollup) in self.rollups.items()}
+        )
+        super().__init__(
+            name="data_writer",
+            queue=queue,
+            connection_string=connection_string,
+            table=table,
+            **kwargs
+        )
+
+    def rollup_query(self, rollup: str):
+        return text(
+            f"""
+            INSERT INTO {rollup}
+                ({", ".join(self.rollup_columns)})
+                VALUES
+                ({", ".join(":" + column for column in self.rollup_columns)})
+                ON DUPLICATE KEY UPDATE
+                    {SENT} = {SENT} + VALUES({SENT}),
+                    {RECEIVED} = {RECEIVED} + VALUES({RECEIVED}),
+                    {SENT_PEAK} = GREATEST({SENT_PEAK}, VALUES({SENT_PEAK})),
+                    {RECEIVED_PEAK} = GREATEST({RECEIVED_PEAK}, VALUES({RECEIVED_PEAK}))
+            """
+        )
+
+    def write(self, session: Session, query, batch: List[Dict[str, Any]]):
+        super().write(session, query, batch)
+        # Bytes per second of every row over its poll interval
+        speeds = []
+        for row in batch:
+            duration = row[TIMESTAMP_END] - row[TIMESTAMP_START]
+            if duration > 0:
+                speeds.append((row[SENT] / duration, row[RECEIVED] / duration))
+            else:
+                speeds.append((0., 0.))
+        for seconds, rollup in self.rollups.values():
+            buckets = {}
+            for row, (sent_speed, received_speed) in zip(batch, speeds):
+                bucket = row[TIMESTAMP_START] - row[TIMESTAMP_START] % seconds
+                key = (row[HOST], bucket, row[USER])
+                if key not in buckets:
+                    buckets[key] = {
+                        HOST: row[HOST],
+                        TIMESTAMP_START: bucket,
+                        TIMESTAMP_END: bucket + seconds,
+                        USER: row[USER],
+                        SENT: 0,
+                        RECEIVED: 0,
+                        SENT_PEAK: 0.,
+                        RECEIVED_PEAK: 0.,
+                    }
+                value = buckets[key]
+                value[SENT] += row[SENT]
+                value[RECEIVED] += row[RECEIVED]
+                value[SENT_PEAK] = max(value[SENT_PEAK], sent_speed)
+                value[RECEIVED_PEAK] = max(value[RECEIVED_PEAK], received_speed)
+            session.execute(self.rollup_query(rollup), list(buckets.values()))
+
+    def maintain(self, engine):
+        with Session(engine) as session:
+            for table, days in self.retention.items():
+                if not days:
+                    continue
+                session.execute(
+                    text(f"DELETE FROM {table} WHERE {TIMESTAMP_START} < :timestamp"),
+                    {"timestamp": int(time.time()) - days * 24 * 60 * 60}
                 )
-                """
+            session.commit()
+
+    def rows(self, sessionbytes: SessionBytes) -> List[Dict[str, Any]]:
+        return [
+            {
+                HOST: sessionbytes.host,
+                TIMESTAMP_START: sessionbytes.timestamp_start,
+                TIMESTAMP_END: sessionbytes.timestamp_end,
+                USER: user,
+                SENT: sent,
+                RECEIVED: received,
+            }
+            for user, sent, received in zip(
+                sessionbytes.users, sessionbytes.sent, sessionbytes.received
             )
-            with Session(engine) as session:
-                session.execute(query)
-                session.commit()
+        ]
 
 
-class OVPNDataWriter(multiprocessing.Process):
-    def __init__(self, queue, connection_string, table):
-        super().__init__(name="data_writer")
-        self.queue = queue
-        self.connection_string = connection_string
-        self.table = table
+class OVPNSessionSeriesWriter(OVPNBatchWriter):
+    columns = [
+        HOST,
+        USER,
+        IP,
+        CONNECTED_AT,
+        TIMESTAMP_START,
+        TIMESTAMP_END,
+        SENT,
+        RECEIVED,
+    ]
 
-        engine = create_engine(self.connection_string, pool_recycle=1800)
+    def __init__(
+        self,
+        queue,
+        connection_string,
+        table,
+        retention: Optional[Dict[str, int]] = None,
+        **kwargs
+    ):
+        # Retention in days, 0 or None keeps the series forever
+        self.retention = (retention or {}).get(SESSION_SERIES)
+        super().__init__(
+            name="session_series_writer",
+            queue=queue,
+            connection_string=connection_string,
+            table=table,
+            **kwargs
+        )
+
+    def maintain(self, engine):
+        if not self.retention:
+            return
         with Session(engine) as session:
             session.execute(
-                f'''CREATE TABLE IF NOT EXISTS {self.table}
-                    (
-                        {HOST} VarChar(255) NOT NULL,
-                        {TIMESTAMP_START} Integer, 
-                        {TIMESTAMP_END} Integer, 
-                        {USER} Text, 
-                        {SENT} Integer, 
-                        {RECEIVED} Integer
-                    )
-                    PARTITION BY KEY ({HOST})'''
+                text(f"DELETE FROM {self.table} WHERE {TIMESTAMP_START} < :timestamp"),
+                {"timestamp": int(time.time()) - self.retention * 24 * 60 * 60}
             )
             session.commit()
 
-    def run(self):
-        engine = create_engine(self.connection_string, pool_recycle=1800)
-        while True:
-            sessionbytes: SessionBytes = self.queue.get()
-            for user in sessionbytes.data:
-                query = (
-                    f"""
-                    INSERT INTO {self.table} 
-                        (
-                            {HOST},
-                            {TIMESTAMP_START}, 
-                            {TIMESTAMP_END}, 
-                            {USER}, 
-                            {SENT}, 
-                            {RECEIVED}
-                        )
-                        VALUES
-                        (
-                            "{sessionbytes.host}",
-                            "{sessionbytes.timestamp_start}", 
-                            "{sessionbytes.timestamp_end}", 
-                            "{user}", 
-                            "{sessionbytes.data[user]['sent']}", 
-                            "{sessionbytes.data[user]['received']}"
-                        )
-                    """
-                )
-                with Session(engine) as session:
-                    session.execute(query)
-                    session.commit()
+    def rows(self, batch: SessionSeriesBatch) -> List[Dict[str, Any]]:
+        values = batch.values
+        rows = []
+        for idx in range(0, len(values), FIELDS + 1):
+            user, ip, connected_at = batch.sessions[values[idx]]
+            rows.append(
+                {
+                    HOST: batch.host,
+                    USER: user,
+                    IP: ip,
+                    CONNECTED_AT: connected_at,
+                    TIMESTAMP_START: values[idx + 1],
+                    TIMESTAMP_END: values[idx + 2],
+                    SENT: values[idx + 3],
+                    RECEIVED: values[idx + 4],
+                }
+            )
+        return rows
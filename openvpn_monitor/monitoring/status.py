@@ -0,0 +1,166 @@
+import time
+from typing import Dict, List, Tuple
+
+from openvpn_monitor.monitoring.data import SessionData
+
+# Tabs separate the fields in version 3, common names may contain commas
+STATUS_COMMAND = b"status 3"
+
+CLIENT_LIST = "CLIENT_LIST"
+NOTIFICATION = ">"
+HEADER = "HEADER"
+END_LINE = b"END\n"
+END_LINE_CRLF = b"END\r\n"
+
+COMMON_NAME = "Common Name"
+REAL_ADDRESS = "Real Address"
+VIRTUAL_ADDRESS = "Virtual Address"
+BYTES_RECEIVED = "Bytes Received"
+BYTES_SENT = "Bytes Sent"
+CONNECTED_SINCE = "Connected Since"
+CONNECTED_SINCE_TIME_T = "Connected Since (time_t)"
+CLIENT_ID = "Client ID"
+
+# Columns of CLIENT_LIST in status version 2 and 3 of OpenVPN 2.4+, used until the
+# HEADER line is seen
+DEFAULT_COLUMNS = [
+    CLIENT_LIST, COMMON_NAME, REAL_ADDRESS, VIRTUAL_ADDRESS, "Virtual IPv6 Address",
+    BYTES_RECEIVED, BYTES_SENT, CONNECTED_SINCE, CONNECTED_SINCE_TIME_T, "Username",
+    CLIENT_ID, "Peer ID", "Data Channel Cipher",
+]
+TEXT_COLUMNS = [COMMON_NAME, REAL_ADDRESS, VIRTUAL_ADDRESS, CONNECTED_SINCE, CLIENT_ID]
+NUMBER_COLUMNS = [BYTES_RECEIVED, BYTES_SENT, CONNECTED_SINCE_TIME_T]
+
+# Common name, real address, virtual address, connected since
+SessionKey = Tuple[str, str, str, str]
+
+
+class StatusParser:
+    # Parses the response to `status 2` or `status 3` chunk by chunk while it is being
+    # received: complete lines of every chunk are decoded at once and the rest waits
+    # for the next chunk. Columns are located by the names in the HEADER line, so older
+    # versions without some columns and newer ones with extra columns are handled.
+    # Fields are separated by commas in version 2 and by tabs in version 3.
+    def __init__(self, host_alias: str):
+        self.host_alias = host_alias
+        self.buffer = bytearray()
+        self.sessions: Dict[SessionKey, SessionData] = {}
+        # Session -> client ID, when the server reports them
+        self.client_ids: Dict[SessionKey, str] = {}
+        self.done = False
+        # Real-time notifications received before and within the response, in order
+        self.notifications: List[str] = []
+        # Bytes received after the END line
+        self.remainder = b""
+        # CPU time spent in feed()
+        self.elapsed = 0.
+        self.columns(DEFAULT_COLUMNS)
+
+    def columns(self, names: List[str]):
+        index = {name: idx for idx, name in enumerate(names)}
+        # Missing columns point past the end of the line, where padding is appended
+        width = len(names)
+        self.padding = []
+        for column in TEXT_COLUMNS + NUMBER_COLUMNS:
+            if column not in index:
+                index[column] = width + len(self.padding)
+                self.padding.append("0" if column in NUMBER_COLUMNS else "")
+        self.width = width
+        self.index = (
+            index[COMMON_NAME],
+            index[REAL_ADDRESS],
+            index[VIRTUAL_ADDRESS],
+            index[BYTES_RECEIVED],
+            index[BYTES_SENT],
+            index[CONNECTED_SINCE],
+            index[CONNECTED_SINCE_TIME_T],
+        )
+        self.client_id = index[CLIENT_ID] if CLIENT_ID in names else None
+
+    def clients(self, lines: List[str], separator: str):
+        common_name, real_address, virtual_address, bytes_received, bytes_sent, \
+            connected_since, connected_since_time_t = self.index
+        host_alias, width, padding = self.host_alias, self.width, self.padding
+        client_id = self.client_id
+        sessions, client_ids = self.sessions, self.client_ids
+        for line in lines:
+            fields = line.split(separator)
+            if len(fields) < width:
+                continue
+            if padding:
+                fields += padding
+            user = fields[common_name]
+            ip = fields[real_address]
+            internal_ip = fields[virtual_address]
+            connected_at_str = fields[connected_since]
+            key = (user, ip, internal_ip, connected_at_str)
+            # The server receives what the client sends
+            sessions[key] = SessionData(
+                host_alias,
+                user,
+                ip,
+                internal_ip,
+                int(fields[bytes_received]),
+                int(fields[bytes_sent]),
+                connected_at_str,
+                int(fields[connected_since_time_t]),
+                None,
+            )
+            if client_id is not None:
+                client_ids[key] = fields[client_id]
+
+    def lines(self, text: str):
+        clients = []
+        for line in text.split("\n"):
+            if line.startswith(CLIENT_LIST):
+                clients.append(line.rstrip("\r"))
+            elif line.startswith(NOTIFICATION):
+                self.notifications.append(line.rstrip("\r"))
+            elif line.startswith(HEADER):
+                line = line.rstrip("\r")
+                names = line.split(line[len(HEADER):len(HEADER) + 1])[1:]
+                if names and names[0] == CLIENT_LIST:
+                    if clients:
+                        self.clients(clients, clients[0][len(CLIENT_LIST)])
+                        clients = []
+                    self.columns(names)
+        if clients:
+            self.clients(clients, clients[0][len(CLIENT_LIST)])
+
+    def end_line(self, end: int) -> int:
+        # Offset of the END line among the complete lines of the buffer, or -1
+        buffer = self.buffer
+        if buffer.startswith(END_LINE) or buffer.startswith(END_LINE_CRLF):
+            return 0
+        found = [
+            idx + 1 for idx in (
+                buffer.find(b"\n" + END_LINE, 0, end + 1),
+                buffer.find(b"\n" + END_LINE_CRLF, 0, end + 1),
+            )
+            if idx >= 0
+        ]
+        return min(found) if found else -1
+
+    def feed(self, chunk: bytes) -> bool:
+        # Returns True when the whole response has been parsed
+        started = time.perf_counter()
+        self.buffer += chunk
+        end = self.buffer.rfind(b"\n")
+        if end >= 0:
+            stop = self.end_line(end)
+            if stop >= 0:
+                self.lines(self.buffer[:stop].decode("utf-8", "replace"))
+                self.remainder = bytes(self.buffer[self.buffer.index(b"\n", stop) + 1:])
+                self.buffer = bytearray()
+                self.done = True
+            else:
+                self.lines(self.buffer[:end].decode("utf-8", "replace"))
+                self.buffer = self.buffer[end + 1:]
+        self.elapsed += time.perf_counter() - started
+        return self.done
+
+
+def parse(host_alias: str, response: bytes) -> StatusParser:
+    parser = StatusParser(host_alias)
+    parser.feed(response)
+    return parser
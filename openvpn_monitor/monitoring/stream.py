@@ -0,0 +1,262 @@
+import datetime
+import multiprocessing
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from openvpn_monitor.const import ALL
+from openvpn_monitor.live import LiveStatePublisher
+from openvpn_monitor.metrics import Metrics, POLL_SECONDS, PARSE_SECONDS
+from openvpn_monitor.monitoring.checkpoint import Checkpoint, STREAM
+from openvpn_monitor.monitoring.data import SessionData, SessionBytes
+from openvpn_monitor.monitoring.management import ManagementConnection
+from openvpn_monitor.monitoring.series import SessionSeriesTracker
+from openvpn_monitor.monitoring.status import STATUS_COMMAND, StatusParser
+
+BYTECOUNT = ">BYTECOUNT_CLI:"
+CLIENT = ">CLIENT:"
+CLIENT_ENV = ">CLIENT:ENV,"
+ESTABLISHED = "ESTABLISHED"
+DISCONNECT = "DISCONNECT"
+
+
+class OVPNStreamMonitor(multiprocessing.Process):
+    # Subscribes to the real-time notifications of the management interface instead of
+    # polling the full client list: >BYTECOUNT_CLI updates the counters of one session,
+    # >CLIENT:ESTABLISHED and >CLIENT:DISCONNECT open and close sessions. The full client
+    # list is still fetched every `resync` seconds to catch missed notifications.
+    def __init__(
+        self,
+        *,
+        host_alias: str = "VPNServer",
+        host: str = "localhost",
+        port: int = 7505,
+        sessions_queue: multiprocessing.Queue,
+        data_queue: multiprocessing.Queue,
+        interval: int = 10,
+        timeout: int = 5,
+        bytecount: int = 5,
+        resync: int = 300,
+        live_dir: Optional[str] = None,
+        metrics_dir: Optional[str] = None,
+        series_queue: Optional[multiprocessing.Queue] = None,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_max_age: float = 3600.,
+    ):
+        super().__init__(name=f"monitor:{host_alias}")
+        self.host_alias = host_alias
+        self.host = host
+        self.port = port
+        self.sessions_queue = sessions_queue
+        self.data_queue = data_queue
+        self.interval = interval
+        self.timeout = timeout
+        self.bytecount = bytecount
+        self.resync = resync
+        self.resync_at = 0.
+        self.connection = ManagementConnection(host, port, timeout)
+        self.live = LiveStatePublisher(live_dir, host_alias) if live_dir else None
+        self.metrics = Metrics(metrics_dir, self.name)
+        self.series_queue = series_queue
+        self.series = SessionSeriesTracker(host_alias) if series_queue is not None else None
+        self.checkpoint = (
+            Checkpoint(checkpoint_dir, host_alias, STREAM, checkpoint_max_age)
+            if checkpoint_dir else None
+        )
+
+        # Client ID -> session with the last seen cumulative counters. Sessions of
+        # servers that do not report client IDs are keyed by their SessionKey.
+        self.sessions: Dict[Any, SessionData] = {}
+        # User -> [sent, received]
+        self.user_dw_data: Dict[str, List[int]] = {}
+        self.event: Optional[Tuple[str, str, Dict[str, str]]] = None
+        self.warned = False
+
+    def add_traffic(self, user: str, sent: int, received: int):
+        for key in (user, ALL):
+            value = self.user_dw_data.get(key)
+            if value is None:
+                value = self.user_dw_data[key] = [0, 0]
+            value[0] += sent
+            value[1] += received
+
+    def update(self, cid: str, sent: int, received: int):
+        sess = self.sessions.get(cid)
+        if sess is None:
+            # Notification for a session we have not seen, take a full snapshot
+            self.resync_at = 0
+            return
+        if sent < sess.sent or received < sess.received:
+            # Counters never go down within a session: the client ID was reused, e.g.
+            # after a server restart. The snapshot picks the new session up.
+            self.close(cid, int(time.time()))
+            self.resync_at = 0
+            return
+        self.add_traffic(sess.user, sent - sess.sent, received - sess.received)
+        sess.sent, sess.received = sent, received
+
+    def close(self, cid: str, closed_at: int):
+        sess = self.sessions.pop(cid, None)
+        if sess is None:
+            return
+        sess.closed_at = closed_at
+        self.sessions_queue.put(sess)
+
+    def snapshot(self):
+        parser = StatusParser(self.host_alias)
+        with self.metrics.time(POLL_SECONDS, host=self.host_alias):
+            self.connection.stream(STATUS_COMMAND, parser)
+        apply_start = time.perf_counter()
+        # Notifications received before the snapshot, e.g. the final counters of a
+        # disconnect, must not be lost with the sessions they close
+        for line in parser.notifications:
+            self.handle(line)
+        self.apply_snapshot(parser)
+        self.metrics.observe(
+            PARSE_SECONDS,
+            parser.elapsed + time.perf_counter() - apply_start,
+            host=self.host_alias,
+        )
+
+    def apply_snapshot(self, parser: StatusParser):
+        timestamp = int(time.time())
+        self.resync_at = timestamp + self.resync
+        seen = set()
+        polled = 0
+        for key, sess in parser.sessions.items():
+            cid = parser.client_ids.get(key)
+            if cid is None:
+                # Notifications refer to client IDs only, such sessions are counted
+                # from the snapshots alone
+                cid = key
+                polled += 1
+            seen.add(cid)
+            known = self.sessions.get(cid)
+            if known is not None and (
+                (known.user, known.ip, known.connected_at)
+                != (sess.user, sess.ip, sess.connected_at)
+                or sess.sent < known.sent or sess.received < known.received
+            ):
+                # Client IDs start over when the server restarts
+                self.close(cid, timestamp)
+                known = None
+            if known is not None:
+                self.update(cid, sess.sent, sess.received)
+            else:
+                self.sessions[cid] = sess
+        for cid in [cid for cid in self.sessions if cid not in seen]:
+            self.close(cid, timestamp)
+        if polled:
+            # Without client IDs the snapshot is taken every interval, as in polling mode
+            self.resync_at = timestamp + self.interval
+            if not self.warned:
+                self.warned = True
+                print(f"{self.host_alias}: {polled} sessions without a client ID, the "
+                      f"server is polled every {self.interval} seconds instead", flush=True)
+
+    def established(self, cid: str, env: Dict[str, str]):
+        connected_at = int(env.get("time_unix", time.time()))
+        self.sessions[cid] = SessionData(
+            host=self.host_alias,
+            user=env.get("common_name", ""),
+            ip=f"{env.get('trusted_ip', '')}:{env.get('trusted_port', '')}",
+            internal_ip=env.get("ifconfig_pool_remote_ip", ""),
+            sent=0,
+            received=0,
+            connected_at_str=datetime.datetime.fromtimestamp(connected_at).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+            connected_at=connected_at,
+            closed_at=None,
+        )
+
+    def disconnected(self, cid: str, env: Dict[str, str]):
+        if "bytes_received" in env and "bytes_sent" in env:
+            self.update(cid, int(env["bytes_received"]), int(env["bytes_sent"]))
+        self.close(cid, int(time.time()))
+
+    def handle(self, line: str):
+        if line.startswith(BYTECOUNT):
+            # >BYTECOUNT_CLI:{CID},{BYTES_IN},{BYTES_OUT}
+            cid, bytes_in, bytes_out = line[len(BYTECOUNT):].split(",")[:3]
+            self.update(cid, int(bytes_in), int(bytes_out))
+        elif line.startswith(CLIENT_ENV):
+            if self.event is None:
+                return
+            env = line[len(CLIENT_ENV):]
+            if env == "END":
+                kind, cid, env = self.event
+                self.event = None
+                if kind == ESTABLISHED:
+                    self.established(cid, env)
+                elif kind == DISCONNECT:
+                    self.disconnected(cid, env)
+            else:
+                key, _, value = env.partition("=")
+                self.event[2][key] = value
+        elif line.startswith(CLIENT):
+            # >CLIENT:{EVENT},{CID}[,{KID}]
+            kind, cid = (line[len(CLIENT):].split(",") + [""])[:2]
+            self.event = (kind, cid, {})
+
+    def flush(self, timestamp_prev: int, timestamp: int):
+        data, self.user_dw_data = self.user_dw_data, {}
+        sessionbytes = None
+        if ALL in data and (data[ALL][0] != 0 or data[ALL][1] != 0):
+            sessionbytes = SessionBytes.from_totals(
+                self.host_alias, timestamp_prev, timestamp, data
+            )
+        if self.live is not None:
+            self.live.publish(timestamp_prev, timestamp, self.sessions.values(), sessionbytes)
+        if self.series is not None:
+            self.series.update(timestamp_prev, timestamp, self.sessions.values())
+            batch = self.series.flush()
+            if batch is not None:
+                self.series_queue.put(batch)
+        if sessionbytes is not None:
+            self.data_queue.put(sessionbytes)
+        if self.checkpoint is not None:
+            self.checkpoint.save(timestamp, self.sessions)
+
+    def subscribe(self):
+        self.event = None
+        self.snapshot()
+        self.connection.send(f"bytecount {self.bytecount}".encode())
+
+    def run(
+        self,
+    ):
+        print(f'Started streaming monitoring for host {self.host_alias}', flush=True)
+        self.metrics.start()
+        timestamp = int(time.time())
+        restored = self.checkpoint.load() if self.checkpoint is not None else None
+        if restored is not None:
+            timestamp, self.sessions = restored
+        subscribed = False
+
+        while True:
+            deadline = timestamp + self.interval
+            try:
+                if not subscribed:
+                    self.subscribe()
+                    subscribed = True
+                elif time.time() >= self.resync_at:
+                    self.snapshot()
+                while time.time() < deadline:
+                    line = self.connection.readline(max(deadline - time.time(), 0.01))
+                    if line is not None:
+                        self.handle(line.decode('utf-8', 'replace').rstrip("\r\n"))
+            except OSError as e:
+                subscribed = False
+                print(
+                    f"{self.host_alias}: Got {e.__repr__()} when tried to fetch data "
+                    f"from the monitoring port for {self.host}:{self.port}",
+                    flush=True
+                )
+                time.sleep(min(max(deadline - time.time(), 0), self.connection.retry_in()))
+
+            timestamp_prev, timestamp = timestamp, int(time.time())
+            if timestamp > timestamp_prev:
+                self.flush(timestamp_prev, timestamp)
+            else:
+                timestamp = timestamp_prev
+
@@ -1,65 +1,139 @@
+import functools
 import multiprocessing
 import os
 import sys
-import time
 
 import yaml
 
 from openvpn_monitor.monitoring.monitor import monitor
 
+from openvpn_monitor.const import LIVE_DIR, METRICS_DIR, SPOOL_DIR, CHECKPOINT_DIR
+from openvpn_monitor.metrics import serve as serve_metrics
+from openvpn_monitor.supervisor import Supervisor, Worker
 from openvpn_monitor.tables import SESSIONS_TABLE, DATA_TABLE
-from openvpn_monitor.dashboard.dashboard import app
 
+# Roles of the process, collector nodes do not need the dashboard dependencies
+ALL = "all"
+COLLECTOR = "collector"
+DASHBOARD = "dashboard"
+ROLES = (ALL, COLLECTOR, DASHBOARD)
 
-def main():
+
+def serve_dashboard(**kwargs):
+    # Imported in the webserver process only: dash, pandas and plotly take seconds
+    # and about 100 MB, the monitor and the collectors forked from it must not
+    # inherit them
+    from openvpn_monitor.dashboard.wsgi import serve
+    serve(**kwargs)
+
+
+def monitor_worker(metrics_dir: str) -> Worker:
     with open("/config.yaml") as fd:
         config = yaml.safe_load(fd)
     connection_string = os.environ["CONNECTION_STRING"]
     interval = int(os.environ.get("INTERVAL", "60"))
     timeout = int(os.environ.get("TIMEOUT", "5"))
-
-    processes = []
+    batch_size = int(os.environ.get("BATCH_SIZE", "1000"))
+    flush_interval = float(os.environ.get("FLUSH_INTERVAL", "5"))
+    spill_size = int(os.environ.get("SPILL_SIZE", "100000"))
+    collector = os.environ.get("COLLECTOR", "process")
+    bytecount = int(os.environ.get("BYTECOUNT", "5"))
+    live_dir = os.environ.get("LIVE_DIR", LIVE_DIR)
+    session_series = os.environ.get("SESSION_SERIES", "1") == "1"
+    spool_dir = os.environ.get("SPOOL_DIR", SPOOL_DIR)
+    # Megabytes per writer
+    spool_size = int(os.environ.get("SPOOL_SIZE", "1024")) * 1024 * 1024
+    fsync_interval = float(os.environ.get("FSYNC_INTERVAL", "1"))
+    checkpoint_dir = os.environ.get("CHECKPOINT_DIR", CHECKPOINT_DIR)
+    checkpoint_max_age = float(os.environ.get("CHECKPOINT_MAX_AGE", "3600"))
 
     print("Starting monitor", flush=True)
-    processes.append(
-        multiprocessing.Process(
-            target=monitor,
-            name="monitor",
-            kwargs={
-                "hosts": config["hosts"],
-                "connection_string": connection_string,
-                "data_table": DATA_TABLE,
-                "sessions_table": SESSIONS_TABLE,
-                "interval": interval,
-                "timeout": min(timeout, interval),
-            }
-        )
-    )
-
-    processes.append(
-        multiprocessing.Process(
-            target=app.run_server,
-            name="webserver",
-            kwargs={
-                "host": "0.0.0.0",
-                "port": 8888,
-            }
-        )
-    )
-
-    for process in processes:
-        process.start()
-
-    while True:
-        if not all([process.is_alive() for process in processes]):
-            print("Some processes died", flush=True)
-            for process in processes:
-                if process.is_alive():
-                    process.terminate()
-                process.join()
-            sys.exit(1)
-        time.sleep(10)
+    return Worker(functools.partial(
+        multiprocessing.Process,
+        target=monitor,
+        name="monitor",
+        kwargs={
+            "hosts": config["hosts"],
+            "connection_string": connection_string,
+            "data_table": DATA_TABLE,
+            "sessions_table": SESSIONS_TABLE,
+            "interval": interval,
+            "timeout": min(timeout, interval),
+            "batch_size": batch_size,
+            "flush_interval": flush_interval,
+            "spill_size": spill_size,
+            "collector": collector,
+            "bytecount": bytecount,
+            "retention": config.get("retention"),
+            "partitioning": config.get("partitioning"),
+            "live_dir": live_dir,
+            "metrics_dir": metrics_dir,
+            "session_series": session_series,
+            "spool_dir": spool_dir,
+            "spool_size": spool_size,
+            "fsync_interval": fsync_interval,
+            "checkpoint_dir": checkpoint_dir,
+            "checkpoint_max_age": checkpoint_max_age,
+        }
+    ))
+
+
+def dashboard_worker() -> Worker:
+    # gunicorn or dev for the Flask development server
+    web_server = os.environ.get("WEB_SERVER", "gunicorn")
+    web_workers = int(os.environ.get("WEB_WORKERS", "2"))
+    web_threads = int(os.environ.get("WEB_THREADS", "4"))
+
+    print("Starting webserver", flush=True)
+    return Worker(functools.partial(
+        multiprocessing.Process,
+        target=serve_dashboard,
+        name="webserver",
+        kwargs={
+            "host": "0.0.0.0",
+            "port": 8888,
+            "server": web_server,
+            "workers": web_workers,
+            "threads": web_threads,
+        }
+    ))
+
+
+def metrics_worker(metrics_dir: str, port: int) -> Worker:
+    print("Starting metrics endpoint", flush=True)
+    return Worker(functools.partial(
+        multiprocessing.Process,
+        target=serve_metrics,
+        name="metrics",
+        kwargs={
+            "directory": metrics_dir,
+            "host": "0.0.0.0",
+            "port": port,
+        }
+    ))
+
+
+def main(role: str = ALL):
+    if role not in ROLES:
+        print(f"Unknown role {role}, expected one of {', '.join(ROLES)}", flush=True)
+        sys.exit(2)
+    metrics_dir = os.environ.get("METRICS_DIR", METRICS_DIR)
+    # The dashboard serves /metrics on its own port, collector nodes need an endpoint;
+    # 0 disables it
+    metrics_port = int(os.environ.get("METRICS_PORT", "9100" if role == COLLECTOR else "0"))
+
+    workers = []
+    if role in (ALL, COLLECTOR):
+        workers.append(monitor_worker(metrics_dir))
+    if role in (ALL, DASHBOARD):
+        workers.append(dashboard_worker())
+    if metrics_port and metrics_dir:
+        workers.append(metrics_worker(metrics_dir, metrics_port))
+
+    Supervisor("main", workers, metrics_dir=metrics_dir).run()
+    sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    # all, collector or dashboard
+    main(os.environ.get("ROLE", ALL))
@@ -0,0 +1,135 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+from typing import Callable, List, Optional
+
+from openvpn_monitor.metrics import Metrics, WORKER_RESTARTS
+from openvpn_monitor.monitoring.management import Backoff
+
+# Restart policies
+ALWAYS = "always"
+ON_FAILURE = "on-failure"
+NEVER = "never"
+
+
+class Worker:
+    def __init__(
+        self,
+        factory: Callable[[], multiprocessing.Process],
+        restart: str = ALWAYS,
+        shared: bool = False,
+        delay_min: float = 1.,
+        delay_max: float = 60.,
+    ):
+        # factory creates a new process for every start, a process can be started once
+        self.factory = factory
+        self.restart = restart
+        # The worker shares a multiprocessing.Queue with other workers. Killed by a
+        # signal it may leave the queue locked or with a torn message, so no worker
+        # could use the queue again: the supervisor stops and leaves the restart to its
+        # parent, which creates fresh queues.
+        self.shared = shared
+        self.backoff = Backoff(delay_min, delay_max)
+        self.process: Optional[multiprocessing.Process] = None
+        self.name = ""
+        self.started_at = 0.
+        self.restart_at: Optional[float] = None
+
+    def start(self):
+        self.process = self.factory()
+        self.name = self.process.name
+        self.process.start()
+        self.started_at = time.time()
+        self.restart_at = None
+
+
+class Supervisor:
+    # Starts the workers and restarts every worker that exits according to its policy,
+    # with an exponential backoff per worker. Exits are noticed immediately by waiting
+    # on the process sentinels. A worker that ran for `stable_after` seconds starts
+    # over with the minimal delay. A shared worker killed by a signal stops the whole
+    # supervisor with exit code 1 (see Worker.shared).
+    def __init__(
+        self,
+        name: str,
+        workers: List[Worker],
+        stable_after: float = 60.,
+        metrics_dir: Optional[str] = None,
+    ):
+        self.name = name
+        self.workers = workers
+        self.stable_after = stable_after
+        self.metrics = Metrics(metrics_dir, f"supervisor:{name}")
+        self.pid = None
+
+    def exited(self, worker: Worker):
+        worker.process.join()
+        exitcode = worker.process.exitcode
+        if worker.shared and exitcode < 0:
+            print(f"{self.name}: {worker.name} was killed by signal {-exitcode}, "
+                  f"its queues may be unusable, restarting all workers", flush=True)
+            self.terminate()
+            sys.exit(1)
+        if worker.restart == NEVER or (worker.restart == ON_FAILURE and exitcode == 0):
+            print(f"{self.name}: {worker.name} exited with code {exitcode}", flush=True)
+            worker.process = None
+            return
+        if time.time() - worker.started_at >= self.stable_after:
+            worker.backoff.succeeded()
+        worker.backoff.failed()
+        worker.restart_at = worker.backoff.retry_at
+        worker.process = None
+        self.metrics.inc(WORKER_RESTARTS, worker=worker.name)
+        print(
+            f"{self.name}: {worker.name} exited with code {exitcode}, "
+            f"restarting in {worker.backoff.delay:.1f} seconds",
+            flush=True
+        )
+
+    def stop(self, signum, frame):
+        if os.getpid() != self.pid:
+            # Forked workers inherit the handler, they stop the default way
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        print(f"{self.name}: stopping", flush=True)
+        self.terminate()
+        sys.exit(0)
+
+    def terminate(self):
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        for process in processes:
+            process.terminate()
+        deadline = time.time() + 10
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def run(self):
+        self.pid = os.getpid()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.metrics.start()
+        for worker in self.workers:
+            worker.start()
+
+        while True:
+            running = {
+                worker.process.sentinel: worker
+                for worker in self.workers if worker.process is not None
+            }
+            pending = [worker.restart_at for worker in self.workers if worker.restart_at]
+            if not running and not pending:
+                print(f"{self.name}: all workers exited", flush=True)
+                return
+            timeout = max(min(pending) - time.time(), 0) if pending else None
+            for sentinel in multiprocessing.connection.wait(list(running), timeout):
+                self.exited(running[sentinel])
+            for worker in self.workers:
+                if worker.restart_at is not None and time.time() >= worker.restart_at:
+                    worker.start()
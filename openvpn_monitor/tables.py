@@ -1,2 +1,11 @@
 DATA_TABLE = "data"
 SESSIONS_TABLE = "sessions"
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+def rollup_table(table: str, rollup: str) -> str:
+    return f"{table}_{rollup}"
+
+
+def series_table(sessions_table: str) -> str:
+    return f"{sessions_table}_series"
@@ -0,0 +1,5 @@
+from openvpn_monitor.run import DASHBOARD, main
+
+# Dashboard node: serves the dashboard only, needs no /config.yaml
+if __name__ == "__main__":
+    main(DASHBOARD)
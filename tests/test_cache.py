@@ -0,0 +1,138 @@
+import datetime
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from openvpn_monitor.dashboard.cache import CachedReader, QueryCache
+
+
+class Counter:
+    def __init__(self, value=None):
+        self.calls = 0
+        self.value = value
+
+    def __call__(self):
+        self.calls += 1
+        return self.value if self.value is not None else self.calls
+
+
+def test_hit_within_ttl():
+    cache = QueryCache(ttl=60)
+    func = Counter()
+    assert cache.get("key", func) == 1
+    assert cache.get("key", func) == 1
+    assert func.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_after_ttl():
+    cache = QueryCache(ttl=0.05)
+    func = Counter()
+    assert cache.get("key", func) == 1
+    time.sleep(0.1)
+    assert cache.get("key", func) == 2
+
+
+def test_least_recently_used_evicted():
+    cache = QueryCache(ttl=60, maxsize=2)
+    cache.get("a", Counter("a"))
+    cache.get("b", Counter("b"))
+    cache.get("a", Counter("stale"))
+    cache.get("c", Counter("c"))
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_concurrent_requests_coalesced():
+    cache = QueryCache(ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def query():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("key", query)))
+        for _ in range(8)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # The other threads wait for the running query
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == ["result"] * 8
+
+
+def test_error_raised_to_waiters_and_not_cached():
+    cache = QueryCache(ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    errors = []
+
+    def get():
+        try:
+            cache.get("key", failing)
+        except ValueError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=get)
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=get)
+    waiter.start()
+    time.sleep(0.1)
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+    assert len(errors) == 2
+    assert cache.get("key", Counter("ok")) == "ok"
+
+
+class Reader:
+    table = "data"
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, host=None, connected_at_min=None):
+        self.calls.append((host, connected_at_min))
+        return pd.DataFrame({"value": [1, 2]})
+
+
+def test_cached_reader_rounds_datetimes():
+    reader = Reader()
+    cached = CachedReader(reader, QueryCache(ttl=60), bucket=60)
+    now = datetime.datetime(2024, 1, 1, 12, 0, 5)
+    first = cached(host="gw", connected_at_min=now)
+    second = cached(host="gw", connected_at_min=now + datetime.timedelta(seconds=30))
+    assert reader.calls == [("gw", datetime.datetime(2024, 1, 1, 12, 0))]
+    # Callers get copies, changing one does not change the cached frame
+    first["value"] = 0
+    assert second["value"].tolist() == [1, 2]
+    assert cached(host="gw", connected_at_min=now)["value"].tolist() == [1, 2]
+
+
+@pytest.mark.parametrize("host", ["gw", "other"])
+def test_cached_reader_keys_by_arguments(host):
+    reader = Reader()
+    cached = CachedReader(reader, QueryCache(ttl=60))
+    cached(host="gw")
+    cached(host=host)
+    assert len(reader.calls) == (1 if host == "gw" else 2)
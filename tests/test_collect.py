@@ -0,0 +1,57 @@
+from openvpn_monitor.const import ALL
+from openvpn_monitor.monitoring.data import SessionData
+from openvpn_monitor.monitoring.openvpn import collect
+
+
+def session(user: str, ip: str, sent: int, received: int) -> SessionData:
+    return SessionData("gw", user, ip, "10.8.0.2", sent, received, "2024-01-01 00:00:00",
+                       1704067200)
+
+
+def status(*sessions: SessionData):
+    return {(s.user, s.ip, s.internal_ip, s.connected_at_str): s for s in sessions}
+
+
+def totals(sessionbytes):
+    return {
+        user: (sent, received)
+        for user, sent, received in zip(
+            sessionbytes.users, sessionbytes.sent, sessionbytes.received)
+    }
+
+
+def test_deltas_per_user_and_total():
+    prev = status(session("alice", "a:1", 100, 1000), session("alice", "a:2", 10, 10),
+                  session("bob", "b:1", 5, 5))
+    curr = status(session("alice", "a:1", 150, 1100), session("alice", "a:2", 20, 30),
+                  session("bob", "b:1", 5, 5))
+    expired, sessionbytes = collect("gw", 60, prev, 120, curr)
+    assert expired == []
+    assert (sessionbytes.host, sessionbytes.timestamp_start, sessionbytes.timestamp_end) == (
+        "gw", 60, 120)
+    assert totals(sessionbytes) == {ALL: (60, 120), "alice": (60, 120), "bob": (0, 0)}
+
+
+def test_expired_sessions_closed_at_previous_poll():
+    gone = session("bob", "b:1", 5, 5)
+    prev = status(session("alice", "a:1", 100, 100), gone)
+    curr = status(session("alice", "a:1", 200, 100))
+    expired, sessionbytes = collect("gw", 60, prev, 120, curr)
+    assert expired == [gone]
+    assert gone.closed_at == 60
+    # The traffic of the expired session after the last poll is unknown
+    assert totals(sessionbytes) == {ALL: (100, 0), "alice": (100, 0)}
+
+
+def test_new_sessions_are_a_baseline():
+    prev = status(session("alice", "a:1", 100, 100))
+    curr = status(session("alice", "a:1", 100, 100), session("bob", "b:1", 500, 500))
+    expired, sessionbytes = collect("gw", 60, prev, 120, curr)
+    assert expired == []
+    assert sessionbytes is None
+
+
+def test_first_poll():
+    expired, sessionbytes = collect("gw", 0, {}, 60, status(session("alice", "a:1", 1, 1)))
+    assert expired == []
+    assert sessionbytes is None
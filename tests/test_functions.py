@@ -0,0 +1,75 @@
+import datetime
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from openvpn_monitor.const import DATA_SIZES, DATA_SPEEDS
+from openvpn_monitor.dashboard.functions import (
+    bytes_to_str,
+    speed_to_str,
+    timestamps_to_datetime,
+    units_to_str,
+)
+
+
+@pytest.fixture(params=["UTC", "Europe/Berlin", "America/St_Johns", "Australia/Lord_Howe"])
+def timezone(request):
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = request.param
+    time.tzset()
+    yield request.param
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+
+
+def numbers():
+    values = [0, 1, 1023, 1024, 1025, 5.125, 10.005, 1023.995, 1023.996]
+    for power in range(1, 7):
+        unit = 1024 ** power
+        values += [unit - 1, unit, unit + 1, unit * 1.5, unit * 1023.995, unit * 0.125]
+    rng = np.random.default_rng(0)
+    values += list(rng.integers(0, 2 ** 62, 1000))
+    values += list(rng.random(1000) * 10 ** rng.integers(0, 15, 1000))
+    # Exact halves of a hundredth are rounded by the float value, as in f-strings
+    values += [idx / 200 for idx in range(2000)]
+    return values
+
+
+def test_units_to_str_matches_scalar():
+    values = numbers()
+    data = pd.Series(values, dtype="float64")
+    assert units_to_str(data, DATA_SIZES).tolist() == [bytes_to_str(x) for x in values]
+    assert units_to_str(data, DATA_SPEEDS).tolist() == [speed_to_str(x) for x in values]
+
+
+def test_units_to_str_integers_and_missing():
+    data = pd.Series([1024, None, 3 * 1024 ** 2], dtype=object)
+    assert units_to_str(data, DATA_SIZES).tolist() == ["1.00 KiB", None, "3.00 MiB"]
+    assert units_to_str(pd.Series([], dtype="float64"), DATA_SIZES).tolist() == []
+
+
+def test_units_to_str_keeps_index():
+    data = pd.Series([1, 2048], index=[10, 20])
+    assert units_to_str(data, DATA_SIZES).to_dict() == {10: "1.00 B", 20: "2.00 KiB"}
+
+
+def test_timestamps_to_datetime_matches_fromtimestamp(timezone):
+    # Every 7 minutes over two years, through the DST changes
+    start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    timestamps = np.arange(start, start + 2 * 366 * 86400, 7 * 60 + 13)
+    result = timestamps_to_datetime(pd.Series(timestamps))
+    expected = [datetime.datetime.fromtimestamp(ts) for ts in timestamps]
+    assert result.dt.to_pydatetime().tolist() == expected
+
+
+def test_timestamps_to_datetime_missing(timezone):
+    result = timestamps_to_datetime(pd.Series([None, 1704067200], index=[5, 6]))
+    assert result.index.tolist() == [5, 6]
+    assert pd.isna(result[5])
+    assert result[6] == datetime.datetime.fromtimestamp(1704067200)
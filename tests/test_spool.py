@@ -0,0 +1,135 @@
+import os
+
+from openvpn_monitor.monitoring.spool import HEADER, Spool
+
+
+def rows(start: int, count: int):
+    return [{"id": idx} for idx in range(start, start + count)]
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def test_append_read_commit(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    assert spool.append(rows(0, 3)) == 0
+    assert spool.append(rows(3, 2)) == 0
+    assert spool.pending == 5
+
+    # Whole frames only, the frame that reaches max_rows is read completely
+    batch, start, end, consumed = spool.read(4)
+    assert batch == rows(0, 5)
+    assert consumed == 5
+    spool.commit(start, end, consumed)
+    assert spool.pending == 0
+    assert spool.read(10)[0] == []
+
+
+def test_partial_read(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    spool.append(rows(0, 3))
+    spool.append(rows(3, 3))
+    batch, start, end, consumed = spool.read(2)
+    assert batch == rows(0, 3)
+    spool.commit(start, end, consumed)
+    assert spool.pending == 3
+    assert spool.read(10)[0] == rows(3, 3)
+
+
+def test_recovery_after_restart(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    spool.append(rows(0, 3))
+    spool.append(rows(3, 3))
+    batch, start, end, consumed = spool.read(1)
+    spool.commit(start, end, consumed)
+    spool.sync(force=True)
+
+    # Rows not committed survive, committed ones are not read again
+    spool = Spool(str(tmp_path)).open()
+    assert spool.pending == 3
+    assert spool.read(10)[0] == rows(3, 3)
+
+
+def test_uncommitted_rows_read_again_after_restart(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    spool.append(rows(0, 3))
+    spool.read(10)
+    spool = Spool(str(tmp_path)).open()
+    assert spool.pending == 3
+    assert spool.read(10)[0] == rows(0, 3)
+
+
+def test_torn_frame_truncated(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    spool.append(rows(0, 3))
+    spool.sync(force=True)
+    path = spool.path(0)
+    size = os.path.getsize(path)
+    # A crash in the middle of the next frame
+    with open(path, "ab") as fd:
+        fd.write(HEADER.pack(100, 5, 0) + b"torn")
+
+    spool = Spool(str(tmp_path)).open()
+    assert os.path.getsize(path) == size
+    assert spool.pending == 3
+    spool.append(rows(3, 1))
+    assert spool.read(10)[0] == rows(0, 4)
+
+
+def test_damaged_frame_skipped_and_counted(tmp_path):
+    spool = Spool(str(tmp_path)).open()
+    spool.append(rows(0, 2))
+    spool.append(rows(2, 2))
+    spool.sync(force=True)
+    # Flip the last byte of the first payload
+    path = spool.path(0)
+    with open(path, "r+b") as fd:
+        length = HEADER.unpack(fd.read(HEADER.size))[0]
+        fd.seek(HEADER.size + length - 1)
+        last = fd.read(1)
+        fd.seek(HEADER.size + length - 1)
+        fd.write(bytes([last[0] ^ 0xff]))
+
+    spool = Spool(str(tmp_path)).open()
+    assert spool.pending == 4
+    batch, start, end, consumed = spool.read(10)
+    assert batch == rows(2, 2)
+    assert consumed == 4
+    spool.commit(start, end, consumed)
+    assert spool.pending == 0
+
+
+def test_segments_rotated_and_deleted_after_commit(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=200).open()
+    for idx in range(10):
+        spool.append(rows(idx * 5, 5))
+    assert len(segments(tmp_path)) > 1
+    batch, start, end, consumed = spool.read(1000)
+    assert batch == rows(0, 50)
+    spool.commit(start, end, consumed)
+    assert spool.pending == 0
+    assert len(segments(tmp_path)) == 1
+
+
+def test_oldest_segments_dropped_when_full(tmp_path):
+    spool = Spool(str(tmp_path), max_size=1000, segment_size=200).open()
+    dropped = sum(spool.append(rows(idx * 5, 5)) for idx in range(40))
+    assert dropped > 0
+    assert spool.size() <= 1000
+    assert spool.pending == 200 - dropped
+    batch, start, end, consumed = spool.read(1000)
+    # The newest rows are kept
+    assert batch == rows(200 - len(batch), len(batch))
+    assert len(batch) == spool.pending
+
+
+def test_commit_after_drop(tmp_path):
+    spool = Spool(str(tmp_path), max_size=1000, segment_size=200).open()
+    spool.append(rows(0, 5))
+    batch, start, end, consumed = spool.read(1000)
+    # Segments are dropped while the batch is being written
+    for idx in range(1, 40):
+        spool.append(rows(idx * 5, 5))
+    spool.commit(start, end, consumed)
+    assert spool.pending == len(spool.read(1000)[0])
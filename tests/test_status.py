@@ -0,0 +1,135 @@
+from openvpn_monitor.monitoring.status import StatusParser, parse
+
+HEADER_V3 = [
+    "CLIENT_LIST", "Common Name", "Real Address", "Virtual Address", "Virtual IPv6 Address",
+    "Bytes Received", "Bytes Sent", "Connected Since", "Connected Since (time_t)",
+    "Username", "Client ID", "Peer ID", "Data Channel Cipher",
+]
+CLIENTS = [
+    ["CLIENT_LIST", "alice, admin", "198.51.100.1:50000", "10.8.0.2", "", "100", "200",
+     "2024-01-01 00:00:00", "1704067200", "UNDEF", "5", "0", "AES-256-GCM"],
+    ["CLIENT_LIST", "bob", "198.51.100.2:50001", "10.8.0.3", "", "300", "400",
+     "2024-01-01 00:01:00", "1704067260", "UNDEF", "6", "1", "AES-256-GCM"],
+]
+
+
+def status(separator: str, header=HEADER_V3, clients=CLIENTS, newline="\n") -> bytes:
+    lines = [
+        separator.join(["TITLE", "OpenVPN 2.5.9"]),
+        separator.join(["TIME", "2024-01-01 00:02:00", "1704067320"]),
+        separator.join(["HEADER"] + header),
+    ]
+    lines += [separator.join(client) for client in clients]
+    lines += [separator.join(["GLOBAL_STATS", "Max bcast/mcast queue length", "0"]), "END"]
+    return newline.join(lines).encode() + newline.encode()
+
+
+def summary(parser: StatusParser):
+    return sorted(
+        (s.user, s.ip, s.internal_ip, s.sent, s.received, s.connected_at_str, s.connected_at)
+        for s in parser.sessions.values()
+    )
+
+
+EXPECTED = [
+    ("alice, admin", "198.51.100.1:50000", "10.8.0.2", 100, 200, "2024-01-01 00:00:00",
+     1704067200),
+    ("bob", "198.51.100.2:50001", "10.8.0.3", 300, 400, "2024-01-01 00:01:00", 1704067260),
+]
+
+
+def test_version_3_with_tabs():
+    parser = parse("gw", status("\t"))
+    assert parser.done
+    assert summary(parser) == EXPECTED
+    assert sorted(parser.client_ids.values()) == ["5", "6"]
+    assert all(s.host == "gw" and s.closed_at is None for s in parser.sessions.values())
+
+
+def test_version_2_with_commas():
+    # Commas inside common names are ambiguous in version 2, plain names only
+    clients = [CLIENTS[1]]
+    parser = parse("gw", status(",", clients=clients))
+    assert summary(parser) == EXPECTED[1:]
+
+
+def test_crlf_line_endings():
+    parser = parse("gw", status("\t", newline="\r\n"))
+    assert parser.done
+    assert summary(parser) == EXPECTED
+
+
+def test_columns_located_by_header():
+    # OpenVPN 2.3 has no Client ID, the columns after Virtual Address are shifted
+    header = [
+        "CLIENT_LIST", "Common Name", "Real Address", "Virtual Address", "Bytes Received",
+        "Bytes Sent", "Connected Since", "Connected Since (time_t)", "Username",
+    ]
+    clients = [[
+        "CLIENT_LIST", "bob", "198.51.100.2:50001", "10.8.0.3", "300", "400",
+        "2024-01-01 00:01:00", "1704067260", "UNDEF",
+    ]]
+    parser = parse("gw", status(",", header=header, clients=clients))
+    assert summary(parser) == EXPECTED[1:]
+    assert parser.client_ids == {}
+
+
+def test_extra_columns_reordered():
+    header = ["CLIENT_LIST", "Bytes Sent", "Bytes Received"] + [
+        name for name in HEADER_V3[1:] if name not in ("Bytes Sent", "Bytes Received")
+    ] + ["Something New"]
+    clients = [
+        [client[0], client[6], client[5]] + client[1:5] + client[7:] + ["x"]
+        for client in CLIENTS
+    ]
+    parser = parse("gw", status("\t", header=header, clients=clients))
+    assert summary(parser) == EXPECTED
+
+
+def test_short_lines_skipped():
+    clients = [CLIENTS[0], ["CLIENT_LIST", "broken"]]
+    parser = parse("gw", status("\t", clients=clients))
+    assert summary(parser) == EXPECTED[:1]
+
+
+def test_chunked_feed_matches_whole_response():
+    data = status("\t")
+    for size in (1, 2, 7, 64, len(data)):
+        parser = StatusParser("gw")
+        results = [parser.feed(data[idx:idx + size]) for idx in range(0, len(data), size)]
+        assert results[-1] is True
+        assert not any(results[:-1])
+        assert summary(parser) == EXPECTED
+
+
+def test_not_done_before_end():
+    data = status("\t")
+    parser = StatusParser("gw")
+    assert parser.feed(data[:-len(b"END\n")]) is False
+    assert not parser.done
+    assert parser.feed(b"END\n") is True
+
+
+def test_notifications_and_remainder():
+    data = (
+        b">BYTECOUNT_CLI:5,1000,2000\n"
+        + status("\t")
+        + b">CLIENT:DISCONNECT,6\n"
+    )
+    parser = StatusParser("gw")
+    idx = 0
+    while not parser.feed(data[idx:idx + 5]):
+        idx += 5
+    assert parser.notifications == [">BYTECOUNT_CLI:5,1000,2000"]
+    # Bytes after the END line belong to the next read
+    assert parser.remainder + data[idx + 5:] == b">CLIENT:DISCONNECT,6\n"
+    assert summary(parser) == EXPECTED
+
+
+def test_invalid_utf8_replaced():
+    line = "\t".join(CLIENTS[1]).replace("bob", "caf\udce9")
+    data = status("\t", clients=[]).replace(
+        b"GLOBAL_STATS", line.encode("utf-8", "surrogateescape") + b"\nGLOBAL_STATS"
+    )
+    parser = parse("gw", data)
+    assert [s.user for s in parser.sessions.values()] == ["caf\ufffd"]
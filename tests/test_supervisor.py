@@ -0,0 +1,110 @@
+import functools
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+from openvpn_monitor.metrics import WORKER_RESTARTS
+from openvpn_monitor.supervisor import ALWAYS, NEVER, ON_FAILURE, Supervisor, Worker
+
+
+def fail_times(path: str, failures: int):
+    # Exits with code 1 on the first `failures` starts, then with 0
+    with open(path, "a") as fd:
+        fd.write(f"{time.time()}\n")
+    with open(path) as fd:
+        starts = len(fd.readlines())
+    sys.exit(1 if starts <= failures else 0)
+
+
+def starts(path: str):
+    with open(path) as fd:
+        return [float(line) for line in fd]
+
+
+def worker(path, failures: int, restart: str, **kwargs) -> Worker:
+    return Worker(
+        functools.partial(
+            multiprocessing.Process,
+            target=fail_times,
+            name="worker",
+            args=(str(path), failures),
+        ),
+        restart=restart,
+        **kwargs
+    )
+
+
+@pytest.fixture(autouse=True)
+def signals():
+    # Supervisor.run() installs its own handlers
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_restart_with_backoff(tmp_path):
+    path = tmp_path / "starts"
+    failing = worker(path, 3, ON_FAILURE, delay_min=0.1, delay_max=0.25)
+    supervisor = Supervisor("test", [failing])
+    supervisor.run()
+
+    times = starts(path)
+    assert len(times) == 4
+    delays = [b - a for a, b in zip(times, times[1:])]
+    # 0.1, 0.2, then capped at 0.25
+    for delay, expected in zip(delays, [0.1, 0.2, 0.25]):
+        assert expected <= delay < expected + 0.5
+    assert supervisor.metrics.values[(WORKER_RESTARTS, (("worker", "worker"),))] == 3
+
+
+def test_backoff_reset_after_stable_run(tmp_path):
+    path = tmp_path / "starts"
+    failing = worker(path, 3, ON_FAILURE, delay_min=0.1, delay_max=10.)
+    # Every run counts as stable, the delay never grows
+    Supervisor("test", [failing], stable_after=0.).run()
+    delays = [b - a for a, b in zip(starts(path), starts(path)[1:])]
+    assert len(delays) == 3
+    assert all(delay < 0.4 for delay in delays)
+
+
+def test_restart_policies(tmp_path):
+    never = worker(tmp_path / "never", 1, NEVER, delay_min=0.01)
+    on_failure = worker(tmp_path / "on_failure", 1, ON_FAILURE, delay_min=0.01)
+    Supervisor("test", [never, on_failure]).run()
+    assert len(starts(tmp_path / "never")) == 1
+    assert len(starts(tmp_path / "on_failure")) == 2
+
+
+def sleep_forever():
+    time.sleep(60)
+
+
+def test_shared_worker_killed_stops_supervisor(monkeypatch):
+    shared = Worker(
+        functools.partial(multiprocessing.Process, target=sleep_forever, name="shared"),
+        restart=ALWAYS,
+        shared=True,
+    )
+    other = Worker(
+        functools.partial(multiprocessing.Process, target=sleep_forever, name="other"),
+        restart=ALWAYS,
+    )
+    supervisor = Supervisor("test", [shared, other])
+    original = Worker.start
+
+    def start(self):
+        original(self)
+        if self is shared:
+            os.kill(self.process.pid, signal.SIGKILL)
+
+    monkeypatch.setattr(Worker, "start", start)
+    with pytest.raises(SystemExit) as exit_info:
+        supervisor.run()
+    assert exit_info.value.code == 1
+    # The other workers are stopped too
+    assert not other.process.is_alive()
@@ -0,0 +1,73 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+from sqlalchemy import create_engine
+
+from openvpn_monitor.metrics import WRITER_REJECTED_ROWS
+from openvpn_monitor.monitoring.data import SessionData
+from openvpn_monitor.monitoring.sql import REJECTED, OVPNSessionsWriter
+
+
+class Written(Exception):
+    pass
+
+
+class OneBatchWriter(OVPNSessionsWriter):
+    # Stops the loop once the first batch is written
+    def written(self, batch):
+        super().written(batch)
+        raise Written()
+
+
+def session(idx: int, sent: int) -> SessionData:
+    return SessionData("gw", f"user{idx}", f"198.51.100.{idx}:1194", f"10.8.0.{idx}", sent,
+                       idx, "2024-01-01 00:00:00", 1704067200 + idx, 1704070800)
+
+
+@pytest.fixture
+def database(tmp_path):
+    url = f"sqlite:///{tmp_path / 'db.sqlite'}"
+    with create_engine(url).begin() as connection:
+        # The database refuses negative counters
+        connection.exec_driver_sql(
+            """CREATE TABLE sessions (
+                host Text, user Text, ip Text, internal_ip Text,
+                sent Integer CHECK (sent >= 0), received Integer,
+                connected_at_str Text, connected_at Integer, closed_at Integer)"""
+        )
+    return url
+
+
+@pytest.mark.parametrize("spool", [False, True])
+def test_refused_rows_quarantined(tmp_path, database, spool):
+    queue = multiprocessing.Queue()
+    bad = {3, 8}
+    for idx in range(10):
+        queue.put(session(idx, -1 if idx in bad else idx * 100))
+    spool_dir = str(tmp_path / "spool")
+    writer = OneBatchWriter(
+        queue,
+        database,
+        "sessions",
+        batch_size=10,
+        flush_interval=60.,
+        spool_dir=spool_dir if spool else None,
+    )
+    with pytest.raises(Written):
+        writer.run()
+
+    with create_engine(database).connect() as connection:
+        users = [row[0] for row in connection.exec_driver_sql(
+            "SELECT user FROM sessions ORDER BY connected_at")]
+    assert users == [f"user{idx}" for idx in range(10) if idx not in bad]
+    assert writer.metrics.values[(WRITER_REJECTED_ROWS, (("writer", writer.name),))] == 2
+    if spool:
+        # The quarantine file is kept in the spool directory of the writer
+        with open(os.path.join(writer.spool_dir, REJECTED)) as fd:
+            rejected = [json.loads(line) for line in fd]
+        assert [row["user"] for row in rejected] == ["user3", "user8"]
+        assert writer.spool.pending == 0
+    else:
+        assert writer.spool is None